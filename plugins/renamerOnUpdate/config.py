@@ -124,11 +124,20 @@ p_tag_option = {
 # Will look like: IDSCENE|OLD_PATH|NEW_PATH
 # Leave Blank ("") or use None if you don't want to use a log file, or a working path like: C:\Users\USERNAME\.stash\plugins\Hooks\rename_log.txt
 log_file = r""
+# Journal of the moves (renamerOnUpdate_journal.jsonl in the plugin folder), written before each file is moved. Needed by the task 'Undo renames'.
+rename_journal = False
+# The task 'Undo renames' moves back the files moved between undo_since and undo_until (e.g. "2024-05-01T20:00"), of the scenes in undo_scenes (scene ids or oshash).
+# Everything empty: the moves of the last run. A file is only moved back if its oshash didn't change.
+undo_since = ""
+undo_until = ""
+undo_scenes = []
 
 ######################################
 #               Settings             #
 
 # rename associated file (subtitle, funscript) if present
+# The extension can be in any case, and subtitles with a language (video.en.srt, video.pt-BR.forced.srt) are renamed too,
+# unless another file of the folder has the longer name (video.HD.srt goes with video.HD.mp4, not video.mp4).
 associated_extension = ["srt", "vtt", "funscript"]
 
 # use filename as title if no title is set
@@ -170,6 +179,8 @@ duration_format = r"%H;%M;%S"
 lowercase_Filename = False
 # filename in title case (Capitalises each word and lowercases the rest)
 titlecase_Filename = False
+# words always put in uppercase by titlecase_Filename (ex: ["USA", "FBI"])
+titlecase_abbreviations = []
 # remove these characters if there are present in the filename
 removecharac_Filename = ",#"
 
@@ -198,6 +209,7 @@ prevent_title_performer = True
 # remove consecutive (/FolderName/FolderName/video.mp4 -> FolderName/video.mp4
 prevent_consecutive = True
 # check when the file has moved that the old directory is empty, if empty it will remove it.
+# With the tasks, the folders are checked once at the end of the run, and their parents left empty are removed too (up to your library folders).
 remove_emptyfolder = True
 # the folder only contains 1 performer name. Else it will look the same as for filename
 path_one_performer = True
@@ -254,9 +266,40 @@ alt_diff_display = False
 
 # number of scene process by the task renamer. -1 = all scenes
 batch_number_scene = -1
+# number of scenes fetched per request by the task renamer (the next page is downloaded while the current one is renamed). -1 = all scenes at once
+batch_page_size = 500
+# True: the task 'Rename scenes' only checks the scenes updated since its last run and skips the ones that didn't change (renamerOnUpdate_state.sqlite).
+# Changing the config or a studio checks every scene again. Use the task 'Rename all scenes' after renaming a performer, a tag...
+# False: the task 'Rename scenes' checks every scene.
+bulk_incremental = False
+# the tasks read the scenes directly in the database of Stash (read-only) instead of asking Stash, much faster for big libraries.
+# Needs Stash 0.17+ (files refactor). Stash itself isn't slowed down but the plugin must be able to read the database file.
+bulk_sqlite_read = False
+
+# number of renames saved in the same database transaction by the task renamer. Higher is faster, lower keeps Stash waiting less.
+db_batch_size = 100
+# seconds SQLite waits for Stash to release the database, then the plugin retries (with backoff) this many times.
+db_timeout = 2
+db_busy_retries = 8
+# number of files moved at the same time by the task 'Apply plan' (the plan is made by the task 'Plan renames' in renamerOnUpdate_plan.jsonl)
+plan_workers = 4
 
 # disable/enable the hook. You can edit this value in 'Plugin Tasks' inside of Stash.
 enable_hook = True
+# Linux/macOS: the hooks are done by a worker process kept running in the background, instead of starting the plugin for each scene.
+# The worker stops after worker_idle_timeout seconds without hook, or when config.py is changed. Its log is in renamerOnUpdate_worker.log
+resident_worker = False
+worker_idle_timeout = 300
+# the hooks add the scene to a queue (renamerOnUpdate_queue.sqlite) and a single process renames the queued scenes by batches.
+# A scene is renamed once it wasn't updated for hook_debounce seconds, so several updates of the same scene give one rename.
+hook_queue = False
+hook_debounce = 2
+# log the time spent in each phase (GraphQL requests, rendering, collisions, moves, database...) when the plugin ends.
+profile = False
+# also write the phases in renamerOnUpdate_trace.json (plugin folder), to open in chrome://tracing or https://ui.perfetto.dev
+profile_trace = False
+# also log the peak memory used by the plugin (tracemalloc, slower)
+profile_memory = False
 # disable/enable dry mode. Do a trial run with no permanent changes. Can write into a file (dryrun_renamerOnUpdate.txt), set a path for log_file. 
 # You can edit this value in 'Plugin Tasks' inside of Stash.
 dry_run = False
@@ -268,6 +311,7 @@ dry_run_append = False
 # ! OPTIONAL module settings. Not needed for basic operation !
 
 # = psutil module (https://pypi.org/project/psutil/) =
+# On Linux, the open files are read in /proc and psutil is not needed.
 # Gets a list of all processes instead of stopping after the first one. Enabling it slows down the plugin
 process_getall = False
 # If the file is used by a process, the plugin will kill it. IT CAN MAKE STASH CRASH TOO. 
@@ -1,14 +1,156 @@
 import difflib
+import errno
+import functools
+import hashlib
+import heapq
 import json
 import os
+import pathlib
 import re
 import shutil
+import signal
+import socket
 import sqlite3
+import stat
+import struct
+import subprocess
 import sys
+import threading
 import time
 import traceback
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
+import log
+
+try:
+    import config
+except Exception:
+    log.LogWarning("Could not import ROU config file, did you rename the template file to 'config.py'? Defaulting to template config file")
+    import renamerOnUpdate_config as config
+
+START_TIME = time.time()
+FRAGMENT = json.loads(sys.stdin.read())
+
+# = Resident worker =
+# With resident_worker, the hooks are sent to a worker process that keeps
+# everything loaded (modules, Stash configuration, templates...) and waits on
+# a Unix socket. The hook process only forwards the scene and ends.
+WORKER = "--worker" in sys.argv
+
+
+def private_dir(path: str, create: bool = False) -> bool:
+    """True if the folder belongs to the user and nobody else can open it."""
+    if create:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            return False
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(path_stat.st_mode)
+        and path_stat.st_uid == os.getuid()
+        and not path_stat.st_mode & 0o077
+    )
+
+
+def worker_socket_path(plugin_dir: str):
+    """
+    Path of the worker socket, in $XDG_RUNTIME_DIR or else in a private folder
+    of the plugin folder, so other users can't take its place.
+    None if there is no such folder (no worker then).
+    """
+    key = zlib.crc32(os.path.abspath(plugin_dir).encode())
+    name = f"renamerOnUpdate-{key:08x}.sock"
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and private_dir(runtime_dir):
+        return os.path.join(runtime_dir, name)
+    worker_dir = os.path.join(os.path.abspath(plugin_dir), ".worker")
+    # a Unix socket path is limited to ~100 characters
+    if len(os.path.join(worker_dir, name)) < 100 and private_dir(worker_dir, True):
+        return os.path.join(worker_dir, name)
+    return None
+
+
+def peer_uid(sock: socket.socket):
+    """User of the process at the other end of the socket (None if unknown)."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        # macOS, only the folder protects the socket
+        return None
+    # struct ucred: pid, uid, gid
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    return struct.unpack("3i", creds)[1]
+
+
+def send_to_worker(request: dict, plugin_dir: str):
+    """Send a request to the running worker, return its reply (None if no worker)."""
+    path = worker_socket_path(plugin_dir)
+    if path is None:
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(path)
+            # the fragment has the session cookie of Stash
+            if peer_uid(sock) not in (None, os.getuid()):
+                return None
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("r", encoding="utf-8") as f:
+                return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def forward_to_worker(fragment: dict) -> bool:
+    """
+    Hand the hook over to the worker, starting it if needed.
+    Return False if the hook must be done by this process.
+    """
+    plugin_dir = fragment["server_connection"]["PluginDir"]
+    hook_type = fragment["args"]["hookContext"]["type"]
+    reply = send_to_worker({"fragment": fragment}, plugin_dir)
+    if reply is not None:
+        return reply.get("accepted", False)
+    if not hook_type.startswith("Scene.") or worker_socket_path(plugin_dir) is None:
+        return False
+    # no worker, start one with this hook
+    with open(
+        os.path.join(plugin_dir, "renamerOnUpdate_worker.log"), "a", encoding="utf-8"
+    ) as worker_log:
+        worker = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=worker_log,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            start_new_session=True,
+        )
+    worker.stdin.write(json.dumps(fragment).encode())
+    worker.stdin.close()
+    return True
+
+
+if (
+    not WORKER
+    and config.resident_worker
+    and config.enable_hook
+    and hasattr(socket, "AF_UNIX")
+    and not FRAGMENT["args"].get("mode")
+    and forward_to_worker(FRAGMENT)
+):
+    print(json.dumps({"output": "sent to the renamer worker", "error": None}))
+    sys.exit()
+
 import requests
 
 try:
@@ -25,17 +167,13 @@ try:
 except Exception:
     MODULE_UNIDECODE = False
 
-import log
-
-try:
-    import config
-except Exception:
-    log.LogWarning("Could not import ROU config file, did you rename the template file to 'config.py'? Defaulting to template config file")
-    import renamerOnUpdate_config as config
+from titlecaser import TitleCaser
 
 
 DB_VERSION_FILE_REFACTOR = 32
 DB_VERSION_SCENE_STUDIO_CODE = 38
+# ratings stored on 100 instead of 5
+DB_VERSION_RATING100 = 40
 
 DRY_RUN = config.dry_run
 DRY_RUN_FILE = None
@@ -51,85 +189,307 @@ if DRY_RUN:
             os.remove(DRY_RUN_FILE)
     log.LogInfo("Dry mode on")
 
-START_TIME = time.time()
-FRAGMENT = json.loads(sys.stdin.read())
-
 FRAGMENT_SERVER = FRAGMENT["server_connection"]
 PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
 
 
 PLUGIN_ARGS = FRAGMENT["args"].get("mode")
 
+
+class Profiler:
+    """
+    Time spent in the phases of a run (GraphQL requests, rendering, moves,
+    database...), logged as a table when the plugin ends. A phase includes
+    the phases called inside it.
+
+    With profile_trace, every phase is also written as a Chrome trace event,
+    with profile_memory the peak memory is measured by tracemalloc.
+    """
+
+    def __init__(self, enabled=False, trace=False, memory=False):
+        self.enabled = enabled or trace or memory
+        self.trace = trace
+        self.memory = memory
+        # name -> [calls, seconds, longest]
+        self.stats = {}
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        if memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def add(self, name: str, start: float, end: float):
+        seconds = end - start
+        with self.lock:
+            stat = self.stats.setdefault(name, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            if self.trace:
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": round((start - self.start) * 1e6),
+                        "dur": round(seconds * 1e6),
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                    }
+                )
+
+    def timed(self, name: str, detail=None):
+        """Decorator, detail(*args) is added to the name of the phase."""
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                phase = name if detail is None else f"{name} {detail(*args, **kwargs)}"
+                with self.phase(phase):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def report(self, trace_file: str):
+        if not self.enabled:
+            return
+        log.LogInfo(
+            f"[Profile] {'phase':<40} {'calls':>7} {'total (s)':>10} {'mean (ms)':>10} {'max (ms)':>10}"
+        )
+        for name, (calls, seconds, longest) in sorted(
+            self.stats.items(), key=lambda x: x[1][1], reverse=True
+        ):
+            log.LogInfo(
+                f"[Profile] {name:<40} {calls:>7} {seconds:>10.3f} {seconds / calls * 1000:>10.2f} {longest * 1000:>10.2f}"
+            )
+        log.LogInfo(f"[Profile] run: {time.perf_counter() - self.start:.3f}s")
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            log.LogInfo(f"[Profile] peak memory: {peak / 1024**2:.1f} MiB")
+        if self.trace:
+            try:
+                with open(trace_file, "w", encoding="utf-8") as f:
+                    json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+                log.LogInfo(f"[Profile] trace written in {trace_file}")
+            except OSError as err:
+                log.LogWarning(f"Could not write the trace ({err})")
+
+
+PROFILER = Profiler(config.profile, config.profile_trace, config.profile_memory)
+
+RE_GRAPHQL_OPERATION = re.compile(
+    r"\s*(?:query|mutation)?\s*(\w*)[^{]*\{\s*(?:\w+\s*:\s*)?(\w+)"
+)
+
+
+def graphql_operation(client, query: str, variables=None) -> str:
+    # the name of the operation, or its first field for batches and anonymous
+    # queries
+    match = RE_GRAPHQL_OPERATION.match(query)
+    if not match:
+        return "?"
+    name, field = match.groups()
+    if name == "Batch":
+        return f"Batch {field}"
+    return name or field
+
+
+# maximum number of root fields sent in a single batched document
+GRAPHQL_BATCH_LIMIT = 50
+
 # log.LogDebug("{}".format(FRAGMENT))
 
 
-def callGraphQL(query, variables=None):
-    # Session cookie for authentication
-    graphql_port = str(FRAGMENT_SERVER["Port"])
-    graphql_scheme = FRAGMENT_SERVER["Scheme"]
-    graphql_cookies = {"session": FRAGMENT_SERVER["SessionCookie"]["Value"]}
-    graphql_headers = {
-        "Accept-Encoding": "gzip, deflate, br",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Connection": "keep-alive",
-        "DNT": "1",
-    }
-    graphql_domain = FRAGMENT_SERVER["Host"]
-    if graphql_domain == "0.0.0.0":
-        graphql_domain = "localhost"
-    # Stash GraphQL endpoint
-    graphql_url = f"{graphql_scheme}://{graphql_domain}:{graphql_port}/graphql"
-
-    json = {"query": query}
-    if variables is not None:
-        json["variables"] = variables
-    try:
-        response = requests.post(
-            graphql_url,
-            json=json,
-            headers=graphql_headers,
-            cookies=graphql_cookies,
-            timeout=20,
+class GraphQLClient:
+    """
+    Persistent connection to the Stash GraphQL endpoint.
+
+    The session keeps the TCP connection alive between queries, so bulk runs
+    don't pay a new handshake for every round-trip.
+    """
+
+    def __init__(self, server_connection: dict):
+        graphql_domain = server_connection["Host"]
+        if graphql_domain == "0.0.0.0":
+            graphql_domain = "localhost"
+        # Stash GraphQL endpoint
+        self.url = f"{server_connection['Scheme']}://{graphql_domain}:{server_connection['Port']}/graphql"
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate, br",
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                "Connection": "keep-alive",
+                "DNT": "1",
+            }
         )
-    except Exception as e:
-        exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
-    if response.status_code == 200:
-        result = response.json()
-        if result.get("error"):
-            for error in result["error"]["errors"]:
-                raise Exception(f"GraphQL error: {error}")
-            return None
-        if result.get("data"):
-            return result.get("data")
-    elif response.status_code == 401:
-        exit_plugin(err="HTTP Error 401, Unauthorised.")
-    else:
-        raise ConnectionError(
-            f"GraphQL query failed: {response.status_code} - {response.content}"
+        # Session cookie for authentication
+        self.session.cookies.set(
+            "session", server_connection["SessionCookie"]["Value"]
         )
 
+    @PROFILER.timed("graphql", graphql_operation)
+    def call(self, query: str, variables=None):
+        json = {"query": query}
+        if variables is not None:
+            json["variables"] = variables
+        try:
+            response = self.session.post(self.url, json=json, timeout=20)
+        except Exception as e:
+            exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("error"):
+                for error in result["error"]["errors"]:
+                    raise Exception(f"GraphQL error: {error}")
+                return None
+            if result.get("data"):
+                return result.get("data")
+        elif response.status_code == 401:
+            exit_plugin(err="HTTP Error 401, Unauthorised.")
+        else:
+            raise ConnectionError(
+                f"GraphQL query failed: {response.status_code} - {response.content}"
+            )
 
-def graphql_getScene(scene_id):
-    query = (
-        """
-    query FindScene($id: ID!, $checksum: String) {
-        findScene(id: $id, checksum: $checksum) {
-            ...SceneData
-        }
-    }
-    fragment SceneData on Scene {
+    def batch(self, operation="query"):
+        return GraphQLBatch(self, operation)
+
+
+class GraphQLBatch:
+    """
+    Queue several root fields and send them as one aliased GraphQL document.
+
+    add() returns the alias of the queued field, execute() returns a dict
+    alias -> result. Arguments are given as {"name": ("Type!", value)}, each
+    one becomes a variable prefixed by the alias so fields can't clash.
+    """
+
+    def __init__(self, client: GraphQLClient, operation="query"):
+        self.client = client
+        self.operation = operation
+        self.fields = []
+
+    def __len__(self):
+        return len(self.fields)
+
+    def add(self, field: str, selection="", arguments=None) -> str:
+        alias = f"q{len(self.fields)}"
+        self.fields.append((alias, field, selection, arguments or {}))
+        return alias
+
+    def execute(self) -> dict:
+        results = {}
+        for i in range(0, len(self.fields), GRAPHQL_BATCH_LIMIT):
+            chunk = self.fields[i : i + GRAPHQL_BATCH_LIMIT]
+            definitions = []
+            body = []
+            variables = {}
+            for alias, field, selection, arguments in chunk:
+                args = []
+                for name, (gql_type, value) in arguments.items():
+                    definitions.append(f"${alias}_{name}: {gql_type}")
+                    args.append(f"{name}: ${alias}_{name}")
+                    variables[f"{alias}_{name}"] = value
+                args = f"({', '.join(args)})" if args else ""
+                selection = f" {{ {selection} }}" if selection else ""
+                body.append(f"{alias}: {field}{args}{selection}")
+            definitions = f"({', '.join(definitions)})" if definitions else ""
+            query = f"{self.operation} Batch{definitions} {{ {' '.join(body)} }}"
+            result = self.client.call(query, variables)
+            if result:
+                results.update(result)
+        self.fields = []
+        return results
+
+
+def callGraphQL(query, variables=None):
+    return STASH_GRAPHQL.call(query, variables)
+
+
+STASH_GRAPHQL = GraphQLClient(FRAGMENT_SERVER)
+
+
+def scene_needs() -> set:
+    """
+    What the renamer reads in a scene with this config: the fields ($studio,
+    $performer...) of every template, and the options looking at the scene.
+    """
+    templates = [config.default_template, config.p_default_template, config.p_non_organized]
+    for option in (
+        config.tag_templates,
+        config.studio_templates,
+        config.p_tag_templates,
+        config.p_studio_templates,
+        config.p_path_templates,
+    ):
+        templates.extend(option.values())
+    fields = set()
+    for template in templates:
+        if isinstance(template, str):
+            fields.update(token[1:].strip("_") for token in RE_FIELD.findall(template))
+    needs = set()
+    for field in fields:
+        if field.startswith("performer") or field == "stashid_performer":
+            needs.add("performers")
+        if field == "stashid_performer":
+            needs.add("performer_stash_ids")
+        if field.startswith(("studio", "parent_studio")):
+            needs.add("studio")
+        if field.startswith("tag"):
+            needs.add("tags")
+        if field.startswith("movie"):
+            needs.add("movies")
+        if field == "stashid_scene":
+            needs.add("stash_ids")
+        if field == "oshash":
+            needs.add("oshash")
+    if config.studio_templates or config.p_studio_templates:
+        needs.add("studio")
+    if config.tag_templates or config.p_tag_templates or config.p_tag_option:
+        needs.add("tags")
+    if config.performer_ignoreGender:
+        needs.add("performer_gender")
+    if config.performer_sort in ("favorite", "mix", "mixid"):
+        needs.add("performer_favorite")
+    if config.performer_sort in ("rating", "mix", "mixid"):
+        needs.add("performer_rating")
+    # written in the journal/log file, to check the file before moving it back
+    if config.rename_journal or config.log_file:
+        needs.add("oshash")
+    return needs
+
+
+def scene_fields() -> str:
+    """Fields of a scene used by the renamer (SCENE_NEEDS)."""
+    fields = """
         id
         title
         date
         rating100
+        organized
+        updated_at"""
+    if "stash_ids" in SCENE_NEEDS:
+        fields += """
         stash_ids {
             endpoint
             stash_id
-        }
-        organized"""
-        + FILE_QUERY
-        + """
+        }"""
+    fields += FILE_QUERY
+    if "studio" in SCENE_NEEDS:
+        fields += """
         studio {
             id
             name
@@ -137,128 +497,192 @@ def graphql_getScene(scene_id):
                 id
                 name
             }
-        }
+        }"""
+    if "tags" in SCENE_NEEDS:
+        fields += """
         tags {
             id
             name
-        }
+        }"""
+    if "performers" in SCENE_NEEDS:
+        fields += """
         performers {
             id
-            name
-            gender
-            favorite
-            rating100
-            stash_ids{
+            name"""
+        if "performer_gender" in SCENE_NEEDS:
+            fields += """
+            gender"""
+        if "performer_favorite" in SCENE_NEEDS:
+            fields += """
+            favorite"""
+        if "performer_rating" in SCENE_NEEDS:
+            fields += """
+            rating100"""
+        if "performer_stash_ids" in SCENE_NEEDS:
+            fields += """
+            stash_ids {
                 endpoint
                 stash_id
-            }
-        }
+            }"""
+        fields += """
+        }"""
+    if "movies" in SCENE_NEEDS:
+        fields += """
         movies {
             movie {
                 name
                 date
             }
             scene_index
-        }
-    }
+        }"""
+    return fields + "\n    "
+
+
+def graphql_getScene(scene_id):
+    query = f"""
+    query FindScene($id: ID!, $checksum: String) {{
+        findScene(id: $id, checksum: $checksum) {{
+            ...SceneData
+        }}
+    }}
+    fragment SceneData on Scene {{{scene_fields()}}}
     """
-    )
     variables = {"id": scene_id}
-    result = callGraphQL(query, variables)
+    try:
+        result = callGraphQL(query, variables)
+    except Exception:
+        if revalidate_stash_info():
+            return graphql_getScene(scene_id)
+        raise
+    if result is None and revalidate_stash_info():
+        return graphql_getScene(scene_id)
     return result.get("findScene")
 
 
+def graphql_getScenes(scene_ids: list) -> dict:
+    """Several scenes with one request, scene id -> scene (None if not found)."""
+    batch = STASH_GRAPHQL.batch()
+    aliases = {}
+    for scene_id in scene_ids:
+        alias = batch.add("findScene", scene_fields(), {"id": ("ID", scene_id)})
+        aliases[alias] = scene_id
+    result = batch.execute()
+    if not result and scene_ids and revalidate_stash_info():
+        return graphql_getScenes(scene_ids)
+    return {scene_id: result.get(alias) for alias, scene_id in aliases.items()}
+
+
 # used for bulk
-def graphql_findScene(perPage, direc="DESC") -> dict:
-    query = (
-        """
-    query FindScenes($filter: FindFilterType) {
-        findScenes(filter: $filter) {
+def graphql_findScene(
+    perPage, direc="DESC", page=1, client=None, updated_after=None
+) -> dict:
+    query = f"""
+    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {{
+        findScenes(filter: $filter, scene_filter: $scene_filter) {{
             count
-            scenes {
+            scenes {{
                 ...SlimSceneData
-            }
-        }
-    }
-    fragment SlimSceneData on Scene {
-        id
-        title
-        date
-        rating100
-        organized
-        stash_ids {
-            endpoint
-            stash_id
-        }
-    """
-        + FILE_QUERY
-        + """
-        studio {
-            id
-            name
-            parent_studio {
-                id
-                name
-            }
-        }
-        tags {
-            id
-            name
-        }
-        performers {
-            id
-            name
-            gender
-            favorite
-            rating100
-            stash_ids{
-                endpoint
-                stash_id
-            }
-        }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
-    }
+            }}
+        }}
+    }}
+    fragment SlimSceneData on Scene {{{scene_fields()}}}
     """
-    )
     # ASC DESC
     variables = {
         "filter": {
             "direction": direc,
-            "page": 1,
+            "page": page,
             "per_page": perPage,
             "sort": "updated_at",
         }
     }
-    result = callGraphQL(query, variables)
+    if updated_after:
+        variables["scene_filter"] = {
+            "updated_at": {"value": updated_after, "modifier": "GREATER_THAN"}
+        }
+    try:
+        result = (client or STASH_GRAPHQL).call(query, variables)
+    except Exception:
+        if revalidate_stash_info():
+            return graphql_findScene(perPage, direc, page, client, updated_after)
+        raise
+    if result is None and revalidate_stash_info():
+        return graphql_findScene(perPage, direc, page, client, updated_after)
     return result.get("findScenes")
 
 
+def iter_scene_pages(page_size: int, limit=-1, direc="ASC", updated_after=None):
+    """
+    Yield (total, scenes) page by page for bulk mode, only the scenes updated
+    after updated_after if given.
+
+    The next page is fetched by a background thread (with its own connection)
+    while the current one is processed. total comes from the 'count' field.
+    """
+    if page_size <= 0 or 0 < limit < page_size:
+        page_size = limit
+    client = GraphQLClient(FRAGMENT_SERVER)
+    seen = set()
+    yielded = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 1
+        future = executor.submit(
+            graphql_findScene, page_size, direc, page, client, updated_after
+        )
+        total = None
+        while future:
+            result = future.result()
+            if total is None:
+                total = result["count"] if limit < 0 else min(result["count"], limit)
+                log.LogDebug(f"Count scenes: {total}")
+            future = None
+            if page_size > 0 and len(result["scenes"]) == page_size and page * page_size < total:
+                page += 1
+                future = executor.submit(
+                    graphql_findScene, page_size, direc, page, client, updated_after
+                )
+            scenes = []
+            for scene in result["scenes"]:
+                if yielded >= total:
+                    break
+                # a scene updated during the run can shift into the next page
+                if scene["id"] in seen:
+                    continue
+                seen.add(scene["id"])
+                yielded += 1
+                scenes.append(scene)
+            yield total, scenes
+
+
 # used to find duplicate
 def graphql_findScenebyPath(path, modifier) -> dict:
-    query = """
-    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
-        findScenes(filter: $filter, scene_filter: $scene_filter) {
-            count
-            scenes {
-                id
-                title
-            }
-        }
-    }
-    """
-    # ASC DESC
-    variables = {
-        "filter": {"direction": "ASC", "page": 1, "per_page": 40, "sort": "updated_at"},
-        "scene_filter": {"path": {"modifier": modifier, "value": path}},
-    }
-    result = callGraphQL(query, variables)
-    return result.get("findScenes")
+    return graphql_findScenesbyPaths([path], modifier)[0]
+
+
+# several path lookups in a single round-trip
+def graphql_findScenesbyPaths(paths: list, modifier) -> list:
+    batch = STASH_GRAPHQL.batch()
+    aliases = []
+    for path in paths:
+        # ASC DESC
+        aliases.append(
+            batch.add(
+                "findScenes",
+                "count scenes { id title }",
+                {
+                    "filter": (
+                        "FindFilterType",
+                        {"direction": "ASC", "page": 1, "per_page": 40, "sort": "updated_at"},
+                    ),
+                    "scene_filter": (
+                        "SceneFilterType",
+                        {"path": {"modifier": modifier, "value": path}},
+                    ),
+                },
+            )
+        )
+    result = batch.execute()
+    return [result.get(alias) for alias in aliases]
 
 
 def graphql_getConfiguration():
@@ -293,6 +717,114 @@ def graphql_getStudio(studio_id):
     return result.get("findStudio")
 
 
+def graphql_getAllStudios():
+    query = """
+        query FindStudios($filter: FindFilterType) {
+            findStudios(filter: $filter) {
+                studios {
+                    id
+                    name
+                    parent_studio {
+                        id
+                    }
+                }
+            }
+        }
+    """
+    variables = {"filter": {"per_page": -1}}
+    result = callGraphQL(query, variables)
+    return result["findStudios"]["studios"]
+
+
+class StudioCache:
+    """
+    Whole studio tree kept in memory (id -> name, parent id).
+
+    It's loaded with one query and saved next to the plugin so hooks can reuse
+    it, the file is removed when a studio is updated.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self.studios = None
+        self.template_memo = {}
+
+    def load(self, refresh=False):
+        if not refresh and self.cache_file and os.path.isfile(self.cache_file):
+            try:
+                with open(self.cache_file, "r", encoding="utf-8") as f:
+                    self.studios = json.load(f)
+                self.template_memo = {}
+                return
+            except Exception as err:
+                log.LogWarning(f"Could not read the studio cache ({err})")
+        self.studios = {
+            str(s["id"]): [s["name"], (s.get("parent_studio") or {}).get("id")]
+            for s in graphql_getAllStudios()
+        }
+        self.template_memo = {}
+        log.LogDebug(f"[STUDIO] {len(self.studios)} studios loaded")
+        if self.cache_file:
+            # own temporary file, other hooks can write the cache at the same
+            # time, readers only see a complete file
+            tmp = f"{self.cache_file}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(self.studios, f)
+                os.replace(tmp, self.cache_file)
+            except Exception as err:
+                log.LogWarning(f"Could not write the studio cache ({err})")
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def invalidate(self):
+        self.studios = None
+        self.template_memo = {}
+        if self.cache_file:
+            try:
+                os.remove(self.cache_file)
+            except FileNotFoundError:
+                # removed by another hook
+                pass
+
+    def ancestors(self, studio: dict) -> list:
+        """Names of the studio then its parents, up to the top one."""
+        if self.studios is None:
+            self.load()
+        studio_id = str(studio["id"])
+        if studio_id not in self.studios:
+            # studio created after the cache was made
+            self.load(refresh=True)
+        if studio_id not in self.studios:
+            names = [studio["name"]]
+            if studio.get("parent_studio"):
+                names.append(studio["parent_studio"]["name"])
+            return names
+        names = []
+        seen = set()
+        while studio_id and studio_id not in seen and studio_id in self.studios:
+            seen.add(studio_id)
+            name, studio_id = self.studios[studio_id]
+            names.append(name)
+        return names
+
+    def template(self, studio: dict, templates: dict):
+        """Template of the studio or of its first parent found in templates."""
+        key = (str(studio["id"]), id(templates))
+        if key not in self.template_memo:
+            self.template_memo[key] = None
+            for name in self.ancestors(studio):
+                if templates.get(name):
+                    self.template_memo[key] = templates[name]
+                    break
+        return self.template_memo[key]
+
+
+STUDIO_CACHE = StudioCache(os.path.join(PLUGIN_DIR, "renamerOnUpdate_studios.json"))
+
+
 def graphql_removeScenesTag(id_scenes: list, id_tags: list):
     query = """
     mutation BulkSceneUpdate($input: BulkSceneUpdateInput!) {
@@ -308,6 +840,34 @@ def graphql_removeScenesTag(id_scenes: list, id_tags: list):
     return result
 
 
+# bulk: tag removals are grouped by tag set and sent as one mutation document
+PENDING_TAG_REMOVAL = {}
+
+
+# sent at the end of the run: updating scenes would move them between pages
+def queue_removeScenesTag(id_scene, id_tags: list):
+    PENDING_TAG_REMOVAL.setdefault(tuple(sorted(id_tags)), []).append(id_scene)
+
+
+def flush_removeScenesTag():
+    if not PENDING_TAG_REMOVAL:
+        return
+    batch = STASH_GRAPHQL.batch("mutation")
+    for id_tags, id_scenes in PENDING_TAG_REMOVAL.items():
+        batch.add(
+            "bulkSceneUpdate",
+            "id",
+            {
+                "input": (
+                    "BulkSceneUpdateInput!",
+                    {"ids": id_scenes, "tag_ids": {"ids": list(id_tags), "mode": "REMOVE"}},
+                )
+            },
+        )
+    PENDING_TAG_REMOVAL.clear()
+    batch.execute()
+
+
 def graphql_getBuild():
     query = """
         {
@@ -320,32 +880,266 @@ def graphql_getBuild():
     return result["systemStatus"]["databaseSchema"]
 
 
-def find_diff_text(a: str, b: str):
-    addi = minus = stay = ""
-    minus_ = addi_ = 0
-    for _, s in enumerate(difflib.ndiff(a, b)):
-        if s[0] == " ":
-            stay += s[-1]
-            minus += "*"
-            addi += "*"
-        elif s[0] == "-":
-            minus += s[-1]
-            minus_ += 1
-        elif s[0] == "+":
-            addi += s[-1]
-            addi_ += 1
-    if minus_ > 20 or addi_ > 20:
-        log.LogDebug(f"Diff Checker: +{addi_}; -{minus_};")
-        log.LogDebug(f"OLD: {a}")
-        log.LogDebug(f"NEW: {b}")
-    else:
-        log.LogDebug(
-            f"Original: {a}\n- Charac: {minus}\n+ Charac: {addi}\n  Result: {b}"
-        )
-    return
+def graphql_getStashInfo() -> dict:
+    """Database path, library folders, DB version and build hash in one request."""
+    batch = STASH_GRAPHQL.batch()
+    configuration = batch.add(
+        "configuration", "general { databasePath stashes { path } }"
+    )
+    status = batch.add("systemStatus", "databaseSchema")
+    version = batch.add("version", "hash")
+    result = batch.execute()
+    return {
+        "database_path": result[configuration]["general"]["databasePath"],
+        "library_roots": [
+            stash["path"] for stash in result[configuration]["general"]["stashes"]
+        ],
+        "db_version": result[status]["databaseSchema"],
+        "build_hash": result[version]["hash"],
+    }
 
 
-def has_handle(fpath, all_result=False):
+class StashInfoCache:
+    """
+    What the plugin needs to know about the Stash server (database path,
+    DB version), saved next to the plugin for each server (host:port).
+
+    It's asked again to Stash only when a query fails (refresh()), so the
+    hooks don't wait for these requests each time.
+    """
+
+    def __init__(self, cache_file: str, server_connection: dict):
+        self.cache_file = cache_file
+        self.key = f"{server_connection['Host']}:{server_connection['Port']}"
+        self.info = None
+        self.refreshed = False
+
+    def load(self):
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                self.info = json.load(f).get(self.key)
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            log.LogWarning(f"Could not read the Stash cache ({err})")
+        # the database was moved or Stash was updated
+        if (
+            not self.info
+            or "library_roots" not in self.info
+            or not os.path.isfile(self.info["database_path"])
+            or self.read_db_version() not in (None, self.info["db_version"])
+        ):
+            self.refresh()
+
+    def read_db_version(self):
+        """Schema version written in the database by Stash (None if unknown)."""
+        try:
+            path = pathlib.Path(self.info["database_path"]).absolute()
+            db = sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True, timeout=1)
+            try:
+                row = db.execute("SELECT version FROM schema_migrations").fetchone()
+            finally:
+                db.close()
+            return row[0] if row else None
+        except sqlite3.Error:
+            return None
+
+    def refresh(self) -> bool:
+        """Ask Stash again (once per run), True if something changed."""
+        if self.refreshed:
+            return False
+        self.refreshed = True
+        info = graphql_getStashInfo()
+        changed = info != self.info
+        self.info = info
+        if changed:
+            log.LogDebug(f"[STASH] {info}")
+            try:
+                data = {}
+                if os.path.isfile(self.cache_file):
+                    with open(self.cache_file, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                data[self.key] = info
+                tmp = f"{self.cache_file}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp, self.cache_file)
+            except Exception as err:
+                log.LogWarning(f"Could not write the Stash cache ({err})")
+        return changed
+
+    @property
+    def database_path(self) -> str:
+        return self.info["database_path"]
+
+    @property
+    def db_version(self) -> int:
+        return self.info["db_version"]
+
+    @property
+    def library_roots(self) -> list:
+        return self.info["library_roots"]
+
+
+def revalidate_stash_info() -> bool:
+    """A query failed, check if Stash changed (True if it did)."""
+    global STASH_DATABASE, DB_VERSION, FILE_QUERY
+    if not STASH_INFO.refresh():
+        return False
+    STASH_DATABASE = STASH_INFO.database_path
+    DB_VERSION = STASH_INFO.db_version
+    FILE_QUERY = build_file_query(DB_VERSION)
+    return True
+
+
+def build_file_query(db_version: int) -> str:
+    if db_version >= DB_VERSION_FILE_REFACTOR:
+        # what extract_info() reads in the file
+        file_query = """
+            files {
+                path
+                video_codec
+                audio_codec
+                width
+                height
+                duration
+                bit_rate"""
+        if "oshash" in SCENE_NEEDS:
+            file_query += """
+                oshash: fingerprint(type: "oshash")"""
+        file_query += """
+            }
+    """
+    else:
+        file_query = """
+            path
+            file {
+                video_codec
+                audio_codec
+                width
+                height
+                framerate
+                bitrate
+                duration
+            }
+    """
+    if db_version >= DB_VERSION_SCENE_STUDIO_CODE:
+        file_query = f"        code{file_query}"
+    return file_query
+
+
+def find_diff_text(a: str, b: str):
+    addi = minus = stay = ""
+    minus_ = addi_ = 0
+    for _, s in enumerate(difflib.ndiff(a, b)):
+        if s[0] == " ":
+            stay += s[-1]
+            minus += "*"
+            addi += "*"
+        elif s[0] == "-":
+            minus += s[-1]
+            minus_ += 1
+        elif s[0] == "+":
+            addi += s[-1]
+            addi_ += 1
+    if minus_ > 20 or addi_ > 20:
+        log.LogDebug(f"Diff Checker: +{addi_}; -{minus_};")
+        log.LogDebug(f"OLD: {a}")
+        log.LogDebug(f"NEW: {b}")
+    else:
+        log.LogDebug(
+            f"Original: {a}\n- Charac: {minus}\n+ Charac: {addi}\n  Result: {b}"
+        )
+    return
+
+
+# open files of the processes can be read in /proc/<pid>/fd
+PROC_FD = sys.platform.startswith("linux") and os.path.isdir("/proc/self/fd")
+# bulk: directory -> {(st_dev, st_ino): [pid]} for its files opened by a process
+HANDLE_CACHE = None
+
+
+def open_targets(pid: int, targets: set, stop_early=False) -> set:
+    # the targets (st_dev, st_ino) opened by the process
+    keys = set()
+    try:
+        with os.scandir(f"/proc/{pid}/fd") as it:
+            for entry in it:
+                try:
+                    st = os.stat(entry.path)
+                except OSError:
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key in targets:
+                    keys.add(key)
+                    if stop_early:
+                        break
+    except OSError:
+        # process ended or not allowed
+        pass
+    return keys
+
+
+def scan_proc_fd(targets: set, stop_early=False) -> dict:
+    """
+    Find the processes having one of the targets (st_dev, st_ino) open.
+    Return {(st_dev, st_ino): [pid]}.
+    """
+    found = {}
+    stop = threading.Event()
+    own_pid = os.getpid()
+
+    def scan(pid: int):
+        if stop.is_set():
+            return
+        keys = open_targets(pid, targets, stop_early)
+        for key in keys:
+            found.setdefault(key, []).append(pid)
+        if keys and stop_early:
+            stop.set()
+
+    pids = [int(x) for x in os.listdir("/proc") if x.isdigit()]
+    pids = [pid for pid in pids if pid != own_pid]
+    workers = min(16, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(scan, pids))
+    return found
+
+
+def proc_has_handle(fpath, all_result=False) -> list:
+    st = os.stat(fpath)
+    key = (st.st_dev, st.st_ino)
+    if HANDLE_CACHE is None:
+        return scan_proc_fd({key}, stop_early=not all_result).get(key, [])
+    directory = os.path.dirname(fpath)
+    cached = HANDLE_CACHE.get(directory)
+    if cached and cached.get(key):
+        # the process can have closed the file (or ended and its pid reused)
+        # since the scan
+        cached[key] = [pid for pid in cached[key] if open_targets(pid, {key})]
+        if cached[key]:
+            return cached[key]
+    # scan for all the files of the directory, the next ones are often used
+    # by the same process
+    targets = {key}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    entry_st = entry.stat()
+                    targets.add((entry_st.st_dev, entry_st.st_ino))
+    except OSError:
+        pass
+    HANDLE_CACHE[directory] = scan_proc_fd(targets)
+    return HANDLE_CACHE[directory].get(key, [])
+
+
+def has_handle(fpath, all_result=False):
+    if PROC_FD:
+        pids = proc_has_handle(fpath, all_result)
+        if all_result:
+            return pids
+        return pids[0] if pids else []
     lst = []
     for proc in psutil.process_iter():
         try:
@@ -360,6 +1154,32 @@ def has_handle(fpath, all_result=False):
     return lst
 
 
+def is_file_in_use(err: OSError) -> bool:
+    if "[WinError 32]" in str(err):
+        return MODULE_PSUTIL
+    return PROC_FD and err.errno in (errno.EBUSY, errno.ETXTBSY)
+
+
+def terminate_process(process):
+    # psutil.Process or pid
+    pid = getattr(process, "pid", process)
+    if MODULE_PSUTIL:
+        p = psutil.Process(pid)
+        p.terminate()
+        p.wait(10)
+    else:
+        os.kill(pid, signal.SIGTERM)
+        for _ in range(100):
+            if not os.path.exists(f"/proc/{pid}"):
+                break
+            time.sleep(0.1)
+    if HANDLE_CACHE:
+        for handles in HANDLE_CACHE.values():
+            for pids in handles.values():
+                if pid in pids:
+                    pids.remove(pid)
+
+
 def config_edit(name: str, state: bool):
     found = 0
     try:
@@ -388,46 +1208,75 @@ def check_longpath(path: str):
         return 1
 
 
+class TemplateRules:
+    """
+    Rules of the config (tag or path -> template) indexed once. Like a loop
+    over the dict, the first rule of the dict that matches wins: each rule
+    has its position as priority.
+
+    Tags are found with a dict, the paths with one regex matching every rule
+    at each position of the path.
+    """
+
+    def __init__(self, rules: dict):
+        self.rules = list(rules.items())
+        self.priority = {match: i for i, (match, _) in enumerate(self.rules)}
+        self.pattern = None
+        if self.rules:
+            # every rule is tried at each position of the path
+            self.pattern = re.compile(
+                "(?=({}))".format("|".join(re.escape(match) for match, _ in self.rules))
+            )
+
+    def _rule(self, best):
+        return None if best is None else self.rules[best]
+
+    def first_tag(self, tags: list):
+        """(tag, template) of the first rule in the tags, None if no rule."""
+        best = None
+        for tag in tags:
+            i = self.priority.get(tag["name"])
+            if i is not None and (best is None or i < best):
+                best = i
+                if best == 0:
+                    break
+        return self._rule(best)
+
+    def first_substring(self, text: str):
+        """(match, template) of the first rule found in text, None if no rule."""
+        if self.pattern is None:
+            return None
+        best = None
+        for found in self.pattern.finditer(text):
+            # at one position, the alternation gives the first rule of the dict
+            i = self.priority[found.group(1)]
+            if best is None or i < best:
+                best = i
+                if best == 0:
+                    break
+        return self._rule(best)
+
+
 def get_template_filename(scene: dict):
     template = None
-    # Change by Studio
+    # Change by Studio (or by first Parent found)
     if scene.get("studio") and config.studio_templates:
-        template_found = False
-        current_studio = scene.get("studio")
-        if config.studio_templates.get(current_studio["name"]):
-            template = config.studio_templates[current_studio["name"]]
-            template_found = True
-        # by first Parent found
-        while current_studio.get("parent_studio") and not template_found:
-            if config.studio_templates.get(
-                current_studio.get("parent_studio").get("name")
-            ):
-                template = config.studio_templates[
-                    current_studio["parent_studio"]["name"]
-                ]
-                template_found = True
-            current_studio = graphql_getStudio(
-                current_studio.get("parent_studio")["id"]
-            )
+        template = STUDIO_CACHE.template(scene["studio"], config.studio_templates)
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
-    if scene.get("tags") and config.tag_templates:
-        for match, job in config.tag_templates.items():
-            if match in tags:
-                template = job
-                break
+    if scene.get("tags"):
+        rule = TAG_TEMPLATES.first_tag(scene["tags"])
+        if rule is not None:
+            template = rule[1]
     return template
 
 
 def get_template_path(scene: dict):
     template = {"destination": "", "option": [], "opt_details": {}}
     # Change by Path
-    if config.p_path_templates:
-        for match, job in config.p_path_templates.items():
-            if match in scene["path"]:
-                template["destination"] = job
-                break
+    rule = P_PATH_TEMPLATES.first_substring(scene["path"])
+    if rule is not None:
+        template["destination"] = rule[1]
 
     # Change by Studio
     if scene.get("studio") and config.p_studio_templates:
@@ -441,12 +1290,10 @@ def get_template_path(scene: dict):
                 ]
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
-    if scene.get("tags") and config.p_tag_templates:
-        for match, job in config.p_tag_templates.items():
-            if match in tags:
-                template["destination"] = job
-                break
+    if scene.get("tags"):
+        rule = P_TAG_TEMPLATES.first_tag(scene["tags"])
+        if rule is not None:
+            template["destination"] = rule[1]
 
     if scene.get("tags") and config.p_tag_option:
         for tag in scene["tags"]:
@@ -480,6 +1327,7 @@ def sort_rating(d: dict):
     return new_d
 
 
+@PROFILER.timed("extract_info")
 def extract_info(scene: dict, template: None):
     # Grabbing things from Stash
     scene_information = {}
@@ -663,14 +1511,11 @@ def extract_info(scene: dict, template: None):
                 ]
             scene_information["studio_family"] = scene_information["parent_studio"]
 
-            studio_p = scene["studio"]
-            while studio_p.get("parent_studio"):
-                studio_p = graphql_getStudio(studio_p["parent_studio"]["id"])
-                if studio_p:
-                    if SQUEEZE_STUDIO_NAMES:
-                        studio_hierarchy.append(studio_p["name"].replace(" ", ""))
-                    else:
-                        studio_hierarchy.append(studio_p["name"])
+            for name in STUDIO_CACHE.ancestors(scene["studio"])[1:]:
+                if SQUEEZE_STUDIO_NAMES:
+                    studio_hierarchy.append(name.replace(" ", ""))
+                else:
+                    studio_hierarchy.append(name)
             studio_hierarchy.reverse()
         scene_information["studio_hierarchy"] = studio_hierarchy
     # Grab Tags
@@ -745,49 +1590,197 @@ def extract_info(scene: dict, template: None):
     return scene_information
 
 
-def replace_text(text: str):
-    for old, new in FILENAME_REPLACEWORDS.items():
+RE_WORD_SEPARATOR = re.compile(r"[\s_-]")
+REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+
+
+def word_rule(old: str, new: str):
+    return (
+        "word",
+        re.compile(rf"([\s_-])({old})([\s_-])"),
+        f"\\1{new}\\3",
+        old,
+        new,
+    )
+
+
+def compile_replace_words(rules: dict) -> list:
+    """
+    Turn replace_words into a list of stages applied one after the other.
+
+    Consecutive 'word' (or 'any') rules with plain text are put in one stage
+    matched in a single scan, as long as it can't change the result: a
+    replacement can't create the word of a following rule of the stage
+    (and for 'any', the words can't overlap).
+    """
+    stages = []
+    group = None
+    for old, new in rules.items():
         if type(new) is str:
             new = [new]
-        if len(new) > 1:
-            if new[1] == "regex":
-                tmp = re.sub(old, new[0], text)
-                if tmp != text:
-                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
+        mode = new[1] if len(new) > 1 else "word"
+        if mode == "regex":
+            stages.append(("regex", re.compile(old), new[0], old, new[0]))
+            group = None
+            continue
+        if mode not in ("word", "any"):
+            # ignored
+            continue
+        if mode == "word":
+            plain = not (
+                not old
+                or "\\" in new[0]
+                or new[0][:1].isdigit()
+                or REGEX_SPECIAL.intersection(old)
+                or RE_WORD_SEPARATOR.search(old)
+            )
+        else:
+            plain = bool(old)
+        if not plain:
+            if mode == "word":
+                stages.append(word_rule(old, new[0]))
+            else:
+                stages.append(("any", None, new[0], old, new[0]))
+            group = None
+            continue
+        if group is not None and group["mode"] == mode:
+            if mode == "word":
+                if old in group["parts"]:
+                    group = None
+            elif (
+                group["empty"]
+                or group["characters"].intersection(old)
+                or group["replaced"].intersection(old)
+            ):
+                group = None
+        if group is None or group["mode"] != mode:
+            group = {
+                "mode": mode,
+                "rules": {},
+                "parts": set(),
+                "characters": set(),
+                "replaced": set(),
+                "empty": False,
+            }
+            stages.append(group)
+        group["rules"][old] = new[0]
+        group["parts"].update(RE_WORD_SEPARATOR.split(new[0]))
+        group["characters"].update(old)
+        group["replaced"].update(new[0])
+        group["empty"] = group["empty"] or not new[0]
+    # build the stages of several rules
+    for i, stage in enumerate(stages):
+        if type(stage) is not dict:
+            continue
+        group = stage["rules"]
+        if len(group) == 1:
+            ((old, new),) = group.items()
+            if stage["mode"] == "word":
+                stages[i] = word_rule(old, new)
             else:
-                if new[1] == "word":
-                    tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
-                elif new[1] == "any":
-                    tmp = text.replace(old, new[0])
-                if tmp != text:
-                    log.LogDebug(f"'{old}' changed with '{new[0]}'")
+                stages[i] = ("any", None, new, old, new)
+            continue
+        words = "|".join(
+            re.escape(old) for old in sorted(group, key=len, reverse=True)
+        )
+        if stage["mode"] == "word":
+            pattern = re.compile(rf"(?<=[\s_-])(?:{words})(?=[\s_-])")
         else:
-            tmp = re.sub(rf"([\s_-])({old})([\s_-])", f"\\1{new[0]}\\3", text)
+            pattern = re.compile(words)
+        stages[i] = (stage["mode"] + "s", pattern, group, None, None)
+    return stages
+
+
+def replace_words_stage(text: str, mode: str, pattern, rules: dict):
+    parts = []
+    position = 0
+    # end of the last replacement of each word
+    last_end = {}
+    changed = set()
+    for match in pattern.finditer(text):
+        old = match.group(0)
+        # the separator after a replaced word is not available for the next
+        # match of the same rule
+        if mode == "words" and last_end.get(old) == match.start() - 1:
+            continue
+        last_end[old] = match.end()
+        parts.append(text[position : match.start()])
+        parts.append(rules[old])
+        position = match.end()
+        if rules[old] != old:
+            changed.add(old)
+    if not parts:
+        return text
+    parts.append(text[position:])
+    for old, new in rules.items():
+        if old in changed:
+            log.LogDebug(f"'{old}' changed with '{new}'")
+    return "".join(parts)
+
+
+def replace_text(text: str):
+    for mode, pattern, new, old, new_text in REPLACE_WORDS_STAGES:
+        if mode == "regex":
+            tmp = pattern.sub(new, text)
             if tmp != text:
-                log.LogDebug(f"'{old}' changed with '{new[0]}'")
+                log.LogDebug(f"Regex matched: {text} -> {tmp}")
+        elif mode == "word":
+            tmp = pattern.sub(new, text)
+            if tmp != text:
+                log.LogDebug(f"'{old}' changed with '{new_text}'")
+        elif mode == "any":
+            tmp = text.replace(old, new)
+            if tmp != text:
+                log.LogDebug(f"'{old}' changed with '{new_text}'")
+        else:
+            tmp = replace_words_stage(text, mode, pattern, new)
         text = tmp
-    return tmp
+    return text
+
+
+RE_FIELD = re.compile(r"\$\w+")
+RE_EMPTY_GROUP = re.compile(r"\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}")
+RE_BRACES = re.compile(r"[{}]")
+RE_CONSECUTIVE_NONWORD = re.compile(r"(\W+)\1+")
+RE_NONWORD_RUN = re.compile(r"\W{2,}")
+# run of non-word characters -> same run without the repetitions
+NONWORD_RUNS = {}
 
 
 def cleanup_text(text: str):
-    text = re.sub(r"\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}", "", text)
-    text = re.sub(r"[{}]", "", text)
+    if "(" in text or "[" in text or "{" in text:
+        text = RE_EMPTY_GROUP.sub("", text)
+    if "{" in text or "}" in text:
+        text = RE_BRACES.sub("", text)
     text = remove_consecutive_nonword(text)
     return text.strip(" -_.")
 
 
+def collapse_nonword_run(run: str) -> str:
+    collapsed = NONWORD_RUNS.get(run)
+    if collapsed is None:
+        collapsed = run
+        for _ in range(0, 10):
+            collapsed, found = RE_CONSECUTIVE_NONWORD.subn(r"\1", collapsed)
+            if not found:
+                break
+        if len(NONWORD_RUNS) > 10000:
+            NONWORD_RUNS.clear()
+        NONWORD_RUNS[run] = collapsed
+    return collapsed
+
+
 def remove_consecutive_nonword(text: str):
-    for _ in range(0, 10):
-        m = re.findall(r"(\W+)\1+", text)
-        if m:
-            text = re.sub(r"(\W+)\1+", r"\1", text)
-        else:
-            break
+    # a repetition can't go past a word character, so every run of non-word
+    # characters is handled on its own (and the result reused)
+    for run in RE_NONWORD_RUN.findall(text):
+        if collapse_nonword_run(run) != run:
+            return RE_NONWORD_RUN.sub(lambda m: collapse_nonword_run(m.group(0)), text)
     return text
 
 
 def field_replacer(text: str, scene_information: dict):
-    field_found = re.findall(r"\$\w+", text)
+    field_found = RE_FIELD.findall(text)
     result = text
     title = None
     replaced_word = ""
@@ -832,9 +1825,127 @@ def field_replacer(text: str, scene_information: dict):
     return result, title
 
 
+class CompiledTemplate:
+    """
+    Template parsed once into literal and field segments.
+
+    render() gives the same (result, title) as field_replacer() in a single
+    pass. field_replacer() replaces the fields one after the other (longest
+    first), so a template where a field name is the start of another one, or
+    a value containing a '$', still goes through it to keep the exact output.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        # literal text or (token, field)
+        self.segments = []
+        # occurrences of each field
+        self.counts = {}
+        position = 0
+        for match in RE_FIELD.finditer(template):
+            if match.start() > position:
+                self.segments.append(template[position : match.start()])
+            token = match.group(0)
+            field = token[1:].strip("_")
+            self.segments.append((token, field))
+            self.counts[field] = self.counts.get(field, 0) + 1
+            position = match.end()
+        if position < len(template):
+            self.segments.append(template[position:])
+        tokens = sorted(RE_FIELD.findall(template), key=len, reverse=True)
+        self.fields = {token[1:].strip("_") for token in tokens}
+        self.has_title = "title" in self.fields
+        # $performer followed by $title in field_replacer's order
+        self.prevent_title = False
+        for i, token in enumerate(tokens):
+            if token[1:].strip("_") == "performer":
+                self.prevent_title = tokens[i + 1 : i + 2] == ["$title"]
+                break
+        self.simple = self._is_simple(tokens)
+
+    @staticmethod
+    def _is_simple(tokens: list) -> bool:
+        first_index = {}
+        for i, token in enumerate(tokens):
+            first_index.setdefault(token, i)
+        for token, index in first_index.items():
+            field = token[1:].strip("_")
+            if not field or token[1] == "_":
+                return False
+            if field == "performer" and token != "$performer":
+                return False
+            # replacing another field before (or, for $title, at any time)
+            # must not touch this one
+            for other, other_index in first_index.items():
+                if other == token or (other_index > index and field != "title"):
+                    continue
+                other_field = other[1:].strip("_")
+                if other_field == "title":
+                    continue
+                if token.startswith(other) or token.startswith(f"${other_field}"):
+                    return False
+        return True
+
+    def render(self, scene_information: dict):
+        if not self.simple:
+            return field_replacer(self.template, scene_information)
+        values = {}
+        for field in self.fields:
+            value = scene_information.get(field)
+            if not value:
+                value = ""
+            elif type(value) is not str:
+                return field_replacer(self.template, scene_information)
+            if FIELD_REPLACER.get(f"${field}"):
+                value = value.replace(
+                    FIELD_REPLACER[f"${field}"]["replace"],
+                    FIELD_REPLACER[f"${field}"]["with"],
+                )
+            if "$" in value:
+                return field_replacer(self.template, scene_information)
+            values[field] = value
+        title = values["title"].strip() if self.has_title else None
+        if (
+            self.prevent_title
+            and scene_information.get("performer")
+            and scene_information.get("title")
+            and PREVENT_TITLE_PERF
+        ):
+            if re.search(
+                f"^{scene_information['performer'].lower()}",
+                scene_information["title"].lower(),
+            ):
+                log.LogDebug(
+                    "Ignoring the performer field because it's already in start of title"
+                )
+                values["performer"] = ""
+        parts = []
+        for segment in self.segments:
+            if type(segment) is str:
+                parts.append(segment)
+                continue
+            token, field = segment
+            value = values[field]
+            if field == "title":
+                # replaced after the cleanup
+                parts.append(token)
+            elif value:
+                parts.append(value + token[len(field) + 1 :])
+        return "".join(parts), title
+
+
+COMPILED_TEMPLATES = {}
+
+
+def compile_template(template: str) -> CompiledTemplate:
+    compiled = COMPILED_TEMPLATES.get(template)
+    if compiled is None:
+        compiled = COMPILED_TEMPLATES[template] = CompiledTemplate(template)
+    return compiled
+
+
 def makeFilename(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    r, t = field_replacer(new_filename, scene_information)
+    r, t = compile_template(str(query)).render(scene_information)
     if FILENAME_REPLACEWORDS:
         r = replace_text(r)
     if not t:
@@ -850,7 +1961,7 @@ def makeFilename(scene_information: dict, query: str) -> str:
 def makePath(scene_information: dict, query: str) -> str:
     new_filename = str(query)
     new_filename = new_filename.replace("$performer", "$performer_path")
-    r, t = field_replacer(new_filename, scene_information)
+    r, t = compile_template(new_filename).render(scene_information)
     if not t:
         r = r.replace("$title", "")
     r = cleanup_text(r)
@@ -879,52 +1990,76 @@ def capitalizeWords(s: str) -> str:
     Raises:
         ValueError: If the input is not a string.
 
-    About the regex:
-        The first \b marks the starting word boundary.
-        [A-Z]? allows for an optional initial uppercase letter.
-        [a-z\'\u2019\u2018]+ matches one or more lowercase letters, apostrophes, right single quotation marks, or left single quotation marks.
-            If a word contains multiple uppercase letters, it does not match.
-        The final \b marks the ending word boundary, ensuring the expression matches whole words.
-    """
-    if not isinstance(s, str):
-        raise ValueError("Input must be a string.")
-
-    # Function to capitalize words based on their position and value.
-    def process_word(match):
-        word = match.group(0)
-        preceding_char, following_char = None, None
-
-        # List of words to avoid capitalizing if found between other words.
-        exceptions = {"and", "of", "the"}
-
-        # Find the nearest non-space character before the current word
-        if match.start() > 0:
-            for i in range(match.start() - 1, -1, -1):
-                if not match.string[i].isspace():
-                    preceding_char = match.string[i]
-                    break
+    The words listed in titlecase_abbreviations are put in uppercase.
+    See titlecaser.py for the regex finding the words.
+    """
+    return TITLE_CASER(s)
 
-        # Find the nearest non-space character after the current word
-        if match.end() < len(s):
-            for i in range(match.end(), len(s)):
-                if not match.string[i].isspace():
-                    following_char = match.string[i]
-                    break
 
-        # Determine capitalization based on the position and the exception rules
-        if (
-            match.start() == 0
-            or match.end() == len(s)
-            or word.lower() not in exceptions
-            or (preceding_char and not preceding_char.isalnum())
-            or (following_char and not following_char.isalnum())
-        ):
-            return word.capitalize()
-        else:
-            return word.lower()
+# illegal character for Windows (a backslash is kept)
+ILLEGAL_CHARACTER = str.maketrans("", "", '/:"*?<>|')
+RE_APOSTROPHE = re.compile("[’‘”“]+")
+RE_NON_ASCII = re.compile(r"[^\x00-\x7f]+")
+# run of non-ascii characters -> unidecode result
+TRANSLITERATED = {}
+
+
+def compile_remove_character(characters: str):
+    """
+    Translate table and regex removing the characters of removecharac_Filename.
+    The table is None if it's not a plain list of characters (range, escape...).
+    """
+    if not characters:
+        return None, None
+    regex = re.compile(f"[{characters}]+")
+    if set(characters).intersection("^-\\[]"):
+        return None, regex
+    return str.maketrans("", "", characters), regex
+
+
+def remove_illegal_character(text: str) -> str:
+    return text.translate(ILLEGAL_CHARACTER)
+
+
+def remove_character(text: str) -> str:
+    if REMOVECHARACTER_TABLE:
+        return text.translate(REMOVECHARACTER_TABLE)
+    return RE_REMOVECHARACTER.sub("", text)
+
 
-    # Apply the regex pattern and the process_word function.
-    return re.sub(r"\b[A-Z]?[a-z\'\u2019\u2018]+\b", process_word, s)
+def typewriter_apostrophe(text: str) -> str:
+    if text.isascii():
+        return text
+    return RE_APOSTROPHE.sub("'", text)
+
+
+def transliterate_run(match) -> str:
+    run = match.group(0)
+    transliterated = TRANSLITERATED.get(run)
+    if transliterated is None:
+        transliterated = unidecode.unidecode(run, errors="preserve")
+        if len(TRANSLITERATED) > 10000:
+            TRANSLITERATED.clear()
+        TRANSLITERATED[run] = transliterated
+    return transliterated
+
+
+def transliterate(text: str) -> str:
+    # unidecode works character by character and keeps ascii as it is
+    if text.isascii():
+        return text
+    return RE_NON_ASCII.sub(transliterate_run, text)
+
+
+def sanitize_filename(text: str) -> str:
+    text = text.translate(FILENAME_TABLE)
+    if FILENAME_REMOVECHARACTER and not REMOVECHARACTER_TABLE:
+        text = RE_REMOVECHARACTER.sub("", text)
+    # Trying to remove non standard character
+    if MODULE_UNIDECODE and UNICODE_USE:
+        return transliterate(text)
+    # Using typewriter for Apostrophe
+    return typewriter_apostrophe(text)
 
 
 def create_new_filename(scene_info: dict, template: str):
@@ -937,19 +2072,7 @@ def create_new_filename(scene_info: dict, template: str):
         new_filename = new_filename.lower()
     if FILENAME_TITLECASE:
         new_filename = capitalizeWords(new_filename)
-    # Remove illegal character for Windows
-    new_filename = re.sub('[\\/:"*?<>|]+', "", new_filename)
-
-    if FILENAME_REMOVECHARACTER:
-        new_filename = re.sub(f"[{FILENAME_REMOVECHARACTER}]+", "", new_filename)
-
-    # Trying to remove non standard character
-    if MODULE_UNIDECODE and UNICODE_USE:
-        new_filename = unidecode.unidecode(new_filename, errors="preserve")
-    else:
-        # Using typewriter for Apostrophe
-        new_filename = re.sub("[’‘”“]+", "'", new_filename)
-    return new_filename
+    return sanitize_filename(new_filename)
 
 
 def remove_consecutive(liste: list):
@@ -973,10 +2096,10 @@ def create_new_path(scene_info: dict, template: dict):
             if not scene_info.get("studio_hierarchy"):
                 continue
             for p in scene_info["studio_hierarchy"]:
-                path_list.append(re.sub('[\\/:"*?<>|]+', "", p).strip())
+                path_list.append(remove_illegal_character(p).strip())
         else:
             path_list.append(
-                re.sub('[\\/:"*?<>|]+', "", makePath(scene_info, part)).strip()
+                remove_illegal_character(makePath(scene_info, part)).strip()
             )
     # Remove blank, empty string
     path_split = [x for x in path_list if x]
@@ -995,17 +2118,113 @@ def create_new_path(scene_info: dict, template: dict):
     path_edited = os.sep.join(path_split)
 
     if FILENAME_REMOVECHARACTER:
-        path_edited = re.sub(f"[{FILENAME_REMOVECHARACTER}]+", "", path_edited)
+        path_edited = remove_character(path_edited)
 
     # Using typewriter for Apostrophe
-    new_path = re.sub("[’‘”“]+", "'", path_edited)
+    return typewriter_apostrophe(path_edited)
+
+
+def render_new_path(scene_info: dict, template: dict):
+    if template["filename"]:
+        new_filename = create_new_filename(scene_info, template["filename"])
+    else:
+        new_filename = scene_info["current_filename"]
+    if template.get("path"):
+        new_directory = create_new_path(scene_info, template)
+    else:
+        new_directory = scene_info["current_directory"]
+    return new_filename, new_directory, os.path.join(new_directory, new_filename)
+
+
+def field_length(scene_info: dict, template: dict, field: str) -> int:
+    """Estimate of the characters a field adds to the final path."""
+    value = scene_info.get(field)
+    if type(value) is not str:
+        value = str(value)
+    occurrences = 0
+    if template["filename"]:
+        compiled = compile_template(str(template["filename"]))
+        occurrences += compiled.counts.get(field, 0)
+    if template.get("path"):
+        path_split = scene_info["template_split"]
+        for part in path_split:
+            if (":" in part and path_split[0]) or part == "$studio_hierarchy":
+                continue
+            part = part.replace("$performer", "$performer_path")
+            occurrences += compile_template(part).counts.get(field, 0)
+    return occurrences * len(value)
 
-    return new_path
 
+@PROFILER.timed("render")
+def shorten_new_path(scene_info: dict, template: dict):
+    """
+    Set new_filename, new_directory and final_path, removing the fields of
+    order_field (in order) until the path is short enough.
 
-def connect_db(path: str):
+    The number of fields to remove is estimated from their length, so the
+    path is rendered about twice more instead of once per removed field.
+    The result is the same as removing them one by one.
+    """
+    rendered = render_new_path(scene_info, template)
+    if IGNORE_PATH_LENGTH or len(rendered[2]) <= 240:
+        (
+            scene_info["new_filename"],
+            scene_info["new_directory"],
+            scene_info["final_path"],
+        ) = rendered
+        return
+    fields = []
+    for removed_field in ORDER_SHORTFIELD:
+        if removed_field and scene_info.get(removed_field.replace("$", "")):
+            fields.append(removed_field)
+    if fields:
+        excess = len(rendered[2]) - 240
+        removed_values = {}
+        estimated = 0
+        index = len(fields) - 1
+        for i, removed_field in enumerate(fields):
+            key = removed_field.replace("$", "")
+            estimated += field_length(scene_info, template, key)
+            if estimated >= excess:
+                index = i
+                break
+        for removed_field in fields[: index + 1]:
+            key = removed_field.replace("$", "")
+            removed_values[key] = scene_info.pop(key)
+        rendered = render_new_path(scene_info, template)
+        if len(rendered[2]) > 240:
+            # estimate too low, continue one by one
+            for removed_field in fields[index + 1 :]:
+                key = removed_field.replace("$", "")
+                removed_values[key] = scene_info.pop(key)
+                index += 1
+                rendered = render_new_path(scene_info, template)
+                if len(rendered[2]) <= 240:
+                    break
+        else:
+            # the cleanup can remove more than the values, check that fewer
+            # fields were not enough
+            while index > 0:
+                key = fields[index].replace("$", "")
+                scene_info[key] = removed_values.pop(key)
+                shorter = render_new_path(scene_info, template)
+                if len(shorter[2]) > 240:
+                    removed_values[key] = scene_info.pop(key)
+                    break
+                rendered = shorter
+                index -= 1
+        for removed_field in fields[: index + 1]:
+            log.LogWarning(f"removed {removed_field} to reduce the length path")
+    (
+        scene_info["new_filename"],
+        scene_info["new_directory"],
+        scene_info["final_path"],
+    ) = rendered
+
+
+def connect_db(path: str, timeout=10):
     try:
-        sqliteConnection = sqlite3.connect(path, timeout=10)
+        sqliteConnection = sqlite3.connect(path, timeout=timeout)
         log.LogDebug("Python successfully connected to SQLite")
     except sqlite3.Error as error:
         log.LogError(f"FATAL SQLITE Error: {error}")
@@ -1013,9 +2232,102 @@ def connect_db(path: str):
     return sqliteConnection
 
 
+class PathIndex:
+    """
+    Every file path (and basename) known by Stash with the scene(s) using it.
+
+    Built once from the database for bulk runs and kept up to date with the
+    renames, so collisions are found without querying Stash for each name.
+    """
+
+    @PROFILER.timed("path index")
+    def __init__(self, stash_db: sqlite3.Connection):
+        self.paths = {}
+        self.basenames = {}
+        cursor = stash_db.cursor()
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            cursor.execute(
+                "SELECT folders.path, files.basename, scenes_files.scene_id FROM files JOIN folders ON files.parent_folder_id = folders.id LEFT JOIN scenes_files ON scenes_files.file_id = files.id"
+            )
+            for folder, basename, scene_id in cursor:
+                self.add(os.path.join(folder, basename), scene_id)
+        else:
+            cursor.execute("SELECT path, id FROM scenes")
+            for path, scene_id in cursor:
+                self.add(path, scene_id)
+        cursor.close()
+        log.LogDebug(f"[INDEX] {len(self.paths)} paths indexed")
+
+    @staticmethod
+    def _add(index: dict, key: str, owner):
+        index.setdefault(os.path.normcase(key), set()).add(owner)
+
+    @staticmethod
+    def _remove(index: dict, key: str, owner):
+        key = os.path.normcase(key)
+        owners = index.get(key)
+        if owners is not None:
+            owners.discard(owner)
+            if not owners:
+                del index[key]
+
+    def add(self, path: str, scene_id):
+        # None: the file isn't linked to a scene
+        owner = None if scene_id is None else str(scene_id)
+        self._add(self.paths, path, owner)
+        self._add(self.basenames, os.path.basename(path), owner)
+
+    def remove(self, path: str, scene_id):
+        owner = None if scene_id is None else str(scene_id)
+        self._remove(self.paths, path, owner)
+        self._remove(self.basenames, os.path.basename(path), owner)
+
+    def move(self, old_path: str, new_path: str, scene_id):
+        self.remove(old_path, scene_id)
+        self.add(new_path, scene_id)
+
+    def owners(self, path: str) -> set:
+        return self.paths.get(os.path.normcase(path), set())
+
+    def basename_owners(self, basename: str) -> set:
+        return self.basenames.get(os.path.normcase(basename), set())
+
+
+# only used in bulk mode
+PATH_INDEX = None
+
+
+def checking_duplicate_index(scene_info: dict):
+    scene_id = str(scene_info["scene_id"])
+    # 1. Check for Full Path collisions
+    for owner in PATH_INDEX.owners(scene_info["final_path"]):
+        if owner == scene_id:
+            log.LogDebug(f"Path match is current scene {owner}, ignoring collision.")
+            continue
+        log.LogError("!!! REAL COLLISION DETECTED: Path belongs to another Scene !!!")
+        log.LogWarning(f"Target Path: {scene_info['final_path']}")
+        if owner is None:
+            log.LogWarning("Conflict with a file not linked to a scene")
+        else:
+            log.LogWarning(f"Conflict Scene ID: [{owner}]")
+        return 1
+    # 2. Check for Filename collisions (just the basename)
+    for owner in PATH_INDEX.basename_owners(scene_info["new_filename"]):
+        if owner is not None and owner != scene_id:
+            log.LogInfo(f"Notice: Filename collision (different folder): {scene_info['new_filename']}")
+            log.LogInfo(f" -> Matches Scene ID: [{owner}]")
+    return None
+
+
+@PROFILER.timed("collisions")
 def checking_duplicate_db(scene_info: dict):
+    if PATH_INDEX is not None:
+        return checking_duplicate_index(scene_info)
+    # Full path and basename are checked in the same round-trip
+    scenes_path, scenes_file = graphql_findScenesbyPaths(
+        [scene_info["final_path"], scene_info["new_filename"]], "EQUALS"
+    )
     # 1. Check for Full Path collisions
-    scenes_path = graphql_findScenebyPath(scene_info["final_path"], "EQUALS")
     if scenes_path["count"] > 0:
         for dupl_row in scenes_path["scenes"]:
             # FIX: If the duplicate found is the scene we are currently working on, ignore it
@@ -1029,7 +2341,6 @@ def checking_duplicate_db(scene_info: dict):
             return 1 # This is a real duplicate
 
     # 2. Check for Filename collisions (just the basename)
-    scenes_file = graphql_findScenebyPath(scene_info["new_filename"], "EQUALS")
     if scenes_file["count"] > 0:
         for dupl_row in scenes_file["scenes"]:
             # Ensure we aren't just matching the scene we are currently processing
@@ -1039,109 +2350,687 @@ def checking_duplicate_db(scene_info: dict):
     
     return None
 
-def db_rename(stash_db: sqlite3.Connection, scene_info):
-    cursor = stash_db.cursor()
-    # Database rename
-    cursor.execute(
-        "UPDATE scenes SET path=? WHERE id=?;",
-        [scene_info["final_path"], scene_info["scene_id"]],
+
+def is_db_busy(err: sqlite3.Error) -> bool:
+    return isinstance(err, sqlite3.OperationalError) and (
+        "locked" in str(err) or "busy" in str(err)
     )
-    stash_db.commit()
-    # Close DB
-    cursor.close()
 
 
-def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
-    cursor = stash_db.cursor()
-    # 2022-09-17T11:25:52+02:00
-    mod_time = datetime.now().astimezone().isoformat("T", "seconds")
+class RenameJournal:
+    """
+    The moves of files on disk. Each move is written to the journal (and
+    synced) by add() before the file is moved, so a crash never leaves a
+    moved file out of it. A move that fails is then cancelled.
 
-    # get the next id that we should use if needed
-    cursor.execute("SELECT MAX(id) from folders")
-    new_id = cursor.fetchall()[0][0] + 1
+    The journal is a JSON lines file (one move per line) read back by the
+    task 'Undo renames'. The lines of log_file are written by done(), once
+    the file is moved.
+    """
 
-    # get the old folder id
-    cursor.execute(
-        "SELECT id FROM folders WHERE path=?", [scene_info["current_directory"]]
-    )
-    old_folder_id = cursor.fetchall()[0][0]
-
-    # check if the folder of file is created in db
-    cursor.execute("SELECT id FROM folders WHERE path=?", [scene_info["new_directory"]])
-    folder_id = cursor.fetchall()
-    if not folder_id:
-        dir = scene_info["new_directory"]
-        # reduce the path to find a parent folder
-        for _ in range(1, len(scene_info["new_directory"].split(os.sep))):
-            dir = os.path.dirname(dir)
-            cursor.execute("SELECT id FROM folders WHERE path=?", [dir])
-            parent_id = cursor.fetchall()
-            if parent_id:
-                # create a new row with the new folder with the parent folder find above
-                cursor.execute(
-                    "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
-                    [
-                        new_id,
-                        scene_info["new_directory"],
-                        parent_id[0][0],
-                        mod_time,
-                        mod_time,
-                        mod_time,
-                        None,
-                    ],
-                )
-                stash_db.commit()
-                folder_id = new_id
-                break
-    else:
-        folder_id = folder_id[0][0]
-    if folder_id:
-        cursor.execute(
-            "SELECT file_id from scenes_files WHERE scene_id=?",
-            [scene_info["scene_id"]],
+    def __init__(self, path: str, text_path: str):
+        self.path = path
+        self.text_path = text_path
+        # the moves of the same process
+        self.run = (
+            datetime.fromtimestamp(START_TIME).astimezone().isoformat("T", "seconds")
         )
-        file_ids = cursor.fetchall()
-        file_id = None
-        for f in file_ids:
-            # it can have multiple file for a scene
-            cursor.execute("SELECT parent_folder_id from files WHERE id=?", [f[0]])
-            check_parent = cursor.fetchall()[0][0]
-            # if the parent id is the one found above section, we find our file.s
-            if check_parent == old_folder_id:
-                file_id = f[0]
+        self.lock = threading.Lock()
+
+    def _write(self, entry: dict):
+        # also called by the threads of the plan executor
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, scene_info: dict, source: str, target: str, associated=False) -> dict:
+        """Raise OSError if the journal can't be written, the file must not be moved."""
+        entry = {
+            "time": datetime.now().astimezone().isoformat("T", "milliseconds"),
+            "run": self.run,
+            "scene_id": str(scene_info["scene_id"]),
+            "source": source,
+            "target": target,
+            "oshash": None if associated else scene_info.get("oshash"),
+            "associated": associated,
+        }
+        if self.path:
+            self._write(entry)
+        return entry
+
+    def done(self, entry: dict):
+        """Raise OSError if log_file can't be written, the move must be undone."""
+        if not self.text_path:
+            return
+        line = f"{entry['scene_id']}|{entry['source']}|{entry['target']}"
+        if not entry["associated"]:
+            line += f"|{entry['oshash']}"
+        with self.lock, open(self.text_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def cancel(self, entry: dict):
+        """The move of the entry failed or was undone."""
+        if not self.path:
+            return
+        try:
+            self._write(
+                {
+                    "time": datetime.now().astimezone().isoformat("T", "milliseconds"),
+                    "run": self.run,
+                    "scene_id": entry["scene_id"],
+                    "source": entry["source"],
+                    "target": entry["target"],
+                    "cancelled": True,
+                }
+            )
+        except OSError as err:
+            # the undo skips the files that aren't there
+            log.LogWarning(f"[Journal] Could not cancel the move of {entry['source']} ({err})")
+
+
+JOURNAL = None
+
+
+def read_journal(path: str) -> list:
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # last line cut by a crash
+                log.LogWarning(f"[Journal] Invalid line ignored: {line.strip()}")
+                continue
+            if not entry.get("cancelled"):
+                entries.append(entry)
+                continue
+            # removes the last move of this file, it wasn't done
+            for i in range(len(entries) - 1, -1, -1):
+                if (entries[i]["source"], entries[i]["target"]) == (
+                    entry["source"],
+                    entry["target"],
+                ):
+                    del entries[i]
+                    break
+    return entries
+
+
+def file_oshash(path: str) -> str:
+    # same hash as Stash: the size plus the 64-bit words of the first and
+    # last 64KiB put together
+    chunk = 64 * 1024
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        data = f.read(chunk)
+        f.seek(max(0, size - chunk))
+        data += f.read(chunk)
+    words = struct.unpack(f"<{len(data) // 8}Q", data[: len(data) // 8 * 8])
+    return f"{(size + sum(words)) & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def select_journal(entries: list, since="", until="", scenes=()) -> list:
+    """
+    The moves of files (not associated files) done between since and until
+    (ISO dates), of the scenes given by id or oshash. Nothing given: the
+    moves of the last run.
+    """
+    index = {}
+    moves = []
+    for entry in entries:
+        if entry.get("associated"):
+            continue
+        moves.append(entry)
+        index.setdefault(entry["scene_id"], []).append(entry)
+        if entry.get("oshash"):
+            index.setdefault(entry["oshash"], []).append(entry)
+    if scenes:
+        selected = {id(entry) for key in scenes for entry in index.get(str(key), [])}
+        moves = [entry for entry in moves if id(entry) in selected]
+    elif not since and not until and moves:
+        moves = [entry for entry in moves if entry["run"] == moves[-1]["run"]]
+    if since or until:
+        since = datetime.fromisoformat(since).astimezone() if since else None
+        until = datetime.fromisoformat(until).astimezone() if until else None
+        moves = [
+            entry
+            for entry in moves
+            if (since is None or datetime.fromisoformat(entry["time"]) >= since)
+            and (until is None or datetime.fromisoformat(entry["time"]) <= until)
+        ]
+    return moves
+
+
+def undo_moves(entries: list) -> list:
+    """
+    Moves putting the files back, a file moved several times goes back to
+    its first place.
+    """
+    # key: where the file is moved back to
+    moves = {}
+    for entry in reversed(entries):
+        move = moves.pop(os.path.normcase(entry["target"]), None)
+        if move is None:
+            move = {
+                "scene_id": entry["scene_id"],
+                "source": entry["target"],
+                "oshash": entry.get("oshash"),
+                "associated": True,
+                "clean_tag": None,
+                # only moved back if it's the same file
+                "verify": True,
+            }
+        move["target"] = entry["source"]
+        moves[os.path.normcase(entry["source"])] = move
+    return [
+        move
+        for move in moves.values()
+        if os.path.normcase(move["source"]) != os.path.normcase(move["target"])
+    ]
+
+
+def undo_renames(path: str, since="", until="", scenes=()):
+    if not os.path.isfile(path):
+        log.LogError(f"No journal, enable rename_journal in the config ({path})")
+        return
+    entries = select_journal(read_journal(path), since, until, scenes)
+    moves = undo_moves(entries)
+    log.LogInfo(f"[Undo] {len(entries)} moves to revert, {len(moves)} files to move")
+    apply_moves(moves)
+
+
+def select_db(conn: sqlite3.Connection, query: str, params=()) -> list:
+    """fetchall(), retried with backoff while Stash holds the lock."""
+    for attempt in range(DB_BUSY_RETRIES + 1):
+        try:
+            return conn.execute(query, params).fetchall()
+        except sqlite3.OperationalError as err:
+            if not is_db_busy(err) or attempt == DB_BUSY_RETRIES:
+                raise
+            time.sleep(min(0.05 * 2**attempt, 2))
+
+
+RE_DB_TIME = re.compile(r"(\d{4}-\d\d-\d\d)[ T](\d\d:\d\d:\d\d)(?:\.\d+)?(.*)")
+
+
+def stash_time(value):
+    """A datetime of the database, written like GraphQL (RFC 3339)."""
+    if not isinstance(value, str):
+        return value
+    match = RE_DB_TIME.fullmatch(value.strip())
+    if not match:
+        return value
+    return f"{match[1]}T{match[2]}{match[3].replace(' ', '')}"
+
+
+class StashDBReader:
+    """
+    Scenes read from the database of Stash instead of GraphQL, for the tasks
+    (bulk_sqlite_read). The connection is read-only (URI mode=ro, query_only)
+    and memory-mapped.
+
+    A page of scenes is read with one query per table (files, fingerprints,
+    stash ids, tags, performers, movies), only the ones in SCENE_NEEDS, and
+    put in the shape of scene_fields(), so the rest of the plugin doesn't
+    see the difference.
+    Only the file-refactor schema (v32+) is supported.
+    """
+
+    MMAP_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, path: str):
+        self.conn = None
+        try:
+            uri = pathlib.Path(path).absolute().as_uri()
+            self.conn = sqlite3.connect(f"{uri}?mode=ro", uri=True, timeout=DB_TIMEOUT)
+            self.conn.execute("PRAGMA query_only = ON")
+            self.conn.execute(f"PRAGMA mmap_size = {self.MMAP_SIZE}")
+            self.tables = {
+                row[0]
+                for row in select_db(
+                    self.conn, "SELECT name FROM sqlite_master WHERE type='table'"
+                )
+            }
+            self.studios = {}
+            if "studios" in self.tables:
+                self.studios = {
+                    studio_id: (name, parent_id)
+                    for studio_id, name, parent_id in select_db(
+                        self.conn, "SELECT id, name, parent_id FROM studios"
+                    )
+                }
+        except sqlite3.Error as err:
+            log.LogError(f"[SQLITE] Could not read the scenes in the database ({err})")
+            self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _rows(self, query: str, scene_ids: list) -> list:
+        # 999 variables max
+        rows = []
+        for i in range(0, len(scene_ids), 500):
+            chunk = scene_ids[i : i + 500]
+            rows += select_db(
+                self.conn, query.format(ids=",".join("?" * len(chunk))), chunk
+            )
+        return rows
+
+    def _scene_columns(self) -> str:
+        columns = "id, title, date, rating, organized, updated_at, studio_id"
+        if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
+            columns += ", code"
+        return columns
+
+    def _studio(self, studio_id):
+        if studio_id not in self.studios:
+            return None
+        name, parent_id = self.studios[studio_id]
+        parent = None
+        if parent_id in self.studios:
+            parent = {"id": str(parent_id), "name": self.studios[parent_id][0]}
+        return {"id": str(studio_id), "name": name, "parent_studio": parent}
+
+    @staticmethod
+    def _rating(value):
+        if value is None or DB_VERSION >= DB_VERSION_RATING100:
+            return value
+        return value * 20
+
+    @PROFILER.timed("sqlite read")
+    def load(self, rows: list) -> list:
+        """The scenes of rows (the columns of _scene_columns()), see scene_fields()."""
+        scenes = {}
+        for row in rows:
+            scene_id, title, date, rating, organized, updated_at, studio_id = row[:7]
+            scene = {
+                "id": str(scene_id),
+                "title": title,
+                "date": date,
+                "rating100": self._rating(rating),
+                "organized": bool(organized),
+                "updated_at": stash_time(updated_at),
+                "files": [],
+            }
+            if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
+                scene["code"] = row[7]
+            if "stash_ids" in SCENE_NEEDS:
+                scene["stash_ids"] = []
+            if "studio" in SCENE_NEEDS:
+                scene["studio"] = self._studio(studio_id)
+            for key in ("tags", "performers", "movies"):
+                if key in SCENE_NEEDS:
+                    scene[key] = []
+            scenes[scene_id] = scene
+        ids = list(scenes)
+        files = {}
+        for scene_id, file_id, folder, basename, *video in self._rows(
+            """SELECT scenes_files.scene_id, files.id, folders.path, files.basename,
+                video_files.video_codec, video_files.audio_codec, video_files.width,
+                video_files.height, video_files.duration, video_files.bit_rate
+            FROM scenes_files
+            JOIN files ON files.id = scenes_files.file_id
+            JOIN folders ON folders.id = files.parent_folder_id
+            LEFT JOIN video_files ON video_files.file_id = files.id
+            WHERE scenes_files.scene_id IN ({ids})
+            ORDER BY scenes_files.scene_id, scenes_files."primary" DESC, files.id""",
+            ids,
+        ):
+            scene_file = {
+                "path": os.path.join(folder, basename),
+                "video_codec": video[0],
+                "audio_codec": video[1],
+                "width": video[2],
+                "height": video[3],
+                "duration": video[4],
+                "bit_rate": video[5],
+            }
+            if "oshash" in SCENE_NEEDS:
+                scene_file["oshash"] = None
+            files.setdefault(file_id, []).append(scene_file)
+            scenes[scene_id]["files"].append(scene_file)
+        if "oshash" in SCENE_NEEDS:
+            for file_id, value in self._rows(
+                """SELECT DISTINCT files_fingerprints.file_id, files_fingerprints.fingerprint
+                FROM files_fingerprints
+                JOIN scenes_files ON scenes_files.file_id = files_fingerprints.file_id
+                WHERE files_fingerprints.type = 'oshash' AND scenes_files.scene_id IN ({ids})""",
+                ids,
+            ):
+                if isinstance(value, bytes):
+                    value = value.decode("utf-8", "replace")
+                for scene_file in files.get(file_id, []):
+                    scene_file["oshash"] = value
+        if "stash_ids" in SCENE_NEEDS:
+            for scene_id, endpoint, stash_id in self._rows(
+                "SELECT scene_id, endpoint, stash_id FROM scene_stash_ids WHERE scene_id IN ({ids})",
+                ids,
+            ):
+                scenes[scene_id]["stash_ids"].append(
+                    {"endpoint": endpoint, "stash_id": stash_id}
+                )
+        if "tags" in SCENE_NEEDS:
+            for scene_id, tag_id, name in self._rows(
+                """SELECT scenes_tags.scene_id, tags.id, tags.name FROM scenes_tags
+                JOIN tags ON tags.id = scenes_tags.tag_id
+                WHERE scenes_tags.scene_id IN ({ids}) ORDER BY tags.name""",
+                ids,
+            ):
+                scenes[scene_id]["tags"].append({"id": str(tag_id), "name": name})
+        if "performers" in SCENE_NEEDS:
+            performer_stash_ids = {}
+            if "performer_stash_ids" in SCENE_NEEDS:
+                for performer_id, endpoint, stash_id in self._rows(
+                    """SELECT DISTINCT performer_stash_ids.performer_id, performer_stash_ids.endpoint, performer_stash_ids.stash_id
+                    FROM performer_stash_ids
+                    JOIN performers_scenes ON performers_scenes.performer_id = performer_stash_ids.performer_id
+                    WHERE performers_scenes.scene_id IN ({ids})""",
+                    ids,
+                ):
+                    performer_stash_ids.setdefault(performer_id, []).append(
+                        {"endpoint": endpoint, "stash_id": stash_id}
+                    )
+            for scene_id, performer_id, name, gender, favorite, rating in self._rows(
+                """SELECT performers_scenes.scene_id, performers.id, performers.name,
+                    performers.gender, performers.favorite, performers.rating
+                FROM performers_scenes
+                JOIN performers ON performers.id = performers_scenes.performer_id
+                WHERE performers_scenes.scene_id IN ({ids}) ORDER BY performers.name""",
+                ids,
+            ):
+                performer = {"id": str(performer_id), "name": name}
+                if "performer_gender" in SCENE_NEEDS:
+                    performer["gender"] = gender or None
+                if "performer_favorite" in SCENE_NEEDS:
+                    performer["favorite"] = bool(favorite)
+                if "performer_rating" in SCENE_NEEDS:
+                    performer["rating100"] = self._rating(rating)
+                if "performer_stash_ids" in SCENE_NEEDS:
+                    performer["stash_ids"] = performer_stash_ids.get(performer_id, [])
+                scenes[scene_id]["performers"].append(performer)
+        if "movies" in SCENE_NEEDS:
+            # the movies are groups since Stash 0.27
+            table, column, join = ("movies", "movie_id", "movies_scenes")
+            if "groups_scenes" in self.tables:
+                table, column, join = ("groups", "group_id", "groups_scenes")
+            for scene_id, name, date, scene_index in self._rows(
+                f"""SELECT {join}.scene_id, {table}.name, {table}.date, {join}.scene_index
+                FROM {join} JOIN {table} ON {table}.id = {join}.{column}
+                WHERE {join}.scene_id IN ({{ids}})""",
+                ids,
+            ):
+                scenes[scene_id]["movies"].append(
+                    {"movie": {"name": name, "date": date}, "scene_index": scene_index}
+                )
+        return list(scenes.values())
+
+    def get_scenes(self, scene_ids: list) -> dict:
+        """scene id -> scene (None if not found), like graphql_getScenes()."""
+        rows = self._rows(
+            f"SELECT {self._scene_columns()} FROM scenes WHERE id IN ({{ids}})",
+            [int(x) for x in scene_ids],
+        )
+        found = {scene["id"]: scene for scene in self.load(rows)}
+        return {scene_id: found.get(str(scene_id)) for scene_id in scene_ids}
+
+    def iter_scene_pages(self, page_size: int, limit=-1, updated_after=None):
+        """
+        Yield (total, scenes) like iter_scene_pages(), by updated_at.
+
+        Each page is its own query (keyset on updated_at, id), no read
+        transaction is left open while the renames are written.
+        """
+        where = ""
+        params = []
+        if updated_after:
+            where = "WHERE julianday(updated_at) > julianday(?)"
+            params = [updated_after]
+        total = select_db(self.conn, f"SELECT count(*) FROM scenes {where}", params)[0][0]
+        if limit >= 0:
+            total = min(total, limit)
+        log.LogDebug(f"Count scenes: {total}")
+        if page_size <= 0:
+            page_size = max(total, 1)
+        after = None
+        yielded = 0
+        while yielded < total:
+            conditions = [where[len("WHERE ") :]] if where else []
+            page_params = list(params)
+            if after is not None:
+                conditions.append("(updated_at, id) > (?, ?)")
+                page_params += after
+            rows = select_db(
+                self.conn,
+                f"SELECT {self._scene_columns()} FROM scenes"
+                + (f" WHERE {' AND '.join(conditions)}" if conditions else "")
+                + " ORDER BY updated_at, id LIMIT ?",
+                page_params + [min(page_size, total - yielded)],
+            )
+            if not rows:
                 break
-        if file_id:
-            # log.LogDebug(f"UPDATE files SET basename={scene_info['new_filename']}, parent_folder_id={folder_id}, updated_at={mod_time} WHERE id={file_id};")
-            cursor.execute(
+            after = [rows[-1][5], rows[-1][0]]
+            yielded += len(rows)
+            yield total, self.load(rows)
+
+
+class StashDBWriter:
+    """
+    Apply the database side of the renames in short, grouped transactions.
+
+    rename() only reads (so it can fail before anything is written) and queues
+    the changes. flush() writes the queued renames in one BEGIN IMMEDIATE
+    transaction, retried with backoff while Stash holds the lock. If it still
+    fails, the files of the batch are moved back.
+
+    Folders (path -> id) and scene files are kept in memory: bulk runs load
+    them with load_folders()/prefetch_files(), otherwise they are queried on
+    demand.
+    """
+
+    def __init__(self, path: str, batch_size=1, on_commit=None):
+        self.conn = connect_db(path, DB_TIMEOUT)
+        if self.conn is not None:
+            # transactions are handled by flush()
+            self.conn.isolation_level = None
+        self.batch_size = max(1, batch_size)
+        self.on_commit = on_commit
+        self.pending = []
+        self.new_folders = {}
+        self.next_folder_id = None
+        self.folders = {}
+        self.folders_loaded = False
+        self.files = {}
+        self.files_scenes = set()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _select(self, query: str, params=()) -> list:
+        return select_db(self.conn, query, params)
+
+    @PROFILER.timed("sqlite read")
+    def load_folders(self):
+        self.folders = {path: f_id for f_id, path in self._select("SELECT id, path FROM folders")}
+        self.folders_loaded = True
+        log.LogDebug(f"[SQLITE] {len(self.folders)} folders loaded")
+
+    @PROFILER.timed("sqlite read")
+    def prefetch_files(self, scene_ids: list):
+        # one joined query for a whole page of scenes (999 variables max)
+        self.files = {}
+        self.files_scenes = set(str(x) for x in scene_ids)
+        for i in range(0, len(scene_ids), 500):
+            chunk = scene_ids[i : i + 500]
+            for scene_id, file_id, folder_id, basename in self._select(
+                f"SELECT scenes_files.scene_id, files.id, files.parent_folder_id, files.basename FROM scenes_files JOIN files ON files.id = scenes_files.file_id WHERE scenes_files.scene_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ):
+                self.files[(str(scene_id), folder_id, basename)] = file_id
+
+    def _folder_id(self, path: str):
+        if path not in self.folders and not self.folders_loaded:
+            row = self._select("SELECT id FROM folders WHERE path=?", [path])
+            self.folders[path] = row[0][0] if row else None
+        return self.folders.get(path)
+
+    def _file_id(self, scene_id, folder_id, basename: str):
+        key = (str(scene_id), folder_id, basename)
+        if key not in self.files and str(scene_id) not in self.files_scenes:
+            row = self._select(
+                "SELECT files.id FROM scenes_files JOIN files ON files.id = scenes_files.file_id WHERE scenes_files.scene_id=? AND files.parent_folder_id=? AND files.basename=?",
+                [scene_id, folder_id, basename],
+            )
+            self.files[key] = row[0][0] if row else None
+        return self.files.get(key)
+
+    def rename(self, scene_info: dict) -> dict:
+        item = {"scene_info": scene_info, "moves": [], "mod_time": datetime.now().astimezone().isoformat("T", "seconds")}
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            self._resolve_refactor(item)
+        self.pending.append(item)
+        return item
+
+    def discard(self, item: dict):
+        # the file of a queued rename couldn't be moved
+        self.pending.remove(item)
+
+    def _resolve_refactor(self, item: dict):
+        scene_info = item["scene_info"]
+        # get the old folder id
+        old_folder_id = self._folder_id(scene_info["current_directory"])
+        # it can have multiple file for a scene, find the one in the old folder
+        file_id = self._file_id(
+            scene_info["scene_id"], old_folder_id, scene_info["current_filename"]
+        )
+        if not file_id:
+            raise Exception("Failed to find file_id")
+        item["file_id"] = file_id
+        # check if the folder of file is created in db
+        folder = scene_info["new_directory"]
+        item["folder_path"] = folder
+        if folder in self.new_folders or self._folder_id(folder) is not None:
+            return
+        # reduce the path to find a parent folder, every missing level is created
+        missing = [folder]
+        parent = folder
+        for _ in range(1, len(folder.split(os.sep))):
+            parent = os.path.dirname(parent)
+            if parent in self.new_folders or self._folder_id(parent) is not None:
+                break
+            missing.append(parent)
+        else:
+            raise Exception(
+                f"You need to setup a library with the new location ({folder}) and scan at least 1 file"
+            )
+        for path in reversed(missing):
+            self.new_folders[path] = os.path.dirname(path)
+
+    def flush_if_full(self):
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    @PROFILER.timed("sqlite write")
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        new_folders, self.new_folders = self.new_folders, {}
+        for attempt in range(DB_BUSY_RETRIES + 1):
+            try:
+                folder_ids = self._write(pending, new_folders)
+                break
+            except sqlite3.Error as err:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                if is_db_busy(err) and attempt < DB_BUSY_RETRIES:
+                    log.LogDebug(f"[SQLITE] Database busy, retrying ({attempt + 1})")
+                    time.sleep(min(0.05 * 2**attempt, 2))
+                    continue
+                log.LogError(
+                    f"error when trying to update the database ({err}), revert the move of {len(pending)} file(s)..."
+                )
+                self.revert(pending)
+                return
+        self.folders.update(folder_ids)
+        log.LogDebug(f"[SQLITE] {len(pending)} rename(s) committed")
+        if self.on_commit:
+            for item in pending:
+                self.on_commit(item)
+
+    def _write(self, pending: list, new_folders: dict) -> dict:
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        folder_ids = {}
+        if new_folders:
+            # the counter is read once per transaction, not per folder
+            cursor.execute("SELECT MAX(id) from folders")
+            max_id = cursor.fetchone()[0] or 0
+            if self.next_folder_id is None or self.next_folder_id <= max_id:
+                self.next_folder_id = max_id + 1
+            mod_time = pending[0]["mod_time"]
+            rows = []
+            # parents are always queued before their children
+            for path, parent in new_folders.items():
+                folder_ids[path] = self.next_folder_id
+                self.next_folder_id += 1
+                parent_id = folder_ids.get(parent) or self.folders[parent]
+                rows.append([folder_ids[path], path, parent_id, mod_time, mod_time, mod_time, None])
+            cursor.executemany(
+                "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
+                rows,
+            )
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            cursor.executemany(
                 "UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;",
-                [scene_info["new_filename"], folder_id, mod_time, file_id],
+                [
+                    [
+                        item["scene_info"]["new_filename"],
+                        folder_ids.get(item["folder_path"]) or self.folders[item["folder_path"]],
+                        item["mod_time"],
+                        item["file_id"],
+                    ]
+                    for item in pending
+                ],
             )
-            cursor.close()
-            stash_db.commit()
         else:
-            raise Exception("Failed to find file_id")
-    else:
+            cursor.executemany(
+                "UPDATE scenes SET path=? WHERE id=?;",
+                [
+                    [item["scene_info"]["final_path"], item["scene_info"]["scene_id"]]
+                    for item in pending
+                ],
+            )
+        cursor.execute("COMMIT")
         cursor.close()
-        raise Exception(
-            f"You need to setup a library with the new location ({scene_info['new_directory']}) and scan at least 1 file"
-        )
+        return folder_ids
+
+    def revert(self, pending: list):
+        # last move first: a file may have been moved where another one was
+        for item in reversed(pending):
+            scene_info = item["scene_info"]
+            for src, dst in reversed(item["moves"]):
+                move_associated(scene_info, dst, src)
+            if file_rename(scene_info["final_path"], scene_info["current_path"], scene_info):
+                log.LogError(f"[{scene_info['scene_id']}] Failed to revert the move")
+                continue
+            if PATH_INDEX is not None:
+                PATH_INDEX.move(
+                    scene_info["final_path"],
+                    scene_info["current_path"],
+                    scene_info["scene_id"],
+                )
 
 
-def file_rename(current_path: str, new_path: str, scene_info: dict):
-    # OS Rename
-    if not os.path.isfile(current_path):
-        log.LogWarning(f"[OS] File doesn't exist in your Disk/Drive ({current_path})")
-        return 1
-    # moving/renaming
-    new_dir = os.path.dirname(new_path)
-    current_dir = os.path.dirname(current_path)
-    if not os.path.exists(new_dir):
-        log.LogInfo(f"Creating folder because it don't exist ({new_dir})")
-        os.makedirs(new_dir)
+def move_file(current_path: str, new_path: str):
+    # returns 1 if a process or the permissions prevent the move
     try:
         shutil.move(current_path, new_path)
-    except PermissionError as err:
-        if "[WinError 32]" in str(err) and MODULE_PSUTIL:
+    except OSError as err:
+        if is_file_in_use(err):
             log.LogWarning(
                 "A process is using this file (Probably FFMPEG), trying to find it ..."
             )
@@ -1151,9 +3040,10 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
                 # Terminate the process then try again to rename
                 log.LogDebug(f"Process that uses this file: {process_use}")
                 if PROCESS_KILL:
-                    p = psutil.Process(process_use.pid)
-                    p.terminate()
-                    p.wait(10)
+                    if type(process_use) is not list:
+                        process_use = [process_use]
+                    for process in process_use:
+                        terminate_process(process)
                     # If process is not terminated, this will create an error again.
                     try:
                         shutil.move(current_path, new_path)
@@ -1165,25 +3055,74 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
                 else:
                     log.LogError("A process prevents renaming the file.")
                     return 1
-        else:
+        elif isinstance(err, PermissionError):
             log.LogError(f"Something prevents renaming the file. {err}")
             return 1
+        else:
+            raise
+
+
+def move_kind(current_path: str, new_path: str, scene_info=None) -> str:
+    # detail of the file_rename phase in the profile
+    try:
+        target_dev = os.stat(nearest_existing(os.path.dirname(new_path))).st_dev
+        same_device = os.stat(current_path).st_dev == target_dev
+    except OSError:
+        return "(missing file)"
+    return "(same device)" if same_device else "(cross device)"
+
+
+@PROFILER.timed("file_rename", move_kind)
+def file_rename(current_path: str, new_path: str, scene_info: dict):
+    # OS Rename
+    if not os.path.isfile(current_path):
+        log.LogWarning(f"[OS] File doesn't exist in your Disk/Drive ({current_path})")
+        return 1
+    # moving/renaming
+    new_dir = os.path.dirname(new_path)
+    current_dir = os.path.dirname(current_path)
+    if CREATED_FOLDERS is None or new_dir not in CREATED_FOLDERS:
+        if not os.path.exists(new_dir):
+            log.LogInfo(f"Creating folder because it don't exist ({new_dir})")
+            # exist_ok: the plan executor moves several files at the same time
+            os.makedirs(new_dir, exist_ok=True)
+        if CREATED_FOLDERS is not None:
+            # no folder is removed before the end of the run
+            CREATED_FOLDERS.add(new_dir)
+    entry = None
+    if JOURNAL is not None:
+        try:
+            entry = JOURNAL.add(scene_info, current_path, new_path)
+        except OSError as err:
+            log.LogError(f"Could not write the journal, the file isn't moved ({err})")
+            return 1
+    try:
+        err = move_file(current_path, new_path)
+    except Exception:
+        if entry is not None:
+            JOURNAL.cancel(entry)
+        raise
+    if err:
+        if entry is not None:
+            JOURNAL.cancel(entry)
+        return 1
     # checking if the move/rename work correctly
     if os.path.isfile(new_path):
         log.LogInfo(f"[OS] File Renamed! ({current_path} -> {new_path})")
-        if LOGFILE:
+        if entry is not None:
             try:
-                with open(LOGFILE, "a", encoding="utf-8") as f:
-                    f.write(
-                        f"{scene_info['scene_id']}|{current_path}|{new_path}|{scene_info['oshash']}\n"
-                    )
+                JOURNAL.done(entry)
             except Exception as err:
                 shutil.move(new_path, current_path)
+                JOURNAL.cancel(entry)
                 log.LogError(
                     f"Restoring the original path, error writing the logfile: {err}"
                 )
                 return 1
-        if REMOVE_EMPTY_FOLDER:
+        if REMOVE_EMPTY_FOLDER and EMPTY_FOLDERS is not None:
+            # another move can still go in this folder, checked at the end
+            EMPTY_FOLDERS.add(current_dir)
+        elif REMOVE_EMPTY_FOLDER:
             with os.scandir(current_dir) as it:
                 if not any(it):
                     log.LogInfo(f"Removing empty folder ({current_dir})")
@@ -1196,33 +3135,177 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
     else:
         # I don't think it's possible.
         log.LogError(f"[OS] Failed to rename the file ? {new_path}")
+        if entry is not None:
+            JOURNAL.cancel(entry)
         return 1
 
 
-def associated_rename(scene_info: dict):
-    if ASSOCIATED_EXT:
-        for ext in ASSOCIATED_EXT:
-            p = os.path.splitext(scene_info["current_path"])[0] + "." + ext
-            p_new = os.path.splitext(scene_info["final_path"])[0] + "." + ext
-            if os.path.isfile(p):
-                try:
-                    shutil.move(p, p_new)
-                except Exception as err:
-                    log.LogError(
-                        f"Something prevents renaming this file '{p}' - err: {err}"
-                    )
-                    continue
-            if os.path.isfile(p_new):
-                log.LogInfo(f"[OS] Associate file renamed ({p_new})")
-                if LOGFILE:
-                    try:
-                        with open(LOGFILE, "a", encoding="utf-8") as f:
-                            f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
-                    except Exception as err:
-                        shutil.move(p_new, p)
-                        log.LogError(
-                            f"Restoring the original name, error writing the logfile: {err}"
-                        )
+# flag and language parts of a subtitle name: movie.en.srt, movie.pt-BR.forced.srt
+RE_SIDECAR_FLAG = re.compile(r"\.(?:forced|sdh|cc|hi)$", re.IGNORECASE)
+RE_SIDECAR_LANGUAGE = re.compile(r"\.[a-z]{2,3}(?:[-_][a-z0-9]{2,4})?$", re.IGNORECASE)
+
+
+class SidecarIndex:
+    """
+    Associated files (associated_extension) of the folders, listed once:
+    folder -> ({lowercase stem: [(name, suffix)]}, {lowercase stems of the
+    other files}). The suffix is what follows the stem of the video in the
+    name of the file ('.srt', '.en.SRT'...).
+
+    A language suffix is only taken as such when no other file of the folder
+    has the longer stem: with Scene.mp4 and Scene.HD.mp4, Scene.HD.srt goes
+    with Scene.HD.mp4 only.
+
+    The tasks keep the same index for the whole run (SIDECAR_INDEX), the
+    moves update it.
+    """
+
+    def __init__(self, extensions: list):
+        self.extensions = {ext.lower().lstrip(".") for ext in extensions}
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def scan(self, folder: str) -> tuple:
+        stems = {}
+        others = set()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if not entry.is_file():
+                        continue
+                    base, ext = os.path.splitext(entry.name)
+                    if ext[1:].lower() in self.extensions:
+                        self._add(stems, entry.name, base)
+                    else:
+                        others.add(base.lower())
+        except OSError:
+            pass
+        return stems, others
+
+    @staticmethod
+    def _add(stems: dict, name: str, base: str):
+        # the stem of the file, then without its flag, then without its language
+        bases = [base]
+        for regex in (RE_SIDECAR_FLAG, RE_SIDECAR_LANGUAGE):
+            part = regex.search(bases[-1])
+            if part and part.start():
+                bases.append(bases[-1][: part.start()])
+        for base in dict.fromkeys(bases):
+            stems.setdefault(base.lower(), []).append((name, name[len(base) :]))
+
+    @staticmethod
+    def _other_owner(others: set, stem: str, name: str) -> bool:
+        # Scene.HD.en.srt found for Scene.mp4: does a Scene.HD.* or a
+        # Scene.HD.en.* file take it
+        base = os.path.splitext(name)[0].lower()
+        if base == stem:
+            return False
+        longer = stem
+        for part in base[len(stem) + 1 :].split("."):
+            longer = f"{longer}.{part}"
+            if longer in others:
+                return True
+        return False
+
+    def _folder(self, folder: str) -> tuple:
+        with self.lock:
+            index = self.folders.get(folder)
+        if index is None:
+            index = self.scan(folder)
+            with self.lock:
+                index = self.folders.setdefault(folder, index)
+        return index
+
+    def find(self, video_path: str) -> list:
+        """(path, suffix) of the associated files of a video."""
+        folder, name = os.path.split(video_path)
+        stems, others = self._folder(folder)
+        stem = os.path.splitext(name)[0].lower()
+        with self.lock:
+            found = [
+                (file_name, suffix)
+                for file_name, suffix in stems.get(stem, [])
+                if not self._other_owner(others, stem, file_name)
+            ]
+        return [(os.path.join(folder, file_name), suffix) for file_name, suffix in found]
+
+    def moved(self, old: str, new: str):
+        """Update the index after the move of a file (associated or not)."""
+        old_folder, old_name = os.path.split(old)
+        new_folder, new_name = os.path.split(new)
+        old_base, ext = os.path.splitext(old_name)
+        new_base = os.path.splitext(new_name)[0]
+        sidecar = ext[1:].lower() in self.extensions
+        with self.lock:
+            index = self.folders.get(old_folder)
+            if index is not None and sidecar:
+                stems = index[0]
+                for key in list(stems):
+                    files = [x for x in stems[key] if x[0] != old_name]
+                    if files:
+                        stems[key] = files
+                    else:
+                        del stems[key]
+            elif index is not None:
+                index[1].discard(old_base.lower())
+            index = self.folders.get(new_folder)
+            if index is not None and sidecar:
+                self._add(index[0], new_name, new_base)
+            elif index is not None:
+                index[1].add(new_base.lower())
+
+
+# tasks: associated files of the folders seen during the run
+SIDECAR_INDEX = None
+
+
+def move_associated(scene_info: dict, p: str, p_new: str) -> bool:
+    entry = None
+    if JOURNAL is not None:
+        try:
+            entry = JOURNAL.add(scene_info, p, p_new, associated=True)
+        except OSError as err:
+            log.LogError(f"Could not write the journal, '{p}' isn't moved ({err})")
+            return False
+    try:
+        shutil.move(p, p_new)
+    except Exception as err:
+        log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
+        if entry is not None:
+            JOURNAL.cancel(entry)
+        return False
+    if entry is not None:
+        try:
+            JOURNAL.done(entry)
+        except Exception as err:
+            shutil.move(p_new, p)
+            JOURNAL.cancel(entry)
+            log.LogError(
+                f"Restoring the original name, error writing the logfile: {err}"
+            )
+            return False
+    return True
+
+
+@PROFILER.timed("associated files")
+def associated_rename(scene_info: dict) -> list:
+    # returns the (old, new) paths moved, to be able to move them back
+    moved = []
+    if not ASSOCIATED_EXT:
+        return moved
+    index = SIDECAR_INDEX
+    if index is None:
+        index = SidecarIndex(ASSOCIATED_EXT)
+    new_stem = os.path.splitext(scene_info["final_path"])[0]
+    for p, suffix in index.find(scene_info["current_path"]):
+        p_new = new_stem + suffix
+        if not move_associated(scene_info, p, p_new):
+            continue
+        log.LogInfo(f"[OS] Associate file renamed ({p_new})")
+        moved.append((p, p_new))
+        index.moved(p, p_new)
+    index.moved(scene_info["current_path"], scene_info["final_path"])
+    return moved
 
 
 def renamer(scene_id, db_conn=None):
@@ -1259,207 +3342,1049 @@ def renamer(scene_id, db_conn=None):
     else:
         scene_files = []
     stash_db = None
-    for i in range(0, len(scene_files)):
-        scene_file = scene_files[i]
-        # refractor file support
-        for f in scene_file["fingerprints"]:
-            if f.get("oshash"):
-                stash_scene["oshash"] = f["oshash"]
-            if f.get("md5"):
-                stash_scene["checksum"] = f["md5"]
-            if f.get("checksum"):
-                stash_scene["checksum"] = f["checksum"]
-        stash_scene["path"] = scene_file["path"]
-        stash_scene["file"] = scene_file
-        if scene_file.get("bit_rate"):
-            stash_scene["file"]["bit_rate"] = scene_file["bit_rate"]
-        if scene_file.get("frame_rate"):
-            stash_scene["file"]["framerate"] = scene_file["frame_rate"]
-
-        # Tags > Studios > Default
-        template = {}
-        template["filename"] = get_template_filename(stash_scene)
-        template["path"] = get_template_path(stash_scene)
-        if not template["path"].get("destination"):
-            if config.p_use_default_template:
-                log.LogDebug("[PATH] Using default template")
-                template["path"] = {
-                    "destination": config.p_default_template,
-                    "option": [],
-                    "opt_details": {},
-                }
+    # the moves of the files already renamed are written even when a next
+    # file aborts the scene (duplicate, error...)
+    try:
+        for i in range(0, len(scene_files)):
+            scene_file = scene_files[i]
+            # refractor file support
+            for f in scene_file.get("fingerprints", []):
+                if f.get("oshash"):
+                    stash_scene["oshash"] = f["oshash"]
+                if f.get("md5"):
+                    stash_scene["checksum"] = f["md5"]
+                if f.get("checksum"):
+                    stash_scene["checksum"] = f["checksum"]
+            if scene_file.get("oshash"):
+                stash_scene["oshash"] = scene_file["oshash"]
+            stash_scene["path"] = scene_file["path"]
+            stash_scene["file"] = scene_file
+            if scene_file.get("bit_rate"):
+                stash_scene["file"]["bit_rate"] = scene_file["bit_rate"]
+            if scene_file.get("frame_rate"):
+                stash_scene["file"]["framerate"] = scene_file["frame_rate"]
+
+            # Tags > Studios > Default
+            template = {}
+            template["filename"] = get_template_filename(stash_scene)
+            template["path"] = get_template_path(stash_scene)
+            if not template["path"].get("destination"):
+                if config.p_use_default_template:
+                    log.LogDebug("[PATH] Using default template")
+                    template["path"] = {
+                        "destination": config.p_default_template,
+                        "option": [],
+                        "opt_details": {},
+                    }
+                else:
+                    template["path"] = None
             else:
-                template["path"] = None
-        else:
-            if template["path"].get("option"):
-                if "dry_run" in template["path"]["option"] and not DRY_RUN:
-                    log.LogInfo("Dry-Run on (activate by option)")
-                    option_dryrun = True
-        if not template["filename"] and config.use_default_template:
-            log.LogDebug("[FILENAME] Using default template")
-            template["filename"] = config.default_template
-
-        if not template["filename"] and not template["path"]:
-            log.LogWarning(f"[{scene_id}] No template for this scene.")
-            return
+                if template["path"].get("option"):
+                    if "dry_run" in template["path"]["option"] and not DRY_RUN:
+                        log.LogInfo("Dry-Run on (activate by option)")
+                        option_dryrun = True
+            if not template["filename"] and config.use_default_template:
+                log.LogDebug("[FILENAME] Using default template")
+                template["filename"] = config.default_template
+
+            if not template["filename"] and not template["path"]:
+                log.LogWarning(f"[{scene_id}] No template for this scene.")
+                return
+
+            # log.LogDebug("Using this template: {}".format(filename_template))
+            scene_information = extract_info(stash_scene, template)
+            log.LogDebug(f"[{scene_id}] Scene information: {scene_information}")
+            log.LogDebug(f"[{scene_id}] Template: {template}")
 
-        # log.LogDebug("Using this template: {}".format(filename_template))
-        scene_information = extract_info(stash_scene, template)
-        log.LogDebug(f"[{scene_id}] Scene information: {scene_information}")
-        log.LogDebug(f"[{scene_id}] Template: {template}")
+            scene_information["scene_id"] = scene_id
+            scene_information["file_index"] = i
 
-        scene_information["scene_id"] = scene_id
-        scene_information["file_index"] = i
+            shorten_new_path(scene_information, template)
 
-        for removed_field in ORDER_SHORTFIELD:
-            if removed_field:
-                if scene_information.get(removed_field.replace("$", "")):
-                    del scene_information[removed_field.replace("$", "")]
-                    log.LogWarning(f"removed {removed_field} to reduce the length path")
+            if check_longpath(scene_information["final_path"]):
+                if (DRY_RUN or option_dryrun) and LOGFILE:
+                    with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
+                        f.write(
+                            f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}\n"
+                        )
+                continue
+
+            # log.LogDebug(f"Filename: {scene_information['current_filename']} -> {scene_information['new_filename']}")
+            # log.LogDebug(f"Path: {scene_information['current_directory']} -> {scene_information['new_directory']}")
+
+            if scene_information["final_path"] == scene_information["current_path"]:
+                log.LogDebug(f"Everything is ok. ({scene_information['current_filename']})")
+                if RENDERED is not None:
+                    RENDERED.setdefault(str(scene_id), []).append(
+                        scene_information["final_path"]
+                    )
+                continue
+
+            if scene_information["current_directory"] != scene_information["new_directory"]:
+                log.LogInfo("File will be moved to another directory")
+                log.LogDebug(f"[OLD path] {scene_information['current_path']}")
+                log.LogDebug(f"[NEW path] {scene_information['final_path']}")
+
+            if scene_information["current_filename"] != scene_information["new_filename"]:
+                log.LogInfo("The filename will be changed")
+                if ALT_DIFF_DISPLAY:
+                    find_diff_text(
+                        scene_information["current_filename"],
+                        scene_information["new_filename"],
+                    )
                 else:
-                    continue
-            if template["filename"]:
+                    log.LogDebug(f"[OLD filename] {scene_information['current_filename']}")
+                    log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
+
+            # a plan doesn't move anything, the dry-run setting is for the hook/bulk
+            if (DRY_RUN and PLAN is None or option_dryrun) and LOGFILE:
+                with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
+                    f.write(
+                        f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n"
+                    )
+                continue
+            # check if there is already a file where the new path is
+            err = checking_duplicate_db(scene_information)
+            while err and scene_information["file_index"] <= len(DUPLICATE_SUFFIX):
+                log.LogDebug("Duplicate filename detected, increasing file index")
+                scene_information["file_index"] = scene_information["file_index"] + 1
                 scene_information["new_filename"] = create_new_filename(
                     scene_information, template["filename"]
                 )
-            else:
-                scene_information["new_filename"] = scene_information[
-                    "current_filename"
-                ]
-            if template.get("path"):
-                scene_information["new_directory"] = create_new_path(
-                    scene_information, template
+                scene_information["final_path"] = os.path.join(
+                    scene_information["new_directory"], scene_information["new_filename"]
                 )
+                log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
+                log.LogDebug(f"[NEW path] {scene_information['final_path']}")
+                err = checking_duplicate_db(scene_information)
+            # abort
+            if err:
+                raise Exception("duplicate")
+            if RENDERED is not None:
+                RENDERED.setdefault(str(scene_id), []).append(
+                    scene_information["final_path"]
+                )
+            if PLAN is not None:
+                PLAN.add(scene_information, template, i == 0)
+                continue
+            # connect to the db
+            if not db_conn:
+                if stash_db is None:
+                    stash_db = StashDBWriter(STASH_DATABASE, on_commit=after_db_commit)
+                if stash_db.conn is None:
+                    return
             else:
-                scene_information["new_directory"] = scene_information[
-                    "current_directory"
-                ]
-            scene_information["final_path"] = os.path.join(
-                scene_information["new_directory"], scene_information["new_filename"]
+                stash_db = db_conn
+            try:
+                # rename file on your disk
+                err = file_rename(
+                    scene_information["current_path"],
+                    scene_information["final_path"],
+                    scene_information,
+                )
+                if err:
+                    raise Exception("rename")
+                # rename file on your db (written when the batch is flushed)
+                try:
+                    pending = stash_db.rename(scene_information)
+                except Exception as err:
+                    log.LogError(
+                        f"error when trying to update the database ({err}), revert the move..."
+                    )
+                    err = file_rename(
+                        scene_information["final_path"],
+                        scene_information["current_path"],
+                        scene_information,
+                    )
+                    if err:
+                        raise Exception("rename")
+                    raise Exception("database update")
+                if PATH_INDEX is not None:
+                    PATH_INDEX.move(
+                        scene_information["current_path"],
+                        scene_information["final_path"],
+                        scene_information["scene_id"],
+                    )
+                if i == 0:
+                    pending["moves"].extend(associated_rename(scene_information))
+                if template.get("path"):
+                    if "clean_tag" in template["path"]["option"]:
+                        pending["clean_tag"] = template["path"]["opt_details"]["clean_tag"]
+                pending["bulk"] = bool(db_conn)
+            except Exception as err:
+                log.LogError(f"Error during database operation ({err})")
+                continue
+    finally:
+        if not db_conn and stash_db:
+            stash_db.flush()
+            stash_db.close()
+            log.LogInfo("[SQLITE] Database updated and closed!")
+
+
+def after_db_commit(item: dict):
+    # Tags are removed once the new path is saved
+    if item.get("clean_tag"):
+        if item.get("bulk"):
+            queue_removeScenesTag(item["scene_info"]["scene_id"], item["clean_tag"])
+        else:
+            graphql_removeScenesTag(
+                [item["scene_info"]["scene_id"]], item["clean_tag"]
             )
-            # check length of path
-            if IGNORE_PATH_LENGTH or len(scene_information["final_path"]) <= 240:
-                break
 
-        if check_longpath(scene_information["final_path"]):
-            if (DRY_RUN or option_dryrun) and LOGFILE:
-                with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
-                    f.write(
-                        f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}\n"
-                    )
-            continue
 
-        # log.LogDebug(f"Filename: {scene_information['current_filename']} -> {scene_information['new_filename']}")
-        # log.LogDebug(f"Path: {scene_information['current_directory']} -> {scene_information['new_directory']}")
+class BulkState:
+    """
+    What the previous bulk runs checked, in a SQLite file next to the plugin:
+    the newest updated_at seen (the watermark) and, for each scene, a digest
+    of its fields. The next run only asks Stash for the scenes updated since
+    the watermark and skips the ones with the same digest; the scenes whose
+    rename failed are asked again by id.
+
+    Everything is checked again when the config, the plugin, the database
+    version or the studio tree changed (config_digest).
+    """
 
-        if scene_information["final_path"] == scene_information["current_path"]:
-            log.LogDebug(f"Everything is ok. ({scene_information['current_filename']})")
-            continue
+    # scenes updated in the same second as the watermark are asked again
+    OVERLAP = 60
 
-        if scene_information["current_directory"] != scene_information["new_directory"]:
-            log.LogInfo("File will be moved to another directory")
-            log.LogDebug(f"[OLD path] {scene_information['current_path']}")
-            log.LogDebug(f"[NEW path] {scene_information['final_path']}")
-
-        if scene_information["current_filename"] != scene_information["new_filename"]:
-            log.LogInfo("The filename will be changed")
-            if ALT_DIFF_DISPLAY:
-                find_diff_text(
-                    scene_information["current_filename"],
-                    scene_information["new_filename"],
-                )
-            else:
-                log.LogDebug(f"[OLD filename] {scene_information['current_filename']}")
-                log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
+    def __init__(self, path: str, config_digest: str, full=False):
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scenes (scene_id INTEGER PRIMARY KEY, digest TEXT NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS retry (scene_id INTEGER PRIMARY KEY)"
+        )
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        self.watermark = None
+        self.digests = {}
+        if full or meta.get("config") != config_digest:
+            # the digests were made with another config
+            self.conn.execute("DELETE FROM meta")
+            self.conn.execute("DELETE FROM scenes")
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('config', ?)", (config_digest,)
+            )
+        else:
+            self.watermark = meta.get("watermark")
+            self.digests = dict(
+                self.conn.execute("SELECT scene_id, digest FROM scenes")
+            )
 
-        if (DRY_RUN or option_dryrun) and LOGFILE:
-            with open(DRY_RUN_FILE, "a", encoding="utf-8") as f:
-                f.write(
-                    f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n"
-                )
-            continue
-        # check if there is already a file where the new path is
-        err = checking_duplicate_db(scene_information)
-        while err and scene_information["file_index"] <= len(DUPLICATE_SUFFIX):
-            log.LogDebug("Duplicate filename detected, increasing file index")
-            scene_information["file_index"] = scene_information["file_index"] + 1
-            scene_information["new_filename"] = create_new_filename(
-                scene_information, template["filename"]
+    def close(self):
+        self.conn.close()
+
+    def since(self):
+        """updated_at of the scenes to ask for, None for all the scenes."""
+        if not self.watermark:
+            return None
+        since = datetime.fromisoformat(self.watermark).timestamp() - self.OVERLAP
+        return datetime.fromtimestamp(since).astimezone().isoformat("T", "seconds")
+
+    def retry_ids(self) -> list:
+        if self.watermark is None:
+            return []
+        return [row[0] for row in self.conn.execute("SELECT scene_id FROM retry")]
+
+    @staticmethod
+    def digest(scene: dict) -> str:
+        fields = {key: value for key, value in scene.items() if key != "updated_at"}
+        return hashlib.sha1(
+            json.dumps(fields, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+
+    def unchanged(self, scene_id, digest: str) -> bool:
+        return self.digests.get(int(scene_id)) == digest
+
+    def save(self, checked: dict, failed: set, watermark):
+        """Save a page: scene id -> digest of the scenes checked."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = [(int(x), d) for x, d in checked.items() if x not in failed]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scenes (scene_id, digest) VALUES (?, ?)", done
             )
-            scene_information["final_path"] = os.path.join(
-                scene_information["new_directory"], scene_information["new_filename"]
+            self.conn.executemany(
+                "DELETE FROM retry WHERE scene_id = ?", [(x,) for x, _ in done]
             )
-            log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
-            log.LogDebug(f"[NEW path] {scene_information['final_path']}")
-            err = checking_duplicate_db(scene_information)
-        # abort
-        if err:
-            raise Exception("duplicate")
-        # connect to the db
-        if not db_conn:
-            stash_db = connect_db(STASH_DATABASE)
-            if stash_db is None:
-                return
+            self.conn.executemany(
+                "DELETE FROM scenes WHERE scene_id = ?", [(int(x),) for x in failed]
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO retry (scene_id) VALUES (?)",
+                [(int(x),) for x in failed],
+            )
+            if watermark and (
+                self.watermark is None
+                or datetime.fromisoformat(watermark)
+                > datetime.fromisoformat(self.watermark)
+            ):
+                self.watermark = watermark
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('watermark', ?)",
+                    (watermark,),
+                )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.digests.update(done)
+
+
+def bulk_config_digest() -> str:
+    digest = hashlib.sha1()
+    for path in (config.__file__, __file__):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    digest.update(
+        json.dumps([DB_VERSION, STUDIO_CACHE.studios], sort_keys=True).encode()
+    )
+    return digest.hexdigest()
+
+
+# bulk runs with a BulkState: scene id -> paths the files must have
+RENDERED = None
+
+
+def rendered_failed(checked: dict) -> set:
+    """Scenes of checked whose files aren't where they were rendered."""
+    failed = set()
+    for scene_id in checked:
+        for path in RENDERED.pop(scene_id, []):
+            if scene_id not in PATH_INDEX.owners(path):
+                failed.add(scene_id)
+    return failed
+
+
+# only used by the task 'Plan renames'
+PLAN = None
+# tasks: folders left by the moves, removed once every file is moved
+EMPTY_FOLDERS = None
+# tasks: destination folders known to exist
+CREATED_FOLDERS = None
+
+
+def remove_empty_folders(folders: set):
+    """
+    Remove the folders left empty by the moves of a task, deepest first, then
+    their parents that became empty, up to the library folders of Stash.
+    """
+    roots = {
+        os.path.normcase(os.path.normpath(root)) for root in STASH_INFO.library_roots
+    }
+
+    def in_library(folder: str) -> bool:
+        folder = os.path.normcase(folder)
+        return folder not in roots and any(
+            folder.startswith(os.path.join(root, "")) for root in roots
+        )
+
+    pending = [(-folder.count(os.sep), folder) for folder in folders]
+    heapq.heapify(pending)
+    seen = set(folders)
+    while pending:
+        folder = heapq.heappop(pending)[1]
+        if os.path.normcase(os.path.normpath(folder)) in roots:
+            continue
+        try:
+            with os.scandir(folder) as it:
+                if any(it):
+                    continue
+            log.LogInfo(f"Removing empty folder ({folder})")
+            os.rmdir(folder)
+        except FileNotFoundError:
+            continue
+        except OSError as err:
+            log.LogWarning(f"Fail to delete empty folder {folder} - {err}")
+            continue
+        parent = os.path.dirname(folder)
+        if parent not in seen and in_library(parent):
+            seen.add(parent)
+            heapq.heappush(pending, (-parent.count(os.sep), parent))
+
+
+def nearest_existing(path: str) -> str:
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def temporary_name(path: str) -> str:
+    n = 0
+    temp = f"{path}.renamer-tmp"
+    while os.path.exists(temp):
+        n += 1
+        temp = f"{path}.renamer-tmp{n}"
+    return temp
+
+
+class RenamePlan:
+    """
+    Moves found by the task 'Plan renames', written in a JSON lines file (a
+    header, then one move per line) to be reviewed before the task 'Apply
+    plan' does them.
+    """
+
+    def __init__(self):
+        self.moves = []
+
+    def add(self, scene_info: dict, template: dict, associated: bool):
+        source = scene_info["current_path"]
+        target = scene_info["final_path"]
+        try:
+            source_stat = os.stat(source)
+        except OSError:
+            log.LogWarning(f"[OS] File doesn't exist in your Disk/Drive ({source})")
+            return
+        target_dev = os.stat(nearest_existing(os.path.dirname(target))).st_dev
+        same_device = source_stat.st_dev == target_dev
+        clean_tag = None
+        if template.get("path") and "clean_tag" in template["path"]["option"]:
+            clean_tag = template["path"]["opt_details"]["clean_tag"]
+        self.moves.append(
+            {
+                "scene_id": scene_info["scene_id"],
+                "source": source,
+                "target": target,
+                "same_device": same_device,
+                # a move on the same device is a rename, nothing is copied
+                "bytes": 0 if same_device else source_stat.st_size,
+                "associated": associated,
+                "clean_tag": clean_tag,
+                "oshash": scene_info.get("oshash"),
+            }
+        )
+        # the next scenes are checked against the planned paths
+        if PATH_INDEX is not None:
+            PATH_INDEX.move(source, target, scene_info["scene_id"])
+
+    def write(self, path: str):
+        order_plan(self.moves)
+        cross_device = [move for move in self.moves if not move["same_device"]]
+        header = {
+            "created": datetime.now().astimezone().isoformat("T", "seconds"),
+            "database": STASH_DATABASE,
+            "moves": len(self.moves),
+            "cross_device": len(cross_device),
+            "bytes": sum(move["bytes"] for move in cross_device),
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            for move in self.moves:
+                f.write(json.dumps(move, ensure_ascii=False) + "\n")
+        log.LogInfo(
+            f"[Plan] {header['moves']} moves, {header['cross_device']} to another device ({round(header['bytes'] / 1024**3, 2)} GB to copy), written in {path}"
+        )
+
+
+def read_plan(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    if not lines:
+        return {}, []
+    return json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+
+
+def order_plan(moves: list) -> list:
+    """
+    Set on each move the source of the move it waits for ('after': its target
+    is still used by that file) and, for the moves going round in a cycle
+    (swaps...), a temporary name ('temp') to free the source of the first
+    one. Return the step of each move, the moves of a step only wait for the
+    moves of the previous steps.
+    """
+    sources = {
+        os.path.normcase(move["source"]): i for i, move in enumerate(moves)
+    }
+    after = []
+    for i, move in enumerate(moves):
+        move["temp"] = None
+        j = sources.get(os.path.normcase(move["target"]))
+        after.append(None if j == i else j)
+    # follow the waits from each move, coming back to a move of the same
+    # walk is a cycle
+    state = [0] * len(moves)
+    for i in range(len(moves)):
+        walk = []
+        j = i
+        while j is not None and not state[j]:
+            state[j] = 1
+            walk.append(j)
+            j = after[j]
+        if j is not None and state[j] == 1:
+            # the move that closes the cycle waits for j, the file of j is
+            # moved out of the way first
+            moves[j]["temp"] = temporary_name(moves[j]["source"])
+            after[walk[-1]] = None
+        for k in walk:
+            state[k] = 2
+    steps = [None] * len(moves)
+    for i in range(len(moves)):
+        chain = []
+        j = i
+        while j is not None and steps[j] is None:
+            chain.append(j)
+            j = after[j]
+        step = -1 if j is None else steps[j]
+        for k in reversed(chain):
+            step += 1
+            steps[k] = step
+    for move, j in zip(moves, after):
+        move["after"] = None if j is None else moves[j]["source"]
+    return steps
+
+
+def plan_scene_info(move: dict) -> dict:
+    current_directory, current_filename = os.path.split(move["source"])
+    new_directory, new_filename = os.path.split(move["target"])
+    return {
+        "scene_id": move["scene_id"],
+        "current_path": move["source"],
+        "current_directory": current_directory,
+        "current_filename": current_filename,
+        "final_path": move["target"],
+        "new_directory": new_directory,
+        "new_filename": new_filename,
+        "oshash": move.get("oshash"),
+    }
+
+
+def apply_move(move: dict, scene_info: dict):
+    # runs in the threads of the executor, returns the associated files moved
+    # or None if the file wasn't moved
+    origin = move["temp"] or move["source"]
+    if file_rename(origin, move["target"], scene_info):
+        if move["temp"] and not os.path.exists(move["source"]):
+            os.rename(move["temp"], move["source"])
+        elif move["temp"]:
+            log.LogError(f"[{move['scene_id']}] The file is left in {move['temp']}")
+        return None
+    if move["associated"]:
+        return associated_rename(scene_info)
+    return []
+
+
+def apply_plan_chunk(moves: list, stash_db: StashDBWriter, executor, failed: set):
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        stash_db.prefetch_files(sorted({int(move["scene_id"]) for move in moves}))
+    queued = []
+    for move in moves:
+        scene_id = move["scene_id"]
+        origin = move["temp"] or move["source"]
+        if move["after"] and os.path.normcase(move["after"]) in failed:
+            log.LogError(f"[{scene_id}] Not moved, {move['target']} wasn't freed")
+        elif not os.path.isfile(origin):
+            log.LogWarning(f"[OS] File doesn't exist in your Disk/Drive ({origin})")
+        elif os.path.exists(move["target"]) and not os.path.samefile(
+            origin, move["target"]
+        ):
+            log.LogError(f"[{scene_id}] There is already a file at {move['target']}")
+        elif (
+            move.get("verify")
+            and move.get("oshash")
+            and file_oshash(origin) != move["oshash"]
+        ):
+            log.LogError(f"[{scene_id}] Not moved, {origin} was replaced (oshash)")
         else:
-            stash_db = db_conn
+            scene_info = plan_scene_info(move)
+            try:
+                # checks the database before moving the file
+                item = stash_db.rename(scene_info)
+            except Exception as err:
+                log.LogError(f"[{scene_id}] Error during database operation ({err})")
+            else:
+                if move.get("clean_tag"):
+                    item["clean_tag"] = move["clean_tag"]
+                item["bulk"] = True
+                queued.append(
+                    (move, item, executor.submit(apply_move, move, scene_info))
+                )
+                continue
+        failed.add(os.path.normcase(move["source"]))
+    for move, item, future in queued:
         try:
-            # rename file on your disk
-            err = file_rename(
-                scene_information["current_path"],
-                scene_information["final_path"],
-                scene_information,
+            moved = future.result()
+        except Exception as err:
+            log.LogError(f"[{move['scene_id']}] Error during the move ({err})")
+            moved = None
+        if moved is None:
+            stash_db.discard(item)
+            failed.add(os.path.normcase(move["source"]))
+            continue
+        item["moves"].extend(moved)
+    stash_db.flush()
+
+
+def apply_plan(path: str):
+    if not os.path.isfile(path):
+        log.LogError(
+            f"No plan to apply, use the task 'Plan renames' first ({path})"
+        )
+        return
+    header, moves = read_plan(path)
+    if header.get("database") != STASH_DATABASE:
+        log.LogError(
+            f"The plan was made for another database ({header.get('database')})"
+        )
+        return
+    apply_moves(moves)
+
+
+def apply_moves(moves: list):
+    global HANDLE_CACHE, SIDECAR_INDEX, EMPTY_FOLDERS, CREATED_FOLDERS
+    # a reviewed plan can have been edited
+    targets = set()
+    checked = []
+    for move in moves:
+        target = os.path.normcase(move["target"])
+        if target in targets:
+            log.LogError(
+                f"[{move['scene_id']}] Not moved, another file goes to {move['target']}"
             )
-            if err:
-                raise Exception("rename")
-            # rename file on your db
+            continue
+        targets.add(target)
+        checked.append(move)
+    moves = checked
+    steps = order_plan(moves)
+    stash_db = StashDBWriter(
+        STASH_DATABASE, config.db_batch_size, on_commit=after_db_commit
+    )
+    if stash_db.conn is None:
+        return
+    HANDLE_CACHE = {}
+    SIDECAR_INDEX = SidecarIndex(ASSOCIATED_EXT)
+    EMPTY_FOLDERS = set()
+    CREATED_FOLDERS = set()
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        stash_db.load_folders()
+    failed = set()
+    for move in moves:
+        if move["temp"]:
             try:
-                if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
-                    db_rename_refactor(stash_db, scene_information)
-                else:
-                    db_rename(stash_db, scene_information)
-            except Exception as err:
+                os.rename(move["source"], move["temp"])
+            except OSError as err:
                 log.LogError(
-                    f"error when trying to update the database ({err}), revert the move..."
+                    f"[{move['scene_id']}] Could not free {move['source']} ({err})"
                 )
-                err = file_rename(
-                    scene_information["final_path"],
-                    scene_information["current_path"],
-                    scene_information,
+                move["temp"] = None
+                failed.add(os.path.normcase(move["source"]))
+    order = sorted(range(len(moves)), key=steps.__getitem__)
+    progress = 0
+    with ThreadPoolExecutor(max_workers=max(1, config.plan_workers)) as executor:
+        start = 0
+        while start < len(order):
+            # a step starts once the files of the previous step are moved
+            end = start
+            while end < len(order) and steps[order[end]] == steps[order[start]]:
+                end += 1
+            for i in range(start, end, stash_db.batch_size):
+                chunk = [
+                    moves[j]
+                    for j in order[i : min(end, i + stash_db.batch_size)]
+                    if os.path.normcase(moves[j]["source"]) not in failed
+                ]
+                apply_plan_chunk(chunk, stash_db, executor, failed)
+                progress += len(order[i : min(end, i + stash_db.batch_size)])
+                log.LogProgress(progress / len(order))
+            start = end
+    stash_db.flush()
+    flush_removeScenesTag()
+    stash_db.close()
+    remove_empty_folders(EMPTY_FOLDERS)
+    EMPTY_FOLDERS = CREATED_FOLDERS = None
+    log.LogInfo(f"{len(moves) - len(failed)}/{len(moves)} moves done")
+
+
+class HookQueue:
+    """
+    Scenes updated in Stash and waiting to be renamed, in a SQLite file next
+    to the plugin.
+
+    Each hook adds its scene (a scene updated again only gets a newer time)
+    and one of the hook processes becomes the drainer: it renames the
+    scenes queued for more than hook_debounce seconds, by batches, until
+    the queue is empty. A thread of the drainer updates its heartbeat, a
+    drainer that stopped doing it for 'stale' seconds is replaced by the next
+    hook.
+
+    The scenes of a batch are claimed (taken_by) and only deleted by their
+    drainer once renamed. A replaced drainer stops at its next batch, its
+    claimed scenes are taken again by the new one.
+    """
+
+    def __init__(self, path: str, debounce: float, stale=120):
+        self.path = path
+        self.debounce = debounce
+        self.stale = stale
+        self.pid = os.getpid()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue (scene_id INTEGER PRIMARY KEY, queued_at REAL NOT NULL, taken_by INTEGER, taken_at REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS drainer (id INTEGER PRIMARY KEY CHECK (id = 1), pid INTEGER, heartbeat REAL)"
+        )
+        # queue created by a previous version
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(queue)")]
+        for column, column_type in (("taken_by", "INTEGER"), ("taken_at", "REAL")):
+            if column not in columns:
+                try:
+                    self.conn.execute(f"ALTER TABLE queue ADD COLUMN {column} {column_type}")
+                except sqlite3.OperationalError:
+                    # added by another hook meanwhile
+                    pass
+
+    def close(self):
+        self.conn.close()
+
+    def push(self, scene_id: int) -> bool:
+        """Queue the scene, True if this process must drain the queue."""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # a claimed scene is queued again, unclaimed: it's renamed again
+            # with its new data
+            self.conn.execute(
+                "INSERT OR REPLACE INTO queue (scene_id, queued_at) VALUES (?, ?)",
+                (scene_id, now),
+            )
+            row = self.conn.execute("SELECT heartbeat FROM drainer").fetchone()
+            elected = row is None or row[0] < now - self.stale
+            if elected:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO drainer (id, pid, heartbeat) VALUES (1, ?, ?)",
+                    (self.pid, now),
                 )
-                if err:
-                    raise Exception("rename")
-                raise Exception("database update")
-            if i == 0:
-                associated_rename(scene_information)
-            if template.get("path"):
-                if "clean_tag" in template["path"]["option"]:
-                    graphql_removeScenesTag(
-                        [scene_information["scene_id"]],
-                        template["path"]["opt_details"]["clean_tag"],
-                    )
-        except Exception as err:
-            log.LogError(f"Error during database operation ({err})")
-            if not db_conn:
-                log.LogDebug("[SQLITE] Database closed")
-                stash_db.close()
-            continue
-    if not db_conn and stash_db:
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return elected
+
+    @contextmanager
+    def heartbeat(self):
+        """Update the heartbeat from a thread (with its own connection)."""
+        stop = threading.Event()
+
+        def beat():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            try:
+                while not stop.wait(self.stale / 4):
+                    try:
+                        conn.execute(
+                            "UPDATE drainer SET heartbeat = ? WHERE pid = ?",
+                            (time.time(), self.pid),
+                        )
+                    except sqlite3.Error as err:
+                        log.LogWarning(f"[Queue] Failed to update the heartbeat ({err})")
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def take(self, limit: int):
+        """
+        Claim the scenes ready to be renamed and return (scene ids, None),
+        ([], seconds to wait) if they are too recent, ([], None) if the queue
+        is empty, (None, None) if another process became the drainer.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT pid FROM drainer").fetchone()
+            if row is None or row[0] != self.pid:
+                self.conn.execute("COMMIT")
+                return None, None
+            # the scenes claimed by another pid are from a replaced drainer
+            ids = [
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT scene_id FROM queue WHERE queued_at <= ? AND taken_by IS NOT ? ORDER BY queued_at LIMIT ?",
+                    (now - self.debounce, self.pid, limit),
+                )
+            ]
+            self.conn.executemany(
+                "UPDATE queue SET taken_by = ?, taken_at = ? WHERE scene_id = ?",
+                [(self.pid, now, scene_id) for scene_id in ids],
+            )
+            if not ids:
+                row = self.conn.execute(
+                    "SELECT MIN(queued_at) FROM queue WHERE taken_by IS NOT ?",
+                    (self.pid,),
+                ).fetchone()
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        if ids:
+            return ids, None
+        if row[0] is None:
+            return [], None
+        return [], max(0.1, row[0] + self.debounce - now)
+
+    def done(self, scene_ids: list):
+        # only the scenes still claimed by this process, a scene queued again
+        # meanwhile or taken by a new drainer stays in the queue
+        self.conn.executemany(
+            "DELETE FROM queue WHERE scene_id = ? AND taken_by = ?",
+            [(scene_id, self.pid) for scene_id in scene_ids],
+        )
+
+    def release(self, force=False) -> bool:
+        """Stop being the drainer, only if the queue is empty (unless force)."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            empty = not self.conn.execute("SELECT 1 FROM queue LIMIT 1").fetchone()
+            if empty or force:
+                self.conn.execute("DELETE FROM drainer WHERE pid = ?", (self.pid,))
+                # the scenes not renamed can be claimed by the next drainer
+                self.conn.execute(
+                    "UPDATE queue SET taken_by = NULL, taken_at = NULL WHERE taken_by = ?",
+                    (self.pid,),
+                )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return empty or force
+
+
+def drain_hook_queue(hook_queue: HookQueue):
+    stash_db = StashDBWriter(
+        STASH_DATABASE, config.db_batch_size, on_commit=after_db_commit
+    )
+    if stash_db.conn is None:
+        hook_queue.release(force=True)
+        return
+    renamed = 0
+    try:
+        with hook_queue.heartbeat():
+            while True:
+                scene_ids, wait = hook_queue.take(config.db_batch_size)
+                if scene_ids is None:
+                    log.LogWarning("[Queue] Replaced by another process, stopping")
+                    break
+                if not scene_ids:
+                    if wait is None:
+                        if hook_queue.release():
+                            break
+                        continue
+                    # wait for the debounce window of the oldest scene
+                    time.sleep(wait)
+                    continue
+                log.LogDebug(f"[Queue] Renaming {len(scene_ids)} scenes")
+                scenes = graphql_getScenes(scene_ids)
+                if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+                    stash_db.prefetch_files(scene_ids)
+                for scene_id in scene_ids:
+                    scene = scenes.get(scene_id)
+                    if not scene:
+                        log.LogWarning(f"[{scene_id}] Scene not found")
+                        continue
+                    try:
+                        renamer(scene, stash_db)
+                    except Exception as err:
+                        log.LogError(f"main function error: {err}")
+                    stash_db.flush_if_full()
+                stash_db.flush()
+                flush_removeScenesTag()
+                hook_queue.done(scene_ids)
+                renamed += len(scene_ids)
+    except Exception:
+        hook_queue.release(force=True)
+        raise
+    finally:
         stash_db.close()
-        log.LogInfo("[SQLITE] Database updated and closed!")
+    log.LogInfo(f"[Queue] {renamed} scenes checked")
+
+
+def rename_from_hook(scene_id: int):
+    if not config.hook_queue:
+        renamer(scene_id)
+        return
+    hook_queue = HookQueue(
+        os.path.join(PLUGIN_DIR, "renamerOnUpdate_queue.sqlite"),
+        config.hook_debounce,
+    )
+    try:
+        if hook_queue.push(scene_id):
+            drain_hook_queue(hook_queue)
+        else:
+            log.LogDebug(f"[{scene_id}] Queued, another process renames the scenes")
+    finally:
+        hook_queue.close()
 
 
 def exit_plugin(msg=None, err=None):
     if msg is None and err is None:
         msg = "plugin ended"
+    PROFILER.report(os.path.join(PLUGIN_DIR, "renamerOnUpdate_trace.json"))
     log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
     output_json = {"output": msg, "error": err}
     print(json.dumps(output_json))
     sys.exit()
 
 
+def worker_files_mtime() -> tuple:
+    return (os.path.getmtime(config.__file__), os.path.getmtime(__file__))
+
+
+def handle_hook(fragment: dict):
+    hook = fragment["args"]["hookContext"]
+    # the session can change (Stash restarted...)
+    STASH_GRAPHQL.session.cookies.set(
+        "session", fragment["server_connection"]["SessionCookie"]["Value"]
+    )
+    if hook["type"].startswith("Studio."):
+        STUDIO_CACHE.invalidate()
+        return
+    if DRY_RUN and DRY_RUN_FILE and not config.dry_run_append:
+        if os.path.exists(DRY_RUN_FILE):
+            os.remove(DRY_RUN_FILE)
+    log.LogDebug("--Starting Hook 'Renamer'--")
+    try:
+        rename_from_hook(hook["id"])
+    except SystemExit:
+        pass
+    except Exception as err:
+        log.LogError(f"main function error: {err}")
+        traceback.print_exc()
+
+
+def serve_worker(fragment: dict):
+    """
+    Rename the scene of the hook, then keep renaming the scenes sent by the
+    next hooks until nothing comes for worker_idle_timeout seconds.
+    """
+    import fcntl
+    import queue
+
+    path = worker_socket_path(PLUGIN_DIR)
+    if path is None:
+        handle_hook(fragment)
+        return
+    lock_file = open(f"{path}.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # another worker was started at the same time
+        lock_file.close()
+        handle_hook(fragment)
+        return
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if os.path.lexists(path):
+            # left by a worker that was killed
+            os.remove(path)
+        server.bind(path)
+        server.listen(64)
+    except OSError as err:
+        log.LogWarning(f"[Worker] Could not listen on {path} ({err})")
+        server.close()
+        lock_file.close()
+        handle_hook(fragment)
+        return
+    hooks = queue.Queue()
+    state = {"running": True}
+    state_lock = threading.Lock()
+    files_mtime = worker_files_mtime()
+    connection = {
+        key: value
+        for key, value in fragment["server_connection"].items()
+        if key in ("Scheme", "Host", "Port", "PluginDir")
+    }
+
+    def stop():
+        # called with state_lock
+        if state["running"]:
+            state["running"] = False
+            try:
+                # wakes up accept()
+                server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            server.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            hooks.put(None)
+
+    def answer(client: socket.socket):
+        with client, client.makefile("rw", encoding="utf-8") as f:
+            try:
+                request = json.loads(f.readline())
+            except ValueError:
+                return
+            accepted = False
+            with state_lock:
+                if request.get("stop") or worker_files_mtime() != files_mtime:
+                    stop()
+                elif state["running"] and "fragment" in request:
+                    server_connection = request["fragment"]["server_connection"]
+                    if all(
+                        server_connection.get(key) == value
+                        for key, value in connection.items()
+                    ):
+                        hooks.put(request["fragment"])
+                        accepted = True
+                    else:
+                        # Stash moved, a new worker is needed
+                        stop()
+            f.write(json.dumps({"accepted": accepted}) + "\n")
+            f.flush()
+
+    def listen():
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                return
+            try:
+                if peer_uid(client) in (None, os.getuid()):
+                    answer(client)
+                else:
+                    client.close()
+            except OSError:
+                pass
+
+    threading.Thread(target=listen, daemon=True).start()
+    log.LogInfo(f"[Worker] Started (pid {os.getpid()})")
+    handle_hook(fragment)
+    while True:
+        try:
+            hook = hooks.get(timeout=config.worker_idle_timeout)
+        except queue.Empty:
+            with state_lock:
+                stop()
+            continue
+        if hook is None:
+            break
+        handle_hook(hook)
+    # hooks accepted before the stop
+    while not hooks.empty():
+        hook = hooks.get()
+        if hook is not None:
+            handle_hook(hook)
+    lock_file.close()
+    log.LogInfo("[Worker] Stopped")
+
+
 if PLUGIN_ARGS:
     log.LogDebug("--Starting Plugin 'Renamer'--")
-    if "bulk" not in PLUGIN_ARGS:
+    if PLUGIN_ARGS not in ("bulk", "full", "plan", "apply", "undo"):
         if "enable" in PLUGIN_ARGS:
             log.LogInfo("Enable hook")
             success = config_edit("enable_hook", True)
@@ -1475,22 +4400,35 @@ if PLUGIN_ARGS:
                 success = config_edit("dry_run", True)
         if not success:
             log.LogError("Script failed to change the value")
+        elif hasattr(socket, "AF_UNIX"):
+            # the worker has the old config
+            send_to_worker({"stop": True}, PLUGIN_DIR)
         exit_plugin("script finished")
 else:
+    FRAGMENT_HOOK_TYPE = FRAGMENT["args"]["hookContext"]["type"]
+    FRAGMENT_SCENE_ID = FRAGMENT["args"]["hookContext"]["id"]
+    if FRAGMENT_HOOK_TYPE.startswith("Studio."):
+        STUDIO_CACHE.invalidate()
+        exit_plugin("Studio cache cleared")
     if not config.enable_hook:
         exit_plugin("Hook disabled")
     log.LogDebug("--Starting Hook 'Renamer'--")
-    FRAGMENT_HOOK_TYPE = FRAGMENT["args"]["hookContext"]["type"]
-    FRAGMENT_SCENE_ID = FRAGMENT["args"]["hookContext"]["id"]
 
 LOGFILE = config.log_file
+JOURNAL_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_journal.jsonl")
+if config.rename_journal or LOGFILE:
+    JOURNAL = RenameJournal(JOURNAL_FILE if config.rename_journal else None, LOGFILE)
 
 # Gallery.Update.Post
 # if FRAGMENT_HOOK_TYPE == "Scene.Update.Post":
 
 
-STASH_CONFIG = graphql_getConfiguration()
-STASH_DATABASE = STASH_CONFIG["general"]["databasePath"]
+# database path and DB version, from the cache when possible
+STASH_INFO = StashInfoCache(
+    os.path.join(PLUGIN_DIR, "renamerOnUpdate_stash.json"), FRAGMENT_SERVER
+)
+STASH_INFO.load()
+STASH_DATABASE = STASH_INFO.database_path
 
 # READING CONFIG
 
@@ -1502,9 +4440,22 @@ FIELD_REPLACER = config.field_replacer
 FILENAME_ASTITLE = config.filename_as_title
 FILENAME_LOWER = config.lowercase_Filename
 FILENAME_TITLECASE = config.titlecase_Filename
+TITLE_CASER = TitleCaser(abbreviations=config.titlecase_abbreviations)
 FILENAME_SPLITCHAR = config.filename_splitchar
 FILENAME_REMOVECHARACTER = config.removecharac_Filename
+REMOVECHARACTER_TABLE, RE_REMOVECHARACTER = compile_remove_character(
+    FILENAME_REMOVECHARACTER
+)
+# illegal and removed characters in one table
+FILENAME_TABLE = dict(ILLEGAL_CHARACTER)
+FILENAME_TABLE.update(REMOVECHARACTER_TABLE or {})
 FILENAME_REPLACEWORDS = config.replace_words
+REPLACE_WORDS_STAGES = compile_replace_words(FILENAME_REPLACEWORDS)
+
+# template rules by tag and path, indexed once
+TAG_TEMPLATES = TemplateRules(config.tag_templates)
+P_TAG_TEMPLATES = TemplateRules(config.p_tag_templates)
+P_PATH_TEMPLATES = TemplateRules(config.p_path_templates)
 
 PERFORMER_SPLITCHAR = config.performer_splitchar
 PERFORMER_LIMIT = config.performer_limit
@@ -1531,6 +4482,9 @@ IGNORE_PATH_LENGTH = config.ignore_path_length
 PREVENT_CONSECUTIVE = config.prevent_consecutive
 REMOVE_EMPTY_FOLDER = config.remove_emptyfolder
 
+DB_TIMEOUT = config.db_timeout
+DB_BUSY_RETRIES = config.db_busy_retries
+
 PROCESS_KILL = config.process_kill_attach
 PROCESS_ALLRESULT = config.process_getall
 UNICODE_USE = config.use_ascii
@@ -1545,65 +4499,144 @@ PATH_KEEP_ALRPERF = config.path_keep_alrperf
 PATH_NON_ORGANIZED = config.p_non_organized
 PATH_ONEPERFORMER = config.path_one_performer
 
-DB_VERSION = graphql_getBuild()
-if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
-    FILE_QUERY = """
-            files {
-                path
-                video_codec
-                audio_codec
-                width
-                height
-                frame_rate
-                duration
-                bit_rate
-                phash: fingerprint(type: "phash")
-                oshash: fingerprint(type: "oshash")
-                checksum: fingerprint(type: "checksum")
-                fingerprints {
-                    type
-                    value
-                }
-            }
-    """
-else:
-    FILE_QUERY = """
-            path
-            file {
-                video_codec
-                audio_codec
-                width
-                height
-                framerate
-                bitrate
-                duration
-            }
-    """
-if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
-    FILE_QUERY = f"        code{FILE_QUERY}"
+DB_VERSION = STASH_INFO.db_version
+# only the fields of the scenes used by this config are asked
+SCENE_NEEDS = scene_needs()
+FILE_QUERY = build_file_query(DB_VERSION)
 
 if PLUGIN_ARGS:
-    if "bulk" in PLUGIN_ARGS:
-        scenes = graphql_findScene(config.batch_number_scene, "ASC")
-        log.LogDebug(f"Count scenes: {len(scenes['scenes'])}")
-        progress = 0
-        progress_step = 1 / len(scenes["scenes"])
-        stash_db = connect_db(STASH_DATABASE)
-        if stash_db is None:
+    if PLUGIN_ARGS == "plan":
+        PLAN = RenamePlan()
+    if PLUGIN_ARGS in ("bulk", "full", "plan"):
+        stash_db = StashDBWriter(
+            STASH_DATABASE, config.db_batch_size, on_commit=after_db_commit
+        )
+        if stash_db.conn is None:
             exit_plugin()
-        for scene in scenes["scenes"]:
-            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
-            try:
-                renamer(scene, stash_db)
-            except Exception as err:
-                log.LogError(f"main function error: {err}")
-            progress += progress_step
-            log.LogProgress(progress)
+        # the whole studio tree in one query, fresh for this run
+        STUDIO_CACHE.load(refresh=True)
+        bulk_state = None
+        if PLUGIN_ARGS != "plan" and config.bulk_incremental and not DRY_RUN:
+            bulk_state = BulkState(
+                os.path.join(PLUGIN_DIR, "renamerOnUpdate_state.sqlite"),
+                bulk_config_digest(),
+                full=PLUGIN_ARGS == "full",
+            )
+            RENDERED = {}
+        # known paths and folders, to check collisions and resolve the
+        # destination without asking Stash for each name
+        PATH_INDEX = PathIndex(stash_db.conn)
+        # processes using the files, looked for once per directory
+        HANDLE_CACHE = {}
+        # associated files, each folder is listed once
+        SIDECAR_INDEX = SidecarIndex(ASSOCIATED_EXT)
+        # folders created or emptied by the moves, the empty ones are removed
+        # at the end instead of after each move
+        EMPTY_FOLDERS = set()
+        CREATED_FOLDERS = set()
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            stash_db.load_folders()
+        progress = 0
+        skipped = 0
+        retry = bulk_state.retry_ids() if bulk_state else []
+        extra = 0
+        # the scenes are read in the database instead of asked to Stash
+        stash_reader = None
+        if config.bulk_sqlite_read and DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            stash_reader = StashDBReader(STASH_DATABASE)
+            if stash_reader.conn is None:
+                stash_reader = None
+        if stash_reader is not None:
+            pages = stash_reader.iter_scene_pages(
+                config.batch_page_size,
+                config.batch_number_scene,
+                updated_after=bulk_state.since() if bulk_state else None,
+            )
+        else:
+            pages = iter_scene_pages(
+                config.batch_page_size,
+                config.batch_number_scene,
+                updated_after=bulk_state.since() if bulk_state else None,
+            )
+        for total, scenes in pages:
+            if retry:
+                # scenes whose rename failed during the previous runs
+                page_ids = {scene["id"] for scene in scenes}
+                found = (
+                    stash_reader.get_scenes(retry)
+                    if stash_reader is not None
+                    else graphql_getScenes(retry)
+                )
+                retried = [
+                    scene
+                    for scene in found.values()
+                    if scene and scene["id"] not in page_ids
+                ]
+                scenes = retried + scenes
+                extra = len(retried)
+                retry = []
+            if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+                stash_db.prefetch_files([int(scene["id"]) for scene in scenes])
+            checked = {}
+            failed = set()
+            for scene in scenes:
+                progress += 1
+                if bulk_state is not None:
+                    digest = bulk_state.digest(scene)
+                    if bulk_state.unchanged(scene["id"], digest):
+                        skipped += 1
+                        log.LogProgress(progress / (total + extra))
+                        continue
+                    checked[scene["id"]] = digest
+                log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
+                try:
+                    renamer(scene, stash_db)
+                except Exception as err:
+                    log.LogError(f"main function error: {err}")
+                    failed.add(scene["id"])
+                stash_db.flush_if_full()
+                log.LogProgress(progress / (total + extra))
+            if bulk_state is not None:
+                # the renames are saved before checking where the files are
+                stash_db.flush()
+                failed |= rendered_failed(checked)
+                updated = [
+                    scene["updated_at"] for scene in scenes if scene.get("updated_at")
+                ]
+                bulk_state.save(checked, failed, max(updated, default=None))
+        stash_db.flush()
+        flush_removeScenesTag()
         stash_db.close()
+        if stash_reader is not None:
+            stash_reader.close()
         log.LogInfo("[SQLITE] Database closed!")
+        remove_empty_folders(EMPTY_FOLDERS)
+        EMPTY_FOLDERS = CREATED_FOLDERS = None
+        if bulk_state is not None:
+            bulk_state.close()
+            log.LogInfo(f"{progress - skipped} scenes checked, {skipped} unchanged")
+        if PLAN is not None:
+            PLAN.write(os.path.join(PLUGIN_DIR, "renamerOnUpdate_plan.jsonl"))
+    elif PLUGIN_ARGS == "apply":
+        if DRY_RUN:
+            log.LogInfo("Dry mode on, the plan is not applied")
+        else:
+            apply_plan(os.path.join(PLUGIN_DIR, "renamerOnUpdate_plan.jsonl"))
+    elif PLUGIN_ARGS == "undo":
+        if DRY_RUN:
+            log.LogInfo("Dry mode on, nothing is reverted")
+        else:
+            undo_renames(
+                JOURNAL_FILE,
+                FRAGMENT["args"].get("since", config.undo_since),
+                FRAGMENT["args"].get("until", config.undo_until),
+                FRAGMENT["args"].get("scenes", config.undo_scenes),
+            )
+elif WORKER:
+    serve_worker(FRAGMENT)
 else:
     try:
-        renamer(FRAGMENT_SCENE_ID)
+        rename_from_hook(FRAGMENT_SCENE_ID)
     except Exception as err:
         log.LogError(f"main function error: {err}")
         traceback.print_exc()
@@ -0,0 +1,60 @@
+"""
+renamerOnUpdate is a script: it reads the fragment of Stash on stdin and does
+its work when it's loaded. The tests load it with a Studio hook, which only
+clears the studio cache and exits, so its functions and classes can be used
+without Stash.
+"""
+import io
+import json
+import os
+import sys
+import types
+
+import pytest
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def log_module(messages: list) -> types.ModuleType:
+    # the log module of Stash isn't in the repository, keep the messages
+    module = types.ModuleType("log")
+    for level in ("Trace", "Debug", "Info", "Warning", "Error", "Progress"):
+        setattr(
+            module,
+            f"Log{level}",
+            lambda s, level=level: messages.append((level, str(s))),
+        )
+    return module
+
+
+@pytest.fixture(scope="session")
+def rou(tmp_path_factory):
+    pytest.importorskip("requests")
+    plugin_dir = tmp_path_factory.mktemp("plugin")
+    fragment = {
+        "server_connection": {
+            "Scheme": "http",
+            "Host": "localhost",
+            "Port": 9999,
+            "SessionCookie": {"Value": ""},
+            "PluginDir": str(plugin_dir),
+        },
+        "args": {"hookContext": {"type": "Studio.Update.Post", "id": 1}},
+    }
+    messages = []
+    sys.path.insert(0, PLUGIN_DIR)
+    sys.modules["log"] = log_module(messages)
+    module = types.ModuleType("renamerOnUpdate")
+    module.__file__ = os.path.join(PLUGIN_DIR, "renamerOnUpdate.py")
+    with open(module.__file__, encoding="utf-8") as f:
+        code = compile(f.read(), module.__file__, "exec")
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin, sys.stdout = io.StringIO(json.dumps(fragment)), io.StringIO()
+    try:
+        exec(code, module.__dict__)
+    except SystemExit:
+        pass
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+    module.MESSAGES = messages
+    return module
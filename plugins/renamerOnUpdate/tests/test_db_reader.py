@@ -0,0 +1,214 @@
+import re
+import sqlite3
+
+import pytest
+
+# the tables of Stash read by StashDBReader (v32+ schema, columns used only)
+SCHEMA = """
+CREATE TABLE folders (id INTEGER PRIMARY KEY, path TEXT, parent_folder_id INTEGER);
+CREATE TABLE files (id INTEGER PRIMARY KEY, basename TEXT, parent_folder_id INTEGER);
+CREATE TABLE video_files (file_id INTEGER, duration REAL, video_codec TEXT,
+    audio_codec TEXT, width INTEGER, height INTEGER, bit_rate INTEGER);
+CREATE TABLE files_fingerprints (file_id INTEGER, type TEXT, fingerprint BLOB);
+CREATE TABLE studios (id INTEGER PRIMARY KEY, name TEXT, parent_id INTEGER);
+CREATE TABLE scenes (id INTEGER PRIMARY KEY, title TEXT, code TEXT, date TEXT,
+    rating INTEGER, organized BOOLEAN, studio_id INTEGER, updated_at DATETIME);
+CREATE TABLE scenes_files (scene_id INTEGER, file_id INTEGER, "primary" BOOLEAN);
+CREATE TABLE scene_stash_ids (scene_id INTEGER, endpoint TEXT, stash_id TEXT);
+CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE scenes_tags (scene_id INTEGER, tag_id INTEGER);
+CREATE TABLE performers (id INTEGER PRIMARY KEY, name TEXT, gender TEXT,
+    favorite BOOLEAN, rating INTEGER);
+CREATE TABLE performers_scenes (performer_id INTEGER, scene_id INTEGER);
+CREATE TABLE performer_stash_ids (performer_id INTEGER, endpoint TEXT, stash_id TEXT);
+CREATE TABLE groups (id INTEGER PRIMARY KEY, name TEXT, date TEXT);
+CREATE TABLE groups_scenes (group_id INTEGER, scene_id INTEGER, scene_index INTEGER);
+
+INSERT INTO folders VALUES (1, '/lib', NULL);
+INSERT INTO files VALUES (1, 'a.mp4', 1), (2, 'b.mp4', 1);
+INSERT INTO video_files VALUES (1, 60.5, 'h264', 'aac', 1920, 1080, 8000000),
+    (2, 30.0, 'hevc', 'opus', 1280, 720, 2000000);
+INSERT INTO files_fingerprints VALUES (1, 'oshash', 'a1a1a1a1a1a1a1a1'), (1, 'md5', 'x'),
+    (2, 'oshash', 'b2b2b2b2b2b2b2b2');
+INSERT INTO studios VALUES (1, 'Network', NULL), (2, 'Studio', 1);
+INSERT INTO scenes VALUES
+    (1, 'One', 'C-1', '2024-01-02', 80, 1, 2, '2024-01-03 10:00:00.5+01:00'),
+    (2, NULL, NULL, NULL, NULL, 0, NULL, '2024-01-01 08:00:00+00:00');
+INSERT INTO scenes_files VALUES (1, 2, 0), (1, 1, 1), (2, 2, 1);
+INSERT INTO scene_stash_ids VALUES (1, 'https://stashdb.org/graphql', 'abc');
+INSERT INTO tags VALUES (1, 'Zed'), (2, 'Alpha');
+INSERT INTO scenes_tags VALUES (1, 1), (1, 2);
+INSERT INTO performers VALUES (1, 'Bea', 'FEMALE', 1, 60), (2, 'Al', '', 0, NULL);
+INSERT INTO performers_scenes VALUES (1, 1), (2, 1);
+INSERT INTO performer_stash_ids VALUES (1, 'https://stashdb.org/graphql', 'p1');
+INSERT INTO groups VALUES (1, 'Movie', '2023-01-01');
+INSERT INTO groups_scenes VALUES (1, 1, 2);
+"""
+
+ALL_NEEDS = {
+    "performers",
+    "performer_stash_ids",
+    "performer_gender",
+    "performer_favorite",
+    "performer_rating",
+    "studio",
+    "tags",
+    "movies",
+    "stash_ids",
+    "oshash",
+}
+
+
+@pytest.fixture
+def reader(rou, tmp_path, monkeypatch):
+    path = tmp_path / "stash-go.sqlite"
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.close()
+    monkeypatch.setattr(rou, "DB_VERSION", 60, raising=False)
+    monkeypatch.setattr(rou, "DB_TIMEOUT", 5, raising=False)
+    monkeypatch.setattr(rou, "DB_BUSY_RETRIES", 0, raising=False)
+    monkeypatch.setattr(rou, "SCENE_NEEDS", set(ALL_NEEDS), raising=False)
+    monkeypatch.setattr(rou, "FILE_QUERY", rou.build_file_query(60), raising=False)
+    stash_reader = rou.StashDBReader(str(path))
+    yield stash_reader
+    stash_reader.close()
+
+
+def selection(fields: str) -> dict:
+    """The keys of the GraphQL answer to fields, the sub-fields as dicts."""
+    tokens = re.findall(r"[{}]|\w+(?:\s*:\s*\w+)?(?:\([^)]*\))?", fields)
+    stack = [{}]
+    last = None
+    for token in tokens:
+        if token == "{":
+            stack[-1][last] = {}
+            stack.append(stack[-1][last])
+        elif token == "}":
+            stack.pop()
+        else:
+            # the alias is the key: oshash: fingerprint(type: "oshash")
+            last = re.match(r"\w+", token).group(0)
+            stack[-1][last] = None
+    return stack[0]
+
+
+def shape(value):
+    """The keys of value, the items of a list put together."""
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        merged = None
+        for item in value:
+            merged = merge(merged, shape(item))
+        return merged
+    return None
+
+
+def merge(a, b):
+    if not isinstance(a, dict) or not isinstance(b, dict):
+        return a or b
+    return {key: merge(a.get(key), b.get(key)) for key in {**a, **b}}
+
+
+def test_shape_of_graphql(rou, reader):
+    scene = reader.get_scenes(["1"])["1"]
+    assert shape(scene) == selection(rou.scene_fields())
+
+
+def test_scene(rou, reader):
+    scene = reader.get_scenes(["1"])["1"]
+    assert scene == {
+        "id": "1",
+        "title": "One",
+        "code": "C-1",
+        "date": "2024-01-02",
+        "rating100": 80,
+        "organized": True,
+        "updated_at": "2024-01-03T10:00:00+01:00",
+        "stash_ids": [{"endpoint": "https://stashdb.org/graphql", "stash_id": "abc"}],
+        # the primary file first
+        "files": [
+            {
+                "path": "/lib/a.mp4",
+                "video_codec": "h264",
+                "audio_codec": "aac",
+                "width": 1920,
+                "height": 1080,
+                "duration": 60.5,
+                "bit_rate": 8000000,
+                "oshash": "a1a1a1a1a1a1a1a1",
+            },
+            {
+                "path": "/lib/b.mp4",
+                "video_codec": "hevc",
+                "audio_codec": "opus",
+                "width": 1280,
+                "height": 720,
+                "duration": 30.0,
+                "bit_rate": 2000000,
+                "oshash": "b2b2b2b2b2b2b2b2",
+            },
+        ],
+        "studio": {
+            "id": "2",
+            "name": "Studio",
+            "parent_studio": {"id": "1", "name": "Network"},
+        },
+        "tags": [{"id": "2", "name": "Alpha"}, {"id": "1", "name": "Zed"}],
+        "performers": [
+            {
+                "id": "2",
+                "name": "Al",
+                "gender": None,
+                "favorite": False,
+                "rating100": None,
+                "stash_ids": [],
+            },
+            {
+                "id": "1",
+                "name": "Bea",
+                "gender": "FEMALE",
+                "favorite": True,
+                "rating100": 60,
+                "stash_ids": [
+                    {"endpoint": "https://stashdb.org/graphql", "stash_id": "p1"}
+                ],
+            },
+        ],
+        "movies": [{"movie": {"name": "Movie", "date": "2023-01-01"}, "scene_index": 2}],
+    }
+
+
+def test_only_the_needs(rou, reader, monkeypatch):
+    monkeypatch.setattr(rou, "SCENE_NEEDS", {"studio"})
+    monkeypatch.setattr(rou, "FILE_QUERY", rou.build_file_query(60))
+    scene = reader.get_scenes(["2"])["2"]
+    fields = selection(rou.scene_fields())
+    assert scene.keys() == fields.keys()
+    assert scene["files"][0].keys() == fields["files"].keys()
+    assert "oshash" not in scene["files"][0]
+    assert scene["studio"] is None
+
+
+def test_rating_on_5(rou, reader, monkeypatch):
+    monkeypatch.setattr(rou, "DB_VERSION", 38)
+    scene = reader.get_scenes(["1"])["1"]
+    assert scene["rating100"] == 80 * 20
+    assert scene["performers"][1]["rating100"] == 60 * 20
+
+
+def test_missing_scene(reader):
+    assert reader.get_scenes(["1", "99"])["99"] is None
+
+
+def test_pages(reader):
+    pages = list(reader.iter_scene_pages(1))
+    assert [(total, [s["id"] for s in scenes]) for total, scenes in pages] == [
+        (2, ["2"]),
+        (2, ["1"]),
+    ]
+    pages = list(reader.iter_scene_pages(10, updated_after="2024-01-02T00:00:00Z"))
+    assert [(total, [s["id"] for s in scenes]) for total, scenes in pages] == [
+        (1, ["1"])
+    ]
@@ -0,0 +1,42 @@
+import types
+
+
+def test_remove_empty_folders(rou, tmp_path, monkeypatch):
+    library = tmp_path / "library"
+    for folder in ("a/b/c", "a/d", "keep/e", "other"):
+        (library / folder).mkdir(parents=True)
+    (library / "keep" / "file.mp4").write_bytes(b"")
+    (tmp_path / "outside").mkdir()
+    monkeypatch.setattr(
+        rou,
+        "STASH_INFO",
+        types.SimpleNamespace(library_roots=[str(library)]),
+        raising=False,
+    )
+    rou.remove_empty_folders(
+        {
+            str(library / "a" / "b" / "c"),
+            str(library / "a" / "d"),
+            str(library / "keep" / "e"),
+            str(library / "missing"),
+        }
+    )
+    # the parents left empty go too, up to the library folder
+    assert sorted(p.name for p in library.iterdir()) == ["keep", "other"]
+    assert [p.name for p in (library / "keep").iterdir()] == ["file.mp4"]
+    assert (tmp_path / "outside").is_dir()
+
+
+def test_library_folder_kept(rou, tmp_path, monkeypatch):
+    library = tmp_path / "library"
+    (library / "a").mkdir(parents=True)
+    monkeypatch.setattr(
+        rou,
+        "STASH_INFO",
+        types.SimpleNamespace(library_roots=[str(library) + "/"]),
+        raising=False,
+    )
+    rou.remove_empty_folders({str(library / "a"), str(library)})
+    assert library.is_dir()
+    assert not (library / "a").exists()
+    assert tmp_path.is_dir()
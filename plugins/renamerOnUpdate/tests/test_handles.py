@@ -0,0 +1,75 @@
+import errno
+import subprocess
+import sys
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def holder(rou, tmp_path):
+    # another process with the file open
+    if not rou.PROC_FD:
+        pytest.skip("no /proc")
+    path = tmp_path / "opened.mp4"
+    path.write_bytes(b"x")
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys, time\nf = open(sys.argv[1])\nprint(flush=True)\ntime.sleep(60)",
+            str(path),
+        ],
+        stdout=subprocess.PIPE,
+    )
+    process.stdout.readline()
+    yield process, path
+    process.kill()
+    process.wait()
+
+
+def test_has_handle(rou, holder, tmp_path, monkeypatch):
+    process, path = holder
+    monkeypatch.setattr(rou, "HANDLE_CACHE", None)
+    closed = tmp_path / "closed.mp4"
+    closed.write_bytes(b"x")
+    assert rou.has_handle(str(path)) == process.pid
+    assert rou.has_handle(str(path), all_result=True) == [process.pid]
+    assert rou.has_handle(str(closed)) == []
+
+
+def test_directory_cache(rou, holder, tmp_path, monkeypatch):
+    process, path = holder
+    cache = {}
+    monkeypatch.setattr(rou, "HANDLE_CACHE", cache)
+    other = tmp_path / "other.mp4"
+    other.write_bytes(b"x")
+    assert rou.has_handle(str(other)) == []
+    # the scan of other.mp4 found the processes of the whole folder
+    assert list(cache) == [str(tmp_path)]
+    assert process.pid in sum(cache[str(tmp_path)].values(), [])
+    assert rou.has_handle(str(path)) == process.pid
+    # reaped as soon as it ends
+    threading.Thread(target=process.wait).start()
+    rou.terminate_process(process.pid)
+    assert sum(cache[str(tmp_path)].values(), []) == []
+
+
+def test_stale_cache(rou, holder, tmp_path, monkeypatch):
+    # a cached pid that doesn't have the file open anymore isn't returned
+    process, path = holder
+    st = path.stat()
+    other = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    try:
+        cache = {str(tmp_path): {(st.st_dev, st.st_ino): [other.pid]}}
+        monkeypatch.setattr(rou, "HANDLE_CACHE", cache)
+        assert rou.has_handle(str(path), all_result=True) == [process.pid]
+    finally:
+        other.kill()
+        other.wait()
+
+
+def test_file_in_use(rou, monkeypatch):
+    monkeypatch.setattr(rou, "PROC_FD", True)
+    assert rou.is_file_in_use(OSError(errno.EBUSY, "busy"))
+    assert not rou.is_file_in_use(OSError(errno.EACCES, "denied"))
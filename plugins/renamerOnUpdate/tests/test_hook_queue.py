@@ -0,0 +1,121 @@
+import sqlite3
+import time
+
+import pytest
+
+
+@pytest.fixture
+def queues(rou, tmp_path):
+    # two hook processes on the same queue
+    opened = []
+
+    def make(debounce=0.0, stale=120):
+        path = str(tmp_path / "queue.sqlite")
+        first = rou.HookQueue(path, debounce, stale)
+        second = rou.HookQueue(path, debounce, stale)
+        second.pid = first.pid + 1
+        opened.extend((first, second))
+        return first, second
+
+    yield make
+    for hook_queue in opened:
+        hook_queue.close()
+
+
+def test_one_drainer(queues):
+    first, second = queues()
+    assert first.push(1)
+    assert not second.push(2)
+    # a scene updated again is only queued once
+    assert not second.push(1)
+    ids, wait = first.take(10)
+    assert sorted(ids) == [1, 2] and wait is None
+    first.done(ids)
+    assert first.take(10) == ([], None)
+    assert first.release()
+    # the next hook drains
+    assert second.push(3)
+
+
+def test_debounce(queues):
+    first, _ = queues(debounce=30)
+    first.push(1)
+    ids, wait = first.take(10)
+    assert ids == []
+    assert 29 < wait <= 30
+
+
+def test_queued_again_while_renamed(queues):
+    first, second = queues()
+    first.push(1)
+    ids, _ = first.take(10)
+    second.push(1)
+    first.done(ids)
+    # renamed again with its new data
+    assert first.take(10)[0] == [1]
+    assert not first.release()
+    assert first.release(force=True)
+
+
+def test_stale_drainer_replaced(queues):
+    first, second = queues(stale=0.01)
+    assert first.push(1)
+    time.sleep(0.05)
+    assert second.push(2)
+
+
+def test_claimed_scenes(queues):
+    first, second = queues(stale=0.05)
+    assert first.push(1)
+    ids, _ = first.take(10)
+    # a scene being renamed isn't taken again
+    first.push(2)
+    assert first.take(10)[0] == [2]
+    assert first.take(10) == ([], None)
+    # the drainer is stuck in a slow batch, the next hook takes its place
+    time.sleep(0.1)
+    assert second.push(3)
+    # the old drainer stops at its next batch
+    assert first.take(10) == (None, None)
+    # its scenes are renamed by the new one, not deleted by the old one
+    ids, _ = second.take(10)
+    assert sorted(ids) == [1, 2, 3]
+    first.done([1, 2])
+    second.done(ids)
+    assert second.take(10) == ([], None)
+
+
+def test_release_unclaims(queues):
+    first, second = queues()
+    first.push(1)
+    first.take(10)
+    assert first.release(force=True)
+    assert second.push(2)
+    assert sorted(second.take(10)[0]) == [1, 2]
+
+
+def test_heartbeat_thread(queues):
+    first, second = queues(stale=0.2)
+    assert first.push(1)
+    with first.heartbeat():
+        time.sleep(0.4)
+        assert not second.push(2)
+    time.sleep(0.4)
+    assert second.push(3)
+
+
+def test_old_queue_file(rou, tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE queue (scene_id INTEGER PRIMARY KEY, queued_at REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO queue VALUES (1, 0)")
+    conn.commit()
+    conn.close()
+    hook_queue = rou.HookQueue(path, 0)
+    try:
+        assert hook_queue.push(2)
+        assert sorted(hook_queue.take(10)[0]) == [1, 2]
+    finally:
+        hook_queue.close()
@@ -0,0 +1,150 @@
+import json
+
+import pytest
+
+
+def entry(scene_id, source, target, run="r1", time="2024-05-01T10:00:00+00:00", **kw):
+    return dict(
+        {
+            "time": time,
+            "run": run,
+            "scene_id": scene_id,
+            "source": source,
+            "target": target,
+            "oshash": f"hash{scene_id}",
+            "associated": False,
+        },
+        **kw,
+    )
+
+
+def test_journal_and_log_file(rou, tmp_path):
+    path, text_path = tmp_path / "journal.jsonl", tmp_path / "log.txt"
+    journal = rou.RenameJournal(str(path), str(text_path))
+    scene = {"scene_id": 1, "oshash": "abc"}
+    video = journal.add(scene, "/a/v.mp4", "/b/v.mp4")
+    subtitle = journal.add(scene, "/a/v.srt", "/b/v.srt", associated=True)
+    # the journal is written before the files are moved, log_file once they are
+    assert len(rou.read_journal(str(path))) == 2
+    assert not text_path.exists()
+    journal.done(video)
+    journal.done(subtitle)
+    assert text_path.read_text().splitlines() == [
+        "1|/a/v.mp4|/b/v.mp4|abc",
+        "1|/a/v.srt|/b/v.srt",
+    ]
+    entries = rou.read_journal(str(path))
+    assert [(e["scene_id"], e["source"], e["oshash"], e["associated"]) for e in entries] == [
+        ("1", "/a/v.mp4", "abc", False),
+        ("1", "/a/v.srt", None, True),
+    ]
+    assert entries[0]["run"] == entries[1]["run"]
+
+
+def test_cancelled_move(rou, tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = rou.RenameJournal(str(path), None)
+    scene = {"scene_id": 1}
+    journal.add(scene, "/a/v.mp4", "/b/v.mp4")
+    journal.add(scene, "/b/v.mp4", "/a/v.mp4")
+    journal.cancel(journal.add(scene, "/a/v.mp4", "/b/v.mp4"))
+    assert [(e["source"], e["target"]) for e in rou.read_journal(str(path))] == [
+        ("/a/v.mp4", "/b/v.mp4"),
+        ("/b/v.mp4", "/a/v.mp4"),
+    ]
+
+
+def test_journal_error(rou, tmp_path):
+    # nothing is moved
+    journal = rou.RenameJournal(str(tmp_path), None)
+    with pytest.raises(OSError):
+        journal.add({"scene_id": 1}, "/a", "/b")
+
+
+def test_log_file_error(rou, tmp_path):
+    # the caller moves the file back
+    journal = rou.RenameJournal(None, str(tmp_path))
+    entry = journal.add({"scene_id": 1}, "/a", "/b")
+    with pytest.raises(OSError):
+        journal.done(entry)
+
+
+def test_file_rename(rou, tmp_path, monkeypatch):
+    path = tmp_path / "journal.jsonl"
+    monkeypatch.setattr(rou, "JOURNAL", rou.RenameJournal(str(path), None))
+    monkeypatch.setattr(rou, "REMOVE_EMPTY_FOLDER", False, raising=False)
+    source, target = tmp_path / "a.mp4", tmp_path / "b" / "b.mp4"
+    source.write_bytes(b"x")
+    moved = []
+    move = rou.shutil.move
+
+    def check_journal(src, dst):
+        # the move is in the journal before it's done
+        moved.append(rou.read_journal(str(path))[-1]["target"])
+        return move(src, dst)
+
+    monkeypatch.setattr(rou.shutil, "move", check_journal)
+    assert not rou.file_rename(str(source), str(target), {"scene_id": 1})
+    assert moved == [str(target)]
+    # failed move, cancelled
+    assert rou.file_rename(str(tmp_path / "missing.mp4"), str(target), {"scene_id": 2}) == 1
+    monkeypatch.setattr(rou, "move_file", lambda src, dst: 1)
+    assert rou.file_rename(str(target), str(source), {"scene_id": 1}) == 1
+    assert [e["target"] for e in rou.read_journal(str(path))] == [str(target)]
+
+
+def test_read_journal_cut_line(rou, tmp_path):
+    path = tmp_path / "journal.jsonl"
+    first = entry("1", "/a", "/b")
+    path.write_text(json.dumps(first) + "\n" + json.dumps(first)[:20])
+    assert rou.read_journal(str(path)) == [first]
+
+
+def test_select_journal(rou):
+    entries = [
+        entry("1", "/a/1", "/b/1", run="r1", time="2024-05-01T10:00:00+00:00"),
+        entry("2", "/a/2", "/b/2", run="r1", time="2024-05-01T10:00:01+00:00"),
+        entry("1", "/a/1.srt", "/b/1.srt", run="r1", associated=True),
+        entry("3", "/a/3", "/b/3", run="r2", time="2024-05-02T10:00:00+00:00"),
+    ]
+    def sources(moves):
+        return [e["source"] for e in moves]
+
+    # last run
+    assert sources(rou.select_journal(entries)) == ["/a/3"]
+    assert sources(rou.select_journal(entries, scenes=["1", "hash2"])) == ["/a/1", "/a/2"]
+    assert sources(rou.select_journal(entries, since="2024-05-01T10:00:01+00:00")) == [
+        "/a/2",
+        "/a/3",
+    ]
+    assert sources(rou.select_journal(entries, until="2024-05-01T12:00:00+00:00")) == [
+        "/a/1",
+        "/a/2",
+    ]
+
+
+def test_undo_moves(rou):
+    entries = [
+        entry("1", "/a/1", "/b/1"),
+        entry("1", "/b/1", "/c/1"),
+        entry("2", "/a/2", "/b/2"),
+        # moved and moved back
+        entry("3", "/a/3", "/b/3"),
+        entry("3", "/b/3", "/a/3"),
+    ]
+    moves = sorted(rou.undo_moves(entries), key=lambda move: move["scene_id"])
+    # a file moved twice goes back to its first place
+    assert [(m["scene_id"], m["source"], m["target"]) for m in moves] == [
+        ("1", "/c/1", "/a/1"),
+        ("2", "/b/2", "/a/2"),
+    ]
+    assert moves[0]["oshash"] == "hash1"
+    assert all(m["verify"] for m in moves)
+
+
+def test_file_oshash(rou, tmp_path):
+    path = tmp_path / "v.mp4"
+    path.write_bytes(bytes(range(16)))
+    # size + the two 64-bit words, read twice (first and last 64KiB)
+    words = 0x0706050403020100 + 0x0F0E0D0C0B0A0908
+    assert rou.file_oshash(str(path)) == f"{(16 + 2 * words) & (2**64 - 1):016x}"
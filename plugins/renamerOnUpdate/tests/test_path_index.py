@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def index(rou, monkeypatch):
+    monkeypatch.setattr(rou, "DB_VERSION", 60, raising=False)
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(
+        """
+        CREATE TABLE folders (id INTEGER PRIMARY KEY, path TEXT);
+        CREATE TABLE files (id INTEGER PRIMARY KEY, basename TEXT, parent_folder_id INTEGER);
+        CREATE TABLE scenes_files (scene_id INTEGER, file_id INTEGER);
+        INSERT INTO folders VALUES (1, '/lib/a'), (2, '/lib/b');
+        INSERT INTO files VALUES (1, 'x.mp4', 1), (2, 'x.mp4', 2), (3, 'cover.jpg', 1);
+        INSERT INTO scenes_files VALUES (1, 1), (2, 2);
+        """
+    )
+    path_index = rou.PathIndex(conn)
+    conn.close()
+    return path_index
+
+
+def scene(scene_id, final_path):
+    return {
+        "scene_id": scene_id,
+        "final_path": final_path,
+        "new_filename": final_path.rsplit("/", 1)[1],
+    }
+
+
+def test_index(index):
+    assert index.owners("/lib/a/x.mp4") == {"1"}
+    assert index.basename_owners("x.mp4") == {"1", "2"}
+    # a file without scene
+    assert index.owners("/lib/a/cover.jpg") == {None}
+    index.move("/lib/a/x.mp4", "/lib/c/y.mp4", 1)
+    assert index.owners("/lib/a/x.mp4") == set()
+    assert index.owners("/lib/c/y.mp4") == {"1"}
+    assert index.basename_owners("x.mp4") == {"2"}
+
+
+def test_collisions(rou, index, monkeypatch):
+    monkeypatch.setattr(rou, "PATH_INDEX", index)
+    # its own path
+    assert rou.checking_duplicate_index(scene(1, "/lib/a/x.mp4")) is None
+    assert rou.checking_duplicate_index(scene(1, "/lib/b/x.mp4")) == 1
+    assert rou.checking_duplicate_index(scene(1, "/lib/a/cover.jpg")) == 1
+    # same name in another folder: only a notice
+    assert rou.checking_duplicate_index(scene(3, "/lib/c/x.mp4")) is None
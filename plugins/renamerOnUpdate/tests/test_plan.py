@@ -0,0 +1,55 @@
+import os
+
+
+def move(source, target, scene_id="1"):
+    return {"scene_id": scene_id, "source": source, "target": target}
+
+
+def test_independent_moves(rou, tmp_path):
+    moves = [
+        move(str(tmp_path / "a.mp4"), str(tmp_path / "x.mp4")),
+        move(str(tmp_path / "b.mp4"), str(tmp_path / "y.mp4")),
+    ]
+    assert rou.order_plan(moves) == [0, 0]
+    assert [(m["after"], m["temp"]) for m in moves] == [(None, None), (None, None)]
+
+
+def test_chain(rou, tmp_path):
+    a, b, c, d = (str(tmp_path / f"{name}.mp4") for name in "abcd")
+    # a -> b needs b -> c done, which needs c -> d done
+    moves = [move(a, b), move(b, c), move(c, d)]
+    assert rou.order_plan(moves) == [2, 1, 0]
+    assert [m["after"] for m in moves] == [b, c, None]
+    assert all(m["temp"] is None for m in moves)
+
+
+def test_swap(rou, tmp_path):
+    a, b = str(tmp_path / "a.mp4"), str(tmp_path / "b.mp4")
+    moves = [move(a, b), move(b, a)]
+    assert rou.order_plan(moves) == [1, 0]
+    # a is put aside first, then b -> a, then the temporary file -> b
+    assert moves[0]["temp"] == f"{a}.renamer-tmp"
+    assert moves[0]["after"] == b
+    assert moves[1]["temp"] is None
+    assert moves[1]["after"] is None
+
+
+def test_cycle_with_a_chain(rou, tmp_path):
+    a, b, c, d = (str(tmp_path / f"{name}.mp4") for name in "abcd")
+    # a -> b -> c -> a is a cycle, d -> e is on its own
+    moves = [move(a, b), move(b, c), move(c, a), move(d, str(tmp_path / "e.mp4"))]
+    steps = rou.order_plan(moves)
+    assert [m["temp"] is not None for m in moves] == [True, False, False, False]
+    assert steps == [2, 1, 0, 0]
+    # no move waits for a move of the same or a later step
+    sources = {m["source"]: i for i, m in enumerate(moves)}
+    for i, m in enumerate(moves):
+        if m["after"] is not None:
+            assert steps[sources[m["after"]]] < steps[i]
+
+
+def test_temporary_name_is_free(rou, tmp_path):
+    a = tmp_path / "a.mp4"
+    (tmp_path / "a.mp4.renamer-tmp").write_bytes(b"")
+    assert rou.temporary_name(str(a)) == f"{a}.renamer-tmp1"
+    assert not os.path.exists(rou.temporary_name(str(a)))
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+
+class FakeWriter:
+    # records what renamer() does with the connection of the hook
+    instances = []
+
+    def __init__(self, path, on_commit=None):
+        self.conn = object()
+        self.pending = []
+        self.flushed = []
+        self.closed = False
+        FakeWriter.instances.append(self)
+
+    def rename(self, scene_info):
+        item = {"scene_info": scene_info, "moves": []}
+        self.pending.append(item)
+        return item
+
+    def flush(self):
+        self.flushed.extend(item["scene_info"]["final_path"] for item in self.pending)
+        self.pending = []
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def hook(rou, monkeypatch, tmp_path):
+    FakeWriter.instances = []
+    old, new = tmp_path / "old", tmp_path / "new"
+    old.mkdir()
+    new.mkdir()
+
+    def extract_info(scene, template):
+        name = os.path.basename(scene["path"])
+        return {
+            "current_path": scene["path"],
+            "current_directory": str(old),
+            "current_filename": name,
+            "new_directory": str(new),
+            "new_filename": name,
+        }
+
+    def shorten_new_path(scene_info, template):
+        scene_info["final_path"] = os.path.join(
+            scene_info["new_directory"], scene_info["new_filename"]
+        )
+
+    def file_rename(current_path, new_path, scene_info):
+        os.rename(current_path, new_path)
+
+    for name, value in {
+        "PATH_NON_ORGANIZED": True,
+        "DRY_RUN": False,
+        "LOGFILE": None,
+        "RENDERED": None,
+        "PLAN": None,
+        "ALT_DIFF_DISPLAY": False,
+        "DUPLICATE_SUFFIX": [],
+        "PATH_INDEX": None,
+        "STASH_DATABASE": str(tmp_path / "stash.sqlite"),
+        "StashDBWriter": FakeWriter,
+        "get_template_filename": lambda scene: "$title",
+        "get_template_path": lambda scene: {},
+        "extract_info": extract_info,
+        "shorten_new_path": shorten_new_path,
+        "check_longpath": lambda path: False,
+        "create_new_filename": lambda scene_info, template: scene_info["new_filename"],
+        "file_rename": file_rename,
+        "associated_rename": lambda scene_info: [],
+    }.items():
+        monkeypatch.setattr(rou, name, value, raising=False)
+    return old, new
+
+
+def test_duplicate_second_file(rou, hook, monkeypatch):
+    # the first file is moved, the second one is a duplicate: the move of the
+    # first one is still written and the connection closed
+    old, new = hook
+    files = []
+    for name in ("a.mp4", "b.mp4"):
+        (old / name).write_text(name)
+        files.append({"path": str(old / name)})
+    monkeypatch.setattr(
+        rou,
+        "checking_duplicate_db",
+        lambda scene_info: scene_info["current_filename"] == "b.mp4",
+    )
+    scene = {"id": "1", "organized": True, "files": files}
+    with pytest.raises(Exception, match="duplicate"):
+        rou.renamer(scene)
+    assert (new / "a.mp4").exists() and (old / "b.mp4").exists()
+    (writer,) = FakeWriter.instances
+    assert writer.flushed == [str(new / "a.mp4")]
+    assert writer.closed
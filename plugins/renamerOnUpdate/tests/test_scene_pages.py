@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def stash(rou, monkeypatch):
+    """Scenes served by a fake findScenes, the pages asked are in 'pages'."""
+    state = {"scenes": [{"id": str(i)} for i in range(1, 8)], "pages": []}
+
+    def find_scenes(per_page, direc, page, client, updated_after):
+        state["pages"].append(page)
+        scenes = state["scenes"]
+        if per_page > 0:
+            scenes = scenes[(page - 1) * per_page : page * per_page]
+        return {"count": len(state["scenes"]), "scenes": scenes}
+
+    monkeypatch.setattr(rou, "graphql_findScene", find_scenes)
+    monkeypatch.setattr(rou, "GraphQLClient", lambda server: None)
+    return state
+
+
+def ids(pages):
+    return [[scene["id"] for scene in scenes] for _, scenes in pages]
+
+
+def wait_for_page(stash, page):
+    for _ in range(100):
+        if page in stash["pages"]:
+            return
+        time.sleep(0.01)
+
+
+def test_pages(rou, stash):
+    pages = list(rou.iter_scene_pages(3))
+    assert ids(pages) == [["1", "2", "3"], ["4", "5", "6"], ["7"]]
+    assert {total for total, _ in pages} == {7}
+    assert stash["pages"] == [1, 2, 3]
+
+
+def test_limit_and_all(rou, stash):
+    assert ids(rou.iter_scene_pages(3, limit=4)) == [["1", "2", "3"], ["4"]]
+    assert ids(rou.iter_scene_pages(-1)) == [[str(i) for i in range(1, 8)]]
+
+
+def test_next_page_prefetched(rou, stash):
+    pages = rou.iter_scene_pages(3)
+    next(pages)
+    # asked while the first page is processed
+    wait_for_page(stash, 2)
+    assert stash["pages"] == [1, 2]
+    pages.close()
+
+
+def test_shifted_scene_once(rou, stash):
+    pages = rou.iter_scene_pages(3)
+    yielded = [scene["id"] for scene in next(pages)[1]]
+    wait_for_page(stash, 2)
+    # scene 6 updated during the run: sorted first, pages after it shift
+    stash["scenes"].insert(0, {"id": "6"})
+    yielded += [scene["id"] for _, scenes in pages for scene in scenes]
+    assert yielded == ["1", "2", "3", "4", "5", "6", "7"]
@@ -0,0 +1,155 @@
+import os
+import random
+
+import pytest
+
+FIELDS = ("studio", "performer", "title", "date", "resolution")
+TEMPLATES = (
+    "$date $performer - $title [$studio] $resolution",
+    "$studio - $date - $title",
+    "$resolution $performer $title",
+    "[$studio] $performer - $title - $date",
+)
+PATH_TEMPLATES = (None, "/library/$studio/$performer", "/library/$studio")
+
+
+@pytest.fixture
+def rendering(rou, monkeypatch):
+    # the settings of the default config used by create_new_filename and
+    # create_new_path (read by the plugin after the hook dispatch)
+    remove_table, remove_re = rou.compile_remove_character("")
+    for name, value in {
+        "FIELD_REPLACER": {},
+        "FILENAME_REPLACEWORDS": {},
+        "REPLACE_WORDS_STAGES": rou.compile_replace_words({}),
+        "FILENAME_SPLITCHAR": " ",
+        "FILENAME_LOWER": False,
+        "FILENAME_TITLECASE": False,
+        "FILENAME_REMOVECHARACTER": "",
+        "REMOVECHARACTER_TABLE": remove_table,
+        "RE_REMOVECHARACTER": remove_re,
+        "FILENAME_TABLE": dict(rou.ILLEGAL_CHARACTER),
+        "UNICODE_USE": False,
+        "DUPLICATE_SUFFIX": [""],
+        "PREVENT_TITLE_PERF": True,
+        "PREVENT_CONSECUTIVE": True,
+        "IGNORE_PATH_LENGTH": False,
+    }.items():
+        monkeypatch.setattr(rou, name, value, raising=False)
+
+
+def make_scene(filename: str, path, **fields) -> tuple:
+    scene_info = {
+        "current_directory": "/library/in",
+        "current_filename": "video.mp4",
+        "file_extension": ".mp4",
+        "file_index": 0,
+    }
+    for field, value in fields.items():
+        if value:
+            scene_info[field] = value
+    if fields.get("performer"):
+        scene_info["performer_path"] = fields["performer"]
+    template = {"filename": filename, "path": None}
+    if path:
+        template["path"] = {"destination": path, "option": [], "opt_details": {}}
+        scene_info["template_split"] = os.path.normpath(path).split(os.sep)
+    return scene_info, template
+
+
+def one_by_one(rou, scene_info, template):
+    # the loop of the plugin before shorten_new_path: remove a field, render
+    # again, until the path is short enough
+    for removed_field in rou.ORDER_SHORTFIELD:
+        if removed_field:
+            if scene_info.get(removed_field.replace("$", "")):
+                del scene_info[removed_field.replace("$", "")]
+            else:
+                continue
+        rendered = rou.render_new_path(scene_info, template)
+        if len(rendered[2]) <= 240:
+            break
+    (
+        scene_info["new_filename"],
+        scene_info["new_directory"],
+        scene_info["final_path"],
+    ) = rendered
+
+
+def check(rou, scene_info, template):
+    expected = dict(scene_info)
+    one_by_one(rou, expected, template)
+    rou.shorten_new_path(scene_info, template)
+    assert scene_info == expected
+    return scene_info
+
+
+def words(rng, length: int) -> str:
+    return " ".join(
+        "".join(rng.choice("abcdefgh") for _ in range(rng.randint(2, 9)))
+        for _ in range(length)
+    ).title()
+
+
+def test_same_as_one_by_one(rou, rendering, monkeypatch):
+    rng = random.Random(8)
+    for _ in range(500):
+        order_field = [None] + [f"${field}" for field in rng.sample(FIELDS, 4)]
+        monkeypatch.setattr(rou, "ORDER_SHORTFIELD", order_field, raising=False)
+        performer = words(rng, rng.randint(0, 3))
+        title = words(rng, rng.randint(0, 30))
+        if performer and rng.random() < 0.3:
+            # the performer isn't in the name (prevent_title_performer)
+            title = f"{performer} {title}"
+        scene_info, template = make_scene(
+            rng.choice(TEMPLATES),
+            rng.choice(PATH_TEMPLATES),
+            studio=words(rng, rng.randint(0, 12)),
+            performer=performer,
+            title=title,
+            date=rng.choice(["", "2021-03-04"]),
+            resolution=rng.choice(["", "1080p", "2160p"]),
+        )
+        check(rou, scene_info, template)
+
+
+def test_field_not_in_the_name(rou, rendering, monkeypatch):
+    # the title starts with the performer, so $performer is empty: removing
+    # it doesn't shorten the path, removing the title brings it back
+    monkeypatch.setattr(
+        rou, "ORDER_SHORTFIELD", [None, "$performer", "$title"], raising=False
+    )
+    scene_info, template = make_scene(
+        "$performer - $title [$studio]",
+        None,
+        studio="Studio",
+        performer="Jane Doe",
+        title="Jane Doe " + "Long Title " * 25,
+    )
+    assert len(rou.render_new_path(scene_info, template)[2]) > 240
+    scene_info = check(rou, scene_info, template)
+    assert "performer" not in scene_info and "title" not in scene_info
+    assert scene_info["new_filename"] == "[Studio].mp4"
+
+    monkeypatch.setattr(
+        rou, "ORDER_SHORTFIELD", [None, "$title", "$performer"], raising=False
+    )
+    scene_info, template = make_scene(
+        "$performer - $title [$studio]",
+        None,
+        studio="Studio",
+        performer="Jane Doe",
+        title="Jane Doe " + "Long Title " * 25,
+    )
+    scene_info = check(rou, scene_info, template)
+    assert scene_info["new_filename"] == "Jane Doe - [Studio].mp4"
+
+
+def test_short_path_untouched(rou, rendering, monkeypatch):
+    monkeypatch.setattr(rou, "ORDER_SHORTFIELD", [None, "$title"], raising=False)
+    scene_info, template = make_scene(
+        "$studio - $title", None, studio="Studio", title="Title"
+    )
+    rou.shorten_new_path(scene_info, template)
+    assert scene_info["final_path"] == "/library/in/Studio - Title.mp4"
+    assert scene_info["title"] == "Title"
@@ -0,0 +1,64 @@
+import os
+
+
+def touch(folder, *names):
+    for name in names:
+        (folder / name).write_bytes(b"")
+
+
+def found(index, path):
+    return sorted(os.path.basename(p) for p, _ in index.find(str(path)))
+
+
+def test_language_and_flags(rou, tmp_path):
+    touch(
+        tmp_path,
+        "Scene.mp4",
+        "Scene.SRT",
+        "Scene.en.srt",
+        "Scene.pt-BR.forced.vtt",
+        "Scene.sdh.srt",
+        "Scene.txt",
+        "Other.srt",
+    )
+    index = rou.SidecarIndex(["srt", "vtt"])
+    assert sorted(index.find(str(tmp_path / "Scene.mp4"))) == [
+        (str(tmp_path / "Scene.SRT"), ".SRT"),
+        (str(tmp_path / "Scene.en.srt"), ".en.srt"),
+        (str(tmp_path / "Scene.pt-BR.forced.vtt"), ".pt-BR.forced.vtt"),
+        (str(tmp_path / "Scene.sdh.srt"), ".sdh.srt"),
+    ]
+
+
+def test_longer_stem_of_another_video(rou, tmp_path):
+    touch(
+        tmp_path,
+        "Scene.mp4",
+        "Scene.HD.mp4",
+        "Scene.HD.srt",
+        "Scene.srt",
+        "Foo.mp4",
+        "Foo.Bar.mp4",
+        "Foo.Bar.srt",
+        "Foo.Bar.forced.srt",
+    )
+    index = rou.SidecarIndex(["srt"])
+    assert found(index, tmp_path / "Scene.mp4") == ["Scene.srt"]
+    assert found(index, tmp_path / "Scene.HD.mp4") == ["Scene.HD.srt"]
+    assert found(index, tmp_path / "Foo.mp4") == []
+    assert found(index, tmp_path / "Foo.Bar.mp4") == [
+        "Foo.Bar.forced.srt",
+        "Foo.Bar.srt",
+    ]
+
+
+def test_moves_update_the_index(rou, tmp_path):
+    touch(tmp_path, "Scene.mp4", "Scene.HD.mp4", "Scene.HD.srt")
+    index = rou.SidecarIndex(["srt"])
+    assert found(index, tmp_path / "Scene.mp4") == []
+    # the other video leaves, its subtitle stays: taken as a language
+    index.moved(str(tmp_path / "Scene.HD.mp4"), str(tmp_path / "New.mp4"))
+    assert found(index, tmp_path / "Scene.mp4") == ["Scene.HD.srt"]
+    index.moved(str(tmp_path / "Scene.HD.srt"), str(tmp_path / "New.srt"))
+    assert found(index, tmp_path / "Scene.mp4") == []
+    assert found(index, tmp_path / "New.mp4") == ["New.srt"]
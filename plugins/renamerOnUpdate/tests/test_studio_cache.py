@@ -0,0 +1,30 @@
+import json
+import os
+
+
+def test_cache_file(rou, tmp_path, monkeypatch):
+    studios = [
+        {"id": "1", "name": "Parent"},
+        {"id": "2", "name": "Child", "parent_studio": {"id": "1"}},
+    ]
+    monkeypatch.setattr(rou, "graphql_getAllStudios", lambda: studios)
+    path = tmp_path / "studios.json"
+    cache = rou.StudioCache(str(path))
+    assert cache.ancestors({"id": 2, "name": "Child"}) == ["Child", "Parent"]
+    # written through a temporary file, nothing left next to it
+    assert os.listdir(tmp_path) == ["studios.json"]
+    assert json.loads(path.read_text())["2"] == ["Child", "1"]
+    # another hook reads it
+    other = rou.StudioCache(str(path))
+    monkeypatch.setattr(rou, "graphql_getAllStudios", lambda: [])
+    assert other.ancestors({"id": 2, "name": "Child"}) == ["Child", "Parent"]
+
+
+def test_invalidate_twice(rou, tmp_path):
+    # two Studio hooks at the same time
+    path = tmp_path / "studios.json"
+    path.write_text("{}")
+    first, second = rou.StudioCache(str(path)), rou.StudioCache(str(path))
+    first.invalidate()
+    second.invalidate()
+    assert not path.exists()
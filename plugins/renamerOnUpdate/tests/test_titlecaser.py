@@ -0,0 +1,63 @@
+import random
+import re
+
+import pytest
+
+
+def capitalize_words(s):
+    # the function of the plugin before TitleCaser
+    def process_word(match):
+        word = match.group(0)
+        preceding_char, following_char = None, None
+        if match.start() > 0:
+            for i in range(match.start() - 1, -1, -1):
+                if not match.string[i].isspace():
+                    preceding_char = match.string[i]
+                    break
+        if match.end() < len(s):
+            for i in range(match.end(), len(s)):
+                if not match.string[i].isspace():
+                    following_char = match.string[i]
+                    break
+        if (
+            match.start() == 0
+            or match.end() == len(s)
+            or word.lower() not in {"and", "of", "the"}
+            or (preceding_char and not preceding_char.isalnum())
+            or (following_char and not following_char.isalnum())
+        ):
+            return word.capitalize()
+        return word.lower()
+
+    return re.sub(r"\b[A-Z]?[a-z\'’‘]+\b", process_word, s)
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("the lord of the rings", "The Lord of the Rings"),
+        ("rock and roll", "Rock and Roll"),
+        ("MILF and BBW in VR 1080p", "MILF and BBW In VR 1080p"),
+        ("LaSirena69 - the end", "LaSirena69 - The End"),
+        ("romeo and  juliet. and the end", "Romeo and  Juliet. And the End"),
+        ("l'amour d’été", "L'amour D’été"),
+        ("", ""),
+    ],
+)
+def test_title_case(rou, text, expected):
+    assert rou.TitleCaser()(text) == expected
+
+
+def test_same_as_before(rou):
+    caser = rou.TitleCaser()
+    tokens = "and of the The AND x word Hello o'neil LaSirena 1080p é".split()
+    tokens += [" ", "  ", "\t", "-", ".", "'", "’", "("]
+    rng = random.Random(11)
+    for _ in range(20000):
+        text = "".join(rng.choice(tokens) for _ in range(rng.randint(0, 10)))
+        assert caser(text) == capitalize_words(text)
+
+
+def test_abbreviations(rou):
+    caser = rou.TitleCaser(abbreviations=["fbi", "the"])
+    assert caser("meet the fbi and the usa") == "Meet THE FBI and THE Usa"
@@ -0,0 +1,114 @@
+"""
+Title casing in a single pass over the words of a string.
+
+Only the words made of lowercase letters (with an optional capital first
+letter) are changed, so words in all caps (MILF, BBW, VR), words with mixed
+case (LaSirena69, xHamster) and resolutions (1080p, 4k) are kept as they are.
+"""
+import re
+
+# \b[A-Z]? an optional capital first letter,
+# [a-z'’‘]+\b lowercase letters, apostrophes or single quotation marks
+# The group makes split() return the words at the odd indexes, with the text
+# between them at the even indexes.
+RE_WORD = re.compile(r"\b([A-Z]?[a-z\'’‘]+)\b")
+RE_FULL_WORD = re.compile(r"[A-Z]?[a-z]+")
+
+# words kept in lowercase when they are between other words
+SMALL_WORDS = ("and", "of", "the")
+
+
+class TitleCaser:
+    """
+    Capitalizes every word, except:
+    - the small words, kept in lowercase when they are between two words
+      (not the first or last word, not next to a punctuation).
+    - the abbreviations, put in uppercase.
+    """
+
+    def __init__(self, small_words=SMALL_WORDS, abbreviations=()):
+        self.small_words = {word.lower() for word in small_words}
+        self.abbreviations = {word.upper() for word in abbreviations}
+        # word -> new word, the small words are never in it
+        self.words = {}
+
+    def __call__(self, text: str) -> str:
+        if not isinstance(text, str):
+            raise ValueError("Input must be a string.")
+        if text.isascii() and text.replace(" ", "").isalpha():
+            # only letters and spaces (most titles), every part between the
+            # spaces is a word, no need for the regex
+            return self._words(text)
+        parts = RE_WORD.split(text)
+        if len(parts) == 1:
+            return text
+        get = self.words.get
+        words = [get(word) for word in parts[1::2]]
+        if None in words:
+            for n, new_word in enumerate(words):
+                if new_word is None:
+                    words[n] = self._word(parts, 2 * n + 1)
+        parts[1::2] = words
+        return "".join(parts)
+
+    def _words(self, text: str) -> str:
+        parts = text.split(" ")
+        get = self.words.get
+        words = [get(word) for word in parts]
+        if None in words:
+            last = len(parts) - 1
+            for i, new_word in enumerate(words):
+                if new_word is not None:
+                    continue
+                word = parts[i]
+                if not RE_FULL_WORD.fullmatch(word):
+                    # all caps, mixed case or empty, kept
+                    words[i] = word
+                    self._cache(word, word)
+                elif word.lower() in self.small_words and not (
+                    self.abbreviations and word.upper() in self.abbreviations
+                ):
+                    # only letters around it, between words unless first or last
+                    words[i] = word.capitalize() if i in (0, last) else word.lower()
+                else:
+                    words[i] = self._word(parts, i)
+        return " ".join(words)
+
+    def _cache(self, word: str, new_word: str):
+        if len(self.words) > 10000:
+            self.words.clear()
+        self.words[word] = new_word
+
+    def _word(self, parts: list, i: int) -> str:
+        word = parts[i]
+        if self.abbreviations and word.upper() in self.abbreviations:
+            new_word = word.upper()
+        elif word.lower() in self.small_words:
+            # depends on the place of the word, not cached
+            if self._between_words(parts, i):
+                return word.lower()
+            return word.capitalize()
+        else:
+            new_word = word.capitalize()
+        self._cache(word, new_word)
+        return new_word
+
+    @staticmethod
+    def _between_words(parts: list, i: int) -> bool:
+        # first or last word of the text
+        if (i == 1 and not parts[0]) or (i == len(parts) - 2 and not parts[-1]):
+            return False
+        # nearest non-space character before and after the word, from the
+        # text between the words or else from the next word (the words have no
+        # space, so it's enough)
+        before = parts[i - 1].rstrip()
+        if not before and i > 1:
+            before = parts[i - 2]
+        if before and not before[-1].isalnum():
+            return False
+        after = parts[i + 1].lstrip()
+        if not after and i < len(parts) - 2:
+            after = parts[i + 2]
+        if after and not after[0].isalnum():
+            return False
+        return True
@@ -0,0 +1,239 @@
+"""
+Measure renamerOnUpdate without a Stash instance.
+
+For each library size, a synthetic library is written in a temporary folder
+(on /dev/shm when possible) and served by a local fake Stash. A copy of the
+plugin is run like Stash runs it (a process, the fragment on stdin):
+
+- hook: one process per updated scene, for a sample of scenes.
+- bulk: the task 'Rename scenes' on the whole library.
+- bulk again: the same task right after, nothing changed.
+
+It reports the scenes per second, the GraphQL requests (round-trips) per
+scene and the database commits per scene (file change counter of SQLite).
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_stash import FakeStashServer, commit_counter, make_library
+
+PLUGIN_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "plugins", "renamerOnUpdate"
+)
+PLUGIN_FILES = ("renamerOnUpdate.py", "titlecaser.py", "renamerOnUpdate.yml")
+
+# stand-in for the log module of Stash (plugin log protocol on stderr)
+LOG_MODULE = '''import sys
+
+
+def _log(level, message):
+    sys.stderr.write(f"\\x01{level}\\x02{message}\\n")
+    sys.stderr.flush()
+
+
+def LogTrace(s):
+    _log("t", s)
+
+
+def LogDebug(s):
+    _log("d", s)
+
+
+def LogInfo(s):
+    _log("i", s)
+
+
+def LogWarning(s):
+    _log("w", s)
+
+
+def LogError(s):
+    _log("e", s)
+
+
+def LogProgress(p):
+    _log("p", min(max(0, p), 1))
+'''
+
+CONFIG = '''
+# = benchmark =
+p_default_template = r"{library}/$studio_hierarchy"
+p_use_default_template = True
+log_file = r""
+dry_run = False
+enable_hook = True
+resident_worker = False
+hook_queue = False
+'''
+
+
+def work_dir(base=None) -> str:
+    if base is None and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        # tmpfs, the disk isn't measured
+        base = "/dev/shm"
+    return tempfile.mkdtemp(prefix="renamer-benchmark-", dir=base)
+
+
+def install_plugin(root: str, library: str, settings: list) -> str:
+    plugin = os.path.join(root, "plugin")
+    os.makedirs(plugin)
+    for name in PLUGIN_FILES:
+        shutil.copy(os.path.join(PLUGIN_DIR, name), plugin)
+    with open(os.path.join(PLUGIN_DIR, "config.py"), "r", encoding="utf-8") as f:
+        config = f.read()
+    config += CONFIG.format(library=library)
+    config += "".join(f"{setting}\n" for setting in settings)
+    with open(os.path.join(plugin, "config.py"), "w", encoding="utf-8") as f:
+        f.write(config)
+    with open(os.path.join(plugin, "log.py"), "w", encoding="utf-8") as f:
+        f.write(LOG_MODULE)
+    return plugin
+
+
+def run_plugin(plugin: str, port: int, args: dict) -> list:
+    """Run the plugin once, return the errors it logged."""
+    fragment = {
+        "server_connection": {
+            "Scheme": "http",
+            "Host": "127.0.0.1",
+            "Port": port,
+            "SessionCookie": {"Name": "session", "Value": "benchmark"},
+            "Dir": plugin,
+            "PluginDir": plugin,
+        },
+        "args": args,
+    }
+    process = subprocess.run(
+        [sys.executable, os.path.join(plugin, "renamerOnUpdate.py")],
+        input=json.dumps(fragment).encode(),
+        capture_output=True,
+        cwd=plugin,
+    )
+    errors = [
+        line[3:]
+        for line in process.stderr.decode("utf-8", "replace").splitlines()
+        if line.startswith("\x01e\x02")
+    ]
+    if process.returncode:
+        errors.append(process.stderr.decode("utf-8", "replace").strip().splitlines()[-1])
+    return errors
+
+
+def measure(name, n_scenes, server, database, runs) -> dict:
+    """runs: list of functions, each one running the plugin once."""
+    server.requests = 0
+    commits = commit_counter(database)
+    errors = []
+    start = time.perf_counter()
+    for run in runs:
+        errors += run()
+    seconds = time.perf_counter() - start
+    commits = commit_counter(database) - commits
+    return {
+        "mode": name,
+        "scenes": n_scenes,
+        "seconds": seconds,
+        "scenes/s": n_scenes / seconds,
+        "requests/scene": server.requests / n_scenes,
+        "commits/scene": commits / n_scenes,
+        "errors": errors,
+    }
+
+
+def benchmark(size: int, options) -> list:
+    results = []
+    modes = options.modes.split(",")
+    if "hook" in modes:
+        root = work_dir(options.dir)
+        try:
+            stash = make_library(root, size, options.schema, options.seed)
+            plugin = install_plugin(root, stash.library, options.set)
+            scene_ids = random.Random(options.seed).sample(list(stash.scenes), min(options.hooks, size))
+            with FakeStashServer(stash) as server:
+                runs = [
+                    (lambda scene_id=scene_id: run_plugin(
+                        plugin,
+                        server.port,
+                        {"hookContext": {"type": "Scene.Update.Post", "id": int(scene_id)}},
+                    ))
+                    for scene_id in scene_ids
+                ]
+                results.append(measure("hook", len(scene_ids), server, stash.database, runs))
+        finally:
+            if not options.keep:
+                shutil.rmtree(root, ignore_errors=True)
+    if "bulk" in modes:
+        root = work_dir(options.dir)
+        try:
+            stash = make_library(root, size, options.schema, options.seed)
+            plugin = install_plugin(root, stash.library, options.set)
+            with FakeStashServer(stash) as server:
+                run = lambda: run_plugin(plugin, server.port, {"mode": "bulk"})
+                results.append(measure("bulk", size, server, stash.database, [run]))
+                results.append(measure("bulk again", size, server, stash.database, [run]))
+        finally:
+            if not options.keep:
+                shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def print_results(results: list):
+    columns = ("mode", "scenes", "seconds", "scenes/s", "requests/scene", "commits/scene", "errors")
+    rows = [
+        [
+            result["mode"],
+            str(result["scenes"]),
+            f"{result['seconds']:.2f}",
+            f"{result['scenes/s']:.1f}",
+            f"{result['requests/scene']:.3f}",
+            f"{result['commits/scene']:.3f}",
+            str(len(result["errors"])),
+        ]
+        for result in results
+    ]
+    widths = [max(len(c), *(len(r[i]) for r in rows)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+    for result in results:
+        for error in result["errors"][:5]:
+            print(f"[{result['mode']} {result['scenes']}] {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="library sizes (scenes)")
+    parser.add_argument("--modes", default="hook,bulk", help="hook and/or bulk")
+    parser.add_argument("--hooks", type=int, default=100, help="hooks run per size")
+    parser.add_argument("--schema", type=int, default=38, help="database version (32 or more)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="line added to the config (e.g. --set 'db_batch_size = 500')",
+    )
+    parser.add_argument("--dir", help="folder for the libraries (default: /dev/shm or the temp folder)")
+    parser.add_argument("--keep", action="store_true", help="don't remove the libraries")
+    parser.add_argument("--json", help="also write the results in this file")
+    options = parser.parse_args()
+    results = []
+    for size in (int(x) for x in options.sizes.split(",")):
+        print(f"{size} scenes...", file=sys.stderr)
+        results += benchmark(size, options)
+    print_results(results)
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
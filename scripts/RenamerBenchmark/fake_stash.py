@@ -0,0 +1,713 @@
+"""
+A local stand-in for Stash, used by RenamerBenchmark.py.
+
+- make_library() writes a synthetic library: empty video files on disk and a
+  SQLite database with the tables of the file-refactor schema (v32+, the
+  scene code of v38) that renamerOnUpdate reads and writes, scenes with their
+  studios, tags and performers included (bulk_sqlite_read).
+- FakeStash answers the GraphQL queries of the plugin from that library. The
+  paths of the files are read from the database, so the renames done by the
+  plugin are seen by the next queries like with Stash.
+- FakeStashServer serves FakeStash on 127.0.0.1 and counts the requests.
+"""
+import bisect
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCHEMA = """
+CREATE TABLE schema_migrations (version uint64 NOT NULL, dirty bool NOT NULL);
+CREATE TABLE folders (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    path varchar(255) NOT NULL,
+    parent_folder_id integer,
+    zip_file_id integer,
+    mod_time datetime NOT NULL,
+    created_at datetime NOT NULL,
+    updated_at datetime NOT NULL,
+    FOREIGN KEY(parent_folder_id) REFERENCES folders(id) ON DELETE SET NULL
+);
+CREATE UNIQUE INDEX index_folders_on_path_unique ON folders (path);
+CREATE INDEX index_folders_on_parent_folder_id ON folders (parent_folder_id);
+CREATE TABLE files (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    basename varchar(255) NOT NULL,
+    zip_file_id integer,
+    parent_folder_id integer NOT NULL,
+    size integer NOT NULL,
+    mod_time datetime NOT NULL,
+    created_at datetime NOT NULL,
+    updated_at datetime NOT NULL,
+    FOREIGN KEY(parent_folder_id) REFERENCES folders(id),
+    CHECK (basename != '')
+);
+CREATE UNIQUE INDEX index_files_zip_basename_unique ON files (zip_file_id, parent_folder_id, basename);
+CREATE INDEX index_files_on_parent_folder_id_basename ON files (parent_folder_id, basename);
+CREATE TABLE files_fingerprints (
+    file_id integer NOT NULL,
+    type varchar(255) NOT NULL,
+    fingerprint blob NOT NULL,
+    PRIMARY KEY (file_id, type, fingerprint)
+);
+CREATE TABLE video_files (
+    file_id integer NOT NULL PRIMARY KEY,
+    duration float NOT NULL,
+    video_codec varchar(255) NOT NULL,
+    format varchar(255) NOT NULL,
+    audio_codec varchar(255) NOT NULL,
+    width tinyint NOT NULL,
+    height tinyint NOT NULL,
+    frame_rate float NOT NULL,
+    bit_rate integer NOT NULL,
+    interactive boolean NOT NULL DEFAULT '0',
+    interactive_speed int
+);
+CREATE TABLE scenes (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    title varchar(255),
+    date date,
+    rating tinyint,
+    studio_id integer,
+    organized boolean NOT NULL DEFAULT '0',
+    created_at datetime NOT NULL,
+    updated_at datetime NOT NULL
+);
+CREATE TABLE scene_stash_ids (
+    scene_id integer NOT NULL,
+    endpoint varchar(255) NOT NULL,
+    stash_id varchar(36) NOT NULL
+);
+CREATE TABLE studios (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    name varchar(255) NOT NULL,
+    parent_id integer
+);
+CREATE TABLE tags (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    name varchar(255) NOT NULL
+);
+CREATE TABLE scenes_tags (
+    scene_id integer NOT NULL,
+    tag_id integer NOT NULL,
+    PRIMARY KEY(scene_id, tag_id)
+);
+CREATE TABLE performers (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    name varchar(255) NOT NULL,
+    gender varchar(20),
+    favorite boolean NOT NULL DEFAULT '0',
+    rating tinyint
+);
+CREATE TABLE performers_scenes (
+    performer_id integer NOT NULL,
+    scene_id integer NOT NULL,
+    PRIMARY KEY(scene_id, performer_id)
+);
+CREATE TABLE performer_stash_ids (
+    performer_id integer NOT NULL,
+    endpoint varchar(255) NOT NULL,
+    stash_id varchar(36) NOT NULL
+);
+CREATE TABLE movies (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    name varchar(255) NOT NULL,
+    date date
+);
+CREATE TABLE movies_scenes (
+    movie_id integer NOT NULL,
+    scene_id integer NOT NULL,
+    scene_index tinyint,
+    PRIMARY KEY(movie_id, scene_id)
+);
+CREATE TABLE scenes_files (
+    scene_id integer NOT NULL,
+    file_id integer NOT NULL,
+    "primary" boolean NOT NULL,
+    PRIMARY KEY(scene_id, file_id)
+);
+CREATE INDEX index_scenes_files_file_id ON scenes_files (file_id);
+"""
+
+WORDS = (
+    "alpha amber angel autumn baby beach blue bright candy cherry city cloud "
+    "coffee crystal dance dark dream early evening fire first forest free "
+    "garden gold happy heart hidden holiday honey hot island last late lazy "
+    "light little lost love lucky magic midnight morning night ocean open "
+    "paradise party pink private pure rain red river road rose secret "
+    "shadow silver sky slow snow soft spring star summer sun sweet time "
+    "wild winter young"
+).split()
+CODECS = (("h264", "aac"), ("hevc", "aac"), ("vp9", "opus"), ("av1", "opus"))
+RESOLUTIONS = ((1280, 720), (1920, 1080), (3840, 2160))
+
+
+def make_library(root: str, n_scenes: int, schema=38, seed=0) -> "FakeStash":
+    """
+    Write a library of n_scenes scenes in root (files in root/library, the
+    database in root/stash.sqlite) and return the FakeStash serving it.
+
+    Studios have parent chains up to 8 levels deep, about 1 scene out of 10
+    has several files.
+    """
+    rng = random.Random(seed)
+    library = os.path.join(root, "library")
+    database = os.path.join(root, "stash.sqlite")
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    studios = {}
+    for i in range(1, max(20, n_scenes // 50) + 1):
+        parent = None
+        if i > 1 and rng.random() < 0.8:
+            # mostly the previous studio, to have deep chains
+            candidate = str(i - 1) if rng.random() < 0.6 else str(rng.randint(1, i - 1))
+            if studio_depth(studios, candidate) < 8:
+                parent = candidate
+        studios[str(i)] = {
+            "id": str(i),
+            "name": " ".join(w.capitalize() for w in rng.sample(WORDS, 2)) + f" {i}",
+            "parent_id": parent,
+        }
+    performers = {}
+    for i in range(1, max(50, n_scenes // 5) + 1):
+        performers[str(i)] = {
+            "id": str(i),
+            "name": f"{rng.choice(WORDS).capitalize()} {rng.choice(WORDS).capitalize()}",
+            "gender": rng.choice(("FEMALE", "FEMALE", "FEMALE", "MALE", "NON_BINARY")),
+            "favorite": rng.random() < 0.1,
+            "rating100": rng.choice((None, 20, 40, 60, 80, 100)),
+            "stash_ids": [],
+        }
+    tags = {
+        str(i): {"id": str(i), "name": f"{rng.choice(WORDS).capitalize()}{i}"}
+        for i in range(1, 301)
+    }
+
+    if os.path.exists(database):
+        os.remove(database)
+    db = sqlite3.connect(database)
+    db.executescript(SCHEMA)
+    if schema >= 38:
+        db.execute("ALTER TABLE scenes ADD COLUMN code text")
+    db.execute("INSERT INTO schema_migrations VALUES (?, 0)", (schema,))
+    stamp = now.isoformat()
+    folders = [(1, library, None)]
+    scenes = {}
+    files = {}
+    file_rows = []
+    scene_rows = []
+    scenes_files = []
+    file_id = 0
+    for i in range(1, n_scenes + 1):
+        folder_id = 2 + i % 100
+        if i <= 100:
+            folders.append((folder_id, os.path.join(library, "incoming", f"{folder_id:03d}"), None))
+        width, height = rng.choice(RESOLUTIONS)
+        video_codec, audio_codec = rng.choice(CODECS)
+        n_files = 1 if rng.random() < 0.9 else rng.choice((2, 2, 3))
+        scene_files = []
+        for n in range(n_files):
+            file_id += 1
+            basename = f"{rng.choice(WORDS)}_{i}_{n}.mp4"
+            oshash = f"{rng.getrandbits(64):016x}"
+            files[file_id] = {
+                "video_codec": video_codec,
+                "audio_codec": audio_codec,
+                "width": width,
+                "height": height,
+                "frame_rate": rng.choice((25.0, 29.97, 30.0, 60.0)),
+                "duration": float(rng.randint(300, 5400)),
+                "bit_rate": rng.randint(2, 20) * 1000000,
+                "fingerprints": [
+                    {"type": "oshash", "value": oshash},
+                    {"type": "phash", "value": f"{rng.getrandbits(64):x}"},
+                ],
+            }
+            file_rows.append((file_id, basename, folder_id, 0, stamp, stamp, stamp))
+            scenes_files.append((i, file_id, n == 0))
+            scene_files.append(file_id)
+        studio_id = rng.choice(list(studios)) if rng.random() < 0.9 else None
+        updated_at = (now + timedelta(seconds=i)).isoformat()
+        scenes[str(i)] = {
+            "id": str(i),
+            "title": " ".join(w.capitalize() for w in rng.sample(WORDS, rng.randint(2, 5))),
+            "code": f"C{i:06d}" if rng.random() < 0.3 else None,
+            "date": f"{rng.randint(2010, 2023)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "rating100": rng.choice((None, 20, 40, 60, 80, 100)),
+            "organized": rng.random() < 0.8,
+            "updated_at": updated_at,
+            "stash_ids": [],
+            "studio_id": studio_id,
+            # in the order of Stash, by name
+            "performer_ids": sorted(
+                rng.sample(list(performers), rng.randint(0, 4)),
+                key=lambda x: (performers[x]["name"], int(x)),
+            ),
+            "tag_ids": sorted(rng.sample(list(tags), rng.randint(0, 8)), key=lambda x: tags[x]["name"]),
+            "movies": [],
+            "file_ids": scene_files,
+        }
+        scene = scenes[str(i)]
+        scene_rows.append(
+            (
+                i,
+                scene["title"],
+                scene["date"],
+                db_rating(scene["rating100"], schema),
+                studio_id,
+                scene["organized"],
+                updated_at,
+                stamp,
+                scene["code"],
+            )
+        )
+    db.executemany(
+        "INSERT INTO folders (id, path, parent_folder_id, mod_time, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(f_id, path, parent or (1 if f_id != 1 else None), stamp, stamp, stamp) for f_id, path, parent in folders],
+    )
+    db.executemany(
+        "INSERT INTO files (id, basename, parent_folder_id, size, mod_time, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        file_rows,
+    )
+    db.executemany(
+        "INSERT INTO files_fingerprints (file_id, type, fingerprint) VALUES (?, 'oshash', ?)",
+        [(f_id, f["fingerprints"][0]["value"]) for f_id, f in files.items()],
+    )
+    # phash is an int64 in the database
+    db.executemany(
+        "INSERT INTO files_fingerprints (file_id, type, fingerprint) VALUES (?, 'phash', ?)",
+        [(f_id, int64(f["fingerprints"][1]["value"])) for f_id, f in files.items()],
+    )
+    db.executemany(
+        "INSERT INTO video_files (file_id, duration, video_codec, format, audio_codec, width, height, frame_rate, bit_rate) VALUES (?, ?, ?, 'mp4', ?, ?, ?, ?, ?)",
+        [
+            (f_id, f["duration"], f["video_codec"], f["audio_codec"], f["width"], f["height"], f["frame_rate"], f["bit_rate"])
+            for f_id, f in files.items()
+        ],
+    )
+    db.executemany(
+        "INSERT INTO scenes (id, title, date, rating, studio_id, organized, updated_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [row[:-1] for row in scene_rows],
+    )
+    if schema >= 38:
+        db.executemany("UPDATE scenes SET code = ? WHERE id = ?", [(row[-1], row[0]) for row in scene_rows])
+    db.executemany(
+        "INSERT INTO studios (id, name, parent_id) VALUES (?, ?, ?)",
+        [(int(x["id"]), x["name"], x["parent_id"] and int(x["parent_id"])) for x in studios.values()],
+    )
+    db.executemany("INSERT INTO tags (id, name) VALUES (?, ?)", [(int(x["id"]), x["name"]) for x in tags.values()])
+    db.executemany(
+        "INSERT INTO performers (id, name, gender, favorite, rating) VALUES (?, ?, ?, ?, ?)",
+        [
+            (int(x["id"]), x["name"], x["gender"], x["favorite"], db_rating(x["rating100"], schema))
+            for x in performers.values()
+        ],
+    )
+    db.executemany(
+        "INSERT INTO scenes_tags (scene_id, tag_id) VALUES (?, ?)",
+        [(int(x["id"]), int(t)) for x in scenes.values() for t in x["tag_ids"]],
+    )
+    db.executemany(
+        "INSERT INTO performers_scenes (performer_id, scene_id) VALUES (?, ?)",
+        [(int(p), int(x["id"])) for x in scenes.values() for p in x["performer_ids"]],
+    )
+    db.executemany(
+        'INSERT INTO scenes_files (scene_id, file_id, "primary") VALUES (?, ?, ?)',
+        scenes_files,
+    )
+    # the files on disk, empty
+    for _, path, _ in folders:
+        os.makedirs(path, exist_ok=True)
+    folder_paths = {f_id: path for f_id, path, _ in folders}
+    for _, basename, folder_id, *_ in file_rows:
+        open(os.path.join(folder_paths[folder_id], basename), "wb").close()
+    db.commit()
+    db.close()
+    return FakeStash(database, library, schema, scenes, files, studios, performers, tags)
+
+
+def db_rating(rating100, schema: int):
+    # on 5 before the version 40 of the schema
+    if rating100 is None or schema >= 40:
+        return rating100
+    return rating100 // 20
+
+
+def int64(value: str) -> int:
+    """A 64 bits hexadecimal hash as a signed integer, like SQLite stores it."""
+    value = int(value, 16)
+    return value - (1 << 64) if value >> 63 else value
+
+
+def studio_depth(studios: dict, studio_id) -> int:
+    depth = 0
+    while studio_id:
+        depth += 1
+        studio_id = studios[studio_id]["parent_id"]
+    return depth
+
+
+def commit_counter(database: str) -> int:
+    """File change counter of the SQLite header, increased by each commit."""
+    with open(database, "rb") as f:
+        f.seek(24)
+        return int.from_bytes(f.read(4), "big")
+
+
+# = GraphQL =
+TOKEN = re.compile(
+    r'[\s,]+|#[^\n]*|(\.\.\.|[{}()\[\]:!$=@]|"(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|[_A-Za-z][_0-9A-Za-z]*)'
+)
+
+
+class Variable(str):
+    pass
+
+
+class Parser:
+    """Just enough of GraphQL for the documents sent by the plugin."""
+
+    def __init__(self, text: str):
+        self.tokens = [m.group(1) for m in TOKEN.finditer(text) if m.group(1)]
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def next(self):
+        self.i += 1
+        return self.tokens[self.i - 1]
+
+    def expect(self, token: str):
+        if self.next() != token:
+            raise ValueError(f"'{token}' expected near token {self.i}")
+
+    def document(self):
+        operation = None
+        fragments = {}
+        while self.peek() is not None:
+            token = self.peek()
+            if token == "fragment":
+                self.next()
+                name = self.next()
+                self.expect("on")
+                self.next()
+                fragments[name] = self.selection_set()
+            elif token in ("query", "mutation"):
+                self.next()
+                if self.peek() not in ("(", "{"):
+                    self.next()
+                if self.peek() == "(":
+                    depth = 0
+                    while True:
+                        token = self.next()
+                        depth += {"(": 1, ")": -1}.get(token, 0)
+                        if depth == 0:
+                            break
+                operation = self.selection_set()
+            else:
+                operation = self.selection_set()
+        return operation, fragments
+
+    def selection_set(self) -> list:
+        self.expect("{")
+        selections = []
+        while self.peek() != "}":
+            selections.append(self.selection())
+        self.next()
+        return selections
+
+    def selection(self):
+        if self.peek() == "...":
+            self.next()
+            if self.peek() == "on":
+                self.next()
+                self.next()
+                return ("inline", self.selection_set())
+            return ("spread", self.next())
+        alias = name = self.next()
+        if self.peek() == ":":
+            self.next()
+            name = self.next()
+        arguments = {}
+        if self.peek() == "(":
+            self.next()
+            while self.peek() != ")":
+                key = self.next()
+                self.expect(":")
+                arguments[key] = self.value()
+            self.next()
+        selections = self.selection_set() if self.peek() == "{" else None
+        return ("field", alias, name, arguments, selections)
+
+    def value(self):
+        token = self.next()
+        if token == "$":
+            return Variable(self.next())
+        if token.startswith('"'):
+            return json.loads(token)
+        if token == "{":
+            value = {}
+            while self.peek() != "}":
+                key = self.next()
+                self.expect(":")
+                value[key] = self.value()
+            self.next()
+            return value
+        if token == "[":
+            value = []
+            while self.peek() != "]":
+                value.append(self.value())
+            self.next()
+            return value
+        if token in ("true", "false"):
+            return token == "true"
+        if token == "null":
+            return None
+        if token[0] in "-0123456789":
+            return float(token) if "." in token or "e" in token.lower() else int(token)
+        # enum
+        return token
+
+
+def bind(value, variables: dict):
+    if isinstance(value, Variable):
+        return variables.get(value)
+    if isinstance(value, dict):
+        return {k: bind(v, variables) for k, v in value.items()}
+    if isinstance(value, list):
+        return [bind(v, variables) for v in value]
+    return value
+
+
+def project(value, selections, fragments: dict):
+    """Keep the selected fields of value (dicts and lists of dicts)."""
+    if selections is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [project(v, selections, fragments) for v in value]
+    result = {}
+    for selection in selections:
+        if selection[0] == "spread":
+            result.update(project(value, fragments[selection[1]], fragments))
+        elif selection[0] == "inline":
+            result.update(project(value, selection[1], fragments))
+        else:
+            _, alias, name, arguments, sub = selection
+            if name == "fingerprint":
+                field = next(
+                    (f["value"] for f in value.get("fingerprints", []) if f["type"] == arguments.get("type")),
+                    None,
+                )
+            elif name == "__typename":
+                field = value.get("__typename")
+            else:
+                field = value.get(name)
+            result[alias] = project(field, sub, fragments)
+    return result
+
+
+class FakeStash:
+    """The data of a library and the root fields used by renamerOnUpdate."""
+
+    def __init__(self, database, library, schema, scenes, files, studios, performers, tags):
+        self.database = database
+        self.library = library
+        self.schema = schema
+        self.scenes = scenes
+        self.files = files
+        self.studios = studios
+        self.performers = performers
+        self.tags = tags
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.order = None
+
+    def connection(self) -> sqlite3.Connection:
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = sqlite3.connect(self.database, timeout=30)
+        return self.local.conn
+
+    def execute(self, query: str, variables: dict) -> dict:
+        operation, fragments = Parser(query).document()
+        data = {}
+        for selection in operation:
+            _, alias, name, arguments, sub = selection
+            resolver = getattr(self, f"resolve_{name}", None)
+            if resolver is None:
+                raise ValueError(f"Unknown field {name}")
+            data[alias] = project(resolver(**bind(arguments, variables)), sub, fragments)
+        return data
+
+    # = objects =
+    def studio(self, studio_id):
+        if not studio_id:
+            return None
+        studio = self.studios[studio_id]
+        return {
+            "id": studio["id"],
+            "name": studio["name"],
+            "parent_studio": self.studio(studio["parent_id"]),
+        }
+
+    def scene_objects(self, scene_ids: list) -> list:
+        """The scenes with their files, paths from the database."""
+        paths = {}
+        conn = self.connection()
+        for i in range(0, len(scene_ids), 500):
+            chunk = [int(x) for x in scene_ids[i : i + 500]]
+            rows = conn.execute(
+                f'SELECT scenes_files.scene_id, files.id, folders.path, files.basename FROM scenes_files JOIN files ON files.id = scenes_files.file_id JOIN folders ON folders.id = files.parent_folder_id WHERE scenes_files.scene_id IN ({",".join("?" * len(chunk))}) ORDER BY scenes_files."primary" DESC, files.id',
+                chunk,
+            )
+            for scene_id, file_id, folder, basename in rows:
+                paths.setdefault(str(scene_id), []).append((file_id, os.path.join(folder, basename)))
+        scenes = []
+        for scene_id in scene_ids:
+            scene = self.scenes.get(str(scene_id))
+            if scene is None:
+                scenes.append(None)
+                continue
+            obj = {k: v for k, v in scene.items() if k not in ("performer_ids", "tag_ids", "file_ids", "studio_id")}
+            obj["files"] = [dict(self.files[file_id], path=path) for file_id, path in paths.get(str(scene_id), [])]
+            obj["studio"] = self.studio(scene["studio_id"])
+            obj["performers"] = [self.performers[x] for x in scene["performer_ids"]]
+            obj["tags"] = [self.tags[x] for x in scene["tag_ids"]]
+            if self.schema < 38:
+                obj.pop("code", None)
+            scenes.append(obj)
+        return scenes
+
+    def sorted_ids(self) -> list:
+        with self.lock:
+            if self.order is None:
+                self.order = sorted(self.scenes, key=lambda x: (self.scenes[x]["updated_at"], int(x)))
+            return self.order
+
+    # = root fields =
+    def resolve_configuration(self):
+        return {
+            "general": {
+                "databasePath": self.database,
+                "stashes": [{"path": self.library, "excludeVideo": False, "excludeImage": False}],
+            }
+        }
+
+    def resolve_systemStatus(self):
+        return {"databaseSchema": self.schema, "status": "OK"}
+
+    def resolve_version(self):
+        return {"hash": "benchmark", "version": "v0.0.0-benchmark"}
+
+    def resolve_findScene(self, id=None, checksum=None):
+        return self.scene_objects([id])[0] if id is not None else None
+
+    def resolve_findScenes(self, filter=None, scene_filter=None, scene_ids=None):
+        filter = filter or {}
+        scene_filter = scene_filter or {}
+        ids = self.sorted_ids()
+        if "updated_at" in scene_filter:
+            criterion = scene_filter["updated_at"]
+            value = datetime.fromisoformat(criterion["value"]).astimezone(timezone.utc).isoformat()
+            keys = [self.scenes[x]["updated_at"] for x in ids]
+            if criterion["modifier"] == "GREATER_THAN":
+                ids = ids[bisect.bisect_right(keys, value) :]
+            elif criterion["modifier"] == "LESS_THAN":
+                ids = ids[: bisect.bisect_left(keys, value)]
+        if "path" in scene_filter:
+            criterion = scene_filter["path"]
+            conn = self.connection()
+            if criterion["modifier"] == "EQUALS":
+                folder, basename = os.path.split(criterion["value"])
+                rows = conn.execute(
+                    "SELECT scenes_files.scene_id FROM scenes_files JOIN files ON files.id = scenes_files.file_id JOIN folders ON folders.id = files.parent_folder_id WHERE folders.path = ? AND files.basename = ?",
+                    (folder, basename),
+                )
+            else:
+                rows = conn.execute(
+                    "SELECT scenes_files.scene_id FROM scenes_files JOIN files ON files.id = scenes_files.file_id JOIN folders ON folders.id = files.parent_folder_id WHERE folders.path || ? || files.basename LIKE ?",
+                    (os.sep, f"%{criterion['value']}%"),
+                )
+            found = {str(row[0]) for row in rows}
+            ids = [x for x in ids if x in found]
+        if filter.get("direction") == "DESC":
+            ids = ids[::-1]
+        per_page = filter.get("per_page", 25)
+        page = filter.get("page", 1)
+        page_ids = ids if per_page < 0 else ids[(page - 1) * per_page : page * per_page]
+        return {"count": len(ids), "scenes": self.scene_objects(page_ids)}
+
+    def resolve_findStudio(self, id=None):
+        return self.studio(id)
+
+    def resolve_findStudios(self, filter=None, studio_filter=None):
+        studios = [self.studio(x) for x in self.studios]
+        return {"count": len(studios), "studios": studios}
+
+    def resolve_bulkSceneUpdate(self, input=None):
+        stamp = datetime.now(timezone.utc).isoformat()
+        conn = self.connection()
+        with self.lock:
+            for scene_id in input["ids"]:
+                scene = self.scenes[str(scene_id)]
+                tag_ids = input.get("tag_ids")
+                if tag_ids and tag_ids.get("mode") == "REMOVE":
+                    scene["tag_ids"] = [x for x in scene["tag_ids"] if x not in tag_ids["ids"]]
+                    conn.executemany(
+                        "DELETE FROM scenes_tags WHERE scene_id = ? AND tag_id = ?",
+                        [(int(scene_id), int(x)) for x in tag_ids["ids"]],
+                    )
+                scene["updated_at"] = stamp
+                conn.execute("UPDATE scenes SET updated_at = ? WHERE id = ?", (stamp, int(scene_id)))
+            conn.commit()
+            self.order = None
+        return [{"id": str(x)} for x in input["ids"]]
+
+
+class FakeStashServer:
+    """FakeStash on http://127.0.0.1:port/graphql, requests counts the POSTs."""
+
+    def __init__(self, stash: FakeStash):
+        self.stash = stash
+        self.requests = 0
+        self.count_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, like Stash
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                with server.count_lock:
+                    server.requests += 1
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                try:
+                    answer = {"data": server.stash.execute(body["query"], body.get("variables") or {})}
+                except Exception as err:
+                    answer = {"errors": [{"message": f"{type(err).__name__}: {err}"}]}
+                payload = json.dumps(answer).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()